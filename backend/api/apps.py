@@ -10,9 +10,36 @@ class ApiConfig(AppConfig):
         It is used to perform any startup tasks, such as rebuilding communication nodes."""
         import os
         import api.signals
-        if os.environ.get("RUN_MAIN") == "true":
-            from api.models import Agent
-            from mqtt_backend.comm_node_manager import CommNodeManager
-            agent_ids = list(Agent.objects.filter(is_archived=False).values_list('id', flat=True))
-            CommNodeManager.rebuild_all(agent_ids)
-            print("Rebuilt all comm nodes at backend startup")
\ No newline at end of file
+        from django.conf import settings
+        from mqtt_backend.comm_node_manager import CommNodeManager
+        CommNodeManager.membership_provider = agent_context_ids
+        if settings.COMM_SHARDING:
+            # Nodes are owned by comm shards. ready() also runs for migrate, test and run_comm_shard,
+            # so web workers join the ring from the serving process only: the runserver child here,
+            # gunicorn workers through the post_worker_init hook in gunicorn.conf.py
+            if os.environ.get("RUN_MAIN") == "true":
+                start_worker_shard()
+        elif os.environ.get("RUN_MAIN") == "true":
+            CommNodeManager.rebuild_all(active_agent_ids())
+            print("Rebuilt all comm nodes at backend startup")
+
+
+def start_worker_shard():
+    """Let this web worker join the comm shard ring, if COMM_SHARD_IN_WORKERS is set."""
+    from django.conf import settings
+    from mqtt_backend.comm_node_manager import CommNodeManager
+    if settings.COMM_SHARDING and settings.COMM_SHARD_IN_WORKERS:
+        CommNodeManager.start_shard(active_agent_ids)
+        print("Joined comm shard ring at backend startup")
+
+
+def active_agent_ids():
+    """IDs of all agents that should have a communication node."""
+    from api.models import Agent
+    return list(Agent.objects.filter(is_archived=False).values_list('id', flat=True))
+
+
+def agent_context_ids(agent_id):
+    """IDs of the contexts an agent is a member of (their multicast topics are subscribed)."""
+    from api.models import Context
+    return list(Context.objects.filter(agents__id=agent_id, is_archived=False).values_list('id', flat=True))
@@ -0,0 +1,252 @@
+"""
+This module provides bulk create/update/delete endpoints for the api viewsets.
+
+Each endpoint takes a JSON list. Items are validated with the viewset's serializer in "bulk" mode
+(serializer context `bulk`), in which the serializers skip their per-row database checks:
+
+- related objects referenced by primary key are fetched once per field for the whole list
+- uniqueness and other cross-row checks run once per batch in the viewset's bulk_check()
+
+Valid items are written with bulk_create/bulk_update in one transaction. Since those send no
+model signals, audit logging and cache invalidation are done explicitly (see
+api.signals.objects_bulk_written). Errors are reported per item by list index; with
+?all_or_nothing=true nothing is written unless every item is valid.
+"""
+
+import copy
+import logging
+from django.db import transaction
+from django.db.models.functions import Lower
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.response import Response
+from .errors import handle_api_error
+from .signals import objects_bulk_written
+
+logger = logging.getLogger('omnisyslogger')
+
+
+class PrefetchedObjects:
+    """Stands in for a related field's queryset: get(pk=...) answered from one in_bulk() query."""
+
+    def __init__(self, model, objects):
+        self.model = model
+        self.objects = objects
+
+    def get(self, pk):
+        try:
+            return self.objects[int(pk)]
+        except KeyError:
+            raise self.model.DoesNotExist()
+
+
+def duplicate_name_errors(model, objects, message):
+    """
+    Check the case-insensitive uniqueness of the names of a batch in one query: against the rows
+    outside the batch and against earlier items. message is formatted with the name.
+    """
+    names = {index: obj.name.lower() for index, obj in objects.items()}
+    batch_pks = [obj.pk for obj in objects.values() if obj.pk is not None]
+    taken = set(
+        model.objects.annotate(lower_name=Lower('name'))
+        .filter(lower_name__in=set(names.values())).exclude(pk__in=batch_pks)
+        .values_list('lower_name', flat=True)
+    )
+    errors = {}
+    seen = set()
+    for index in sorted(names):
+        if names[index] in taken:
+            errors[index] = {'name': [message.format(objects[index].name)]}
+        elif names[index] in seen:
+            errors[index] = {'name': ["Name is used by an earlier item of this batch"]}
+        seen.add(names[index])
+    return errors
+
+
+class BulkMixin:
+    """
+    Adds bulk_create, bulk_update and bulk_delete actions to a ModelViewSet.
+    bulk_update_fields: the fields an update item may change (besides its id).
+    """
+    bulk_max_items = 5000
+    bulk_update_fields = ()
+
+    # -- hooks ---------------------------------------------------------------
+
+    def get_bulk_queryset(self):
+        """Queryset the instances of updated/deleted items are loaded from."""
+        return self.get_queryset().model.objects.all()
+
+    def bulk_check(self, objects, instances):
+        """
+        Batch-level validation of the unsaved objects ({index: object}); instances maps the ids of
+        updated objects to their current rows (empty for creates). Returns {index: errors}.
+        """
+        return {}
+
+    def bulk_deleted(self, objects):
+        """Called with the deleted objects after the delete."""
+
+    # -- helpers -------------------------------------------------------------
+
+    def _all_or_nothing(self, request):
+        return request.query_params.get('all_or_nothing', 'false').lower() == 'true'
+
+    def _bulk_items(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            raise ValueError("Request body must be a non-empty list")
+        if len(items) > self.bulk_max_items:
+            raise ValueError(f"A bulk request cannot contain more than {self.bulk_max_items} items")
+        return items
+
+    def _prefetch_related(self, items):
+        """Fetch the objects referenced by each writable primary key field, one query per field."""
+        prefetched = {}
+        for name, field in self.get_serializer().fields.items():
+            many = isinstance(field, ManyRelatedField)
+            relation = field.child_relation if many else field
+            if field.read_only or not isinstance(relation, PrimaryKeyRelatedField):
+                continue
+            pks = set()
+            for item in items:
+                value = item.get(name) if isinstance(item, dict) else None
+                for pk in (value if many and isinstance(value, list) else [value]):
+                    if isinstance(pk, int) or (isinstance(pk, str) and pk.isdigit()):
+                        pks.add(int(pk))
+            if pks:
+                queryset = relation.get_queryset()
+                prefetched[name] = PrefetchedObjects(queryset.model, queryset.in_bulk(pks))
+        return prefetched
+
+    def _validate_items(self, items, instances=None):
+        """
+        Validate items (updates if instances is given). Returns ({index: unsaved object},
+        {index: errors}, names of the model fields set on the objects).
+        """
+        model = self.get_queryset().model
+        prefetched = self._prefetch_related(items)
+        context = {**self.get_serializer_context(), 'bulk': True}
+        objects, errors, fields = {}, {}, set()
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors[index] = {'non_field_errors': ["Each item must be an object"]}
+                continue
+            instance = None
+            if instances is not None:
+                pk = item.get('id')
+                instance = instances.get(int(pk)) if str(pk).isdigit() else None
+                if instance is None:
+                    errors[index] = {'id': [f"{model.__name__} with ID {item.get('id')} not found"]}
+                    continue
+                unknown = set(item) - set(self.bulk_update_fields) - {'id'}
+                if unknown:
+                    errors[index] = {field: ["This field cannot be changed in bulk"] for field in sorted(unknown)}
+                    continue
+                item = {k: v for k, v in item.items() if k != 'id'}
+
+            serializer = self.get_serializer(instance, data=item, partial=instance is not None, context=context)
+            for name, stand_in in prefetched.items():
+                field = serializer.fields[name]
+                (field.child_relation if isinstance(field, ManyRelatedField) else field).queryset = stand_in
+            if not serializer.is_valid():
+                errors[index] = serializer.errors
+                continue
+            obj = copy.copy(instance) if instance is not None else model()
+            for attr, value in serializer.validated_data.items():
+                setattr(obj, attr, value)
+                fields.add(attr)
+            objects[index] = obj
+
+        errors.update(self.bulk_check(objects, instances or {}))
+        objects = {index: obj for index, obj in objects.items() if index not in errors}
+        return objects, errors, sorted(fields)
+
+    @staticmethod
+    def _error_list(errors):
+        return [{'index': index, 'errors': errors[index]} for index in sorted(errors)]
+
+    def _load_instances(self, ids):
+        return self.get_bulk_queryset().in_bulk([int(pk) for pk in ids if str(pk).isdigit()])
+
+    # -- endpoints -----------------------------------------------------------
+
+    @action(detail=False, methods=['post'])
+    def bulk_create(self, request):
+        """Create the objects of a list payload in one transaction, reporting errors per item."""
+        model = self.get_queryset().model
+        try:
+            items = self._bulk_items(request)
+            objects, errors, _ = self._validate_items(items)
+            created = []
+            if objects and not (errors and self._all_or_nothing(request)):
+                with transaction.atomic():
+                    created = model.objects.bulk_create([objects[index] for index in sorted(objects)])
+                    objects_bulk_written(model, created)
+                logger.info(f"User {request.user.username} bulk created {len(created)} {model.__name__} objects")
+            if errors:
+                logger.warning(f"Bulk create of {len(items)} {model.__name__} objects rejected {len(errors)} items")
+            return Response({
+                'created': self.get_serializer(created, many=True).data,
+                'errors': self._error_list(errors),
+            }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+        except Exception as e:
+            logger.error(f"Error bulk creating {model.__name__} objects: {str(e)}")
+            return handle_api_error(e, f"Failed to bulk create {model.__name__} objects")
+
+    @action(detail=False, methods=['patch'])
+    def bulk_update(self, request):
+        """Apply partial updates ({id, ...fields}) of a list payload in one transaction."""
+        model = self.get_queryset().model
+        try:
+            items = self._bulk_items(request)
+            instances = self._load_instances([item.get('id') for item in items if isinstance(item, dict)])
+            objects, errors, fields = self._validate_items(items, instances)
+            updated = []
+            if objects and not (errors and self._all_or_nothing(request)):
+                updated = [objects[index] for index in sorted(objects)]
+                with transaction.atomic():
+                    model.objects.bulk_update(updated, fields)
+                    objects_bulk_written(model, updated, old_objects=instances)
+                logger.info(f"User {request.user.username} bulk updated {len(updated)} {model.__name__} objects")
+            if errors:
+                logger.warning(f"Bulk update of {len(items)} {model.__name__} objects rejected {len(errors)} items")
+            return Response({
+                'updated': self.get_serializer(updated, many=True).data,
+                'errors': self._error_list(errors),
+            }, status=status.HTTP_200_OK if updated or not errors else status.HTTP_400_BAD_REQUEST)
+
+        except Exception as e:
+            logger.error(f"Error bulk updating {model.__name__} objects: {str(e)}")
+            return handle_api_error(e, f"Failed to bulk update {model.__name__} objects")
+
+    @action(detail=False, methods=['post'])
+    def bulk_delete(self, request):
+        """Delete the objects whose ids are listed, in one transaction."""
+        model = self.get_queryset().model
+        try:
+            ids = self._bulk_items(request)
+            instances = self._load_instances(ids)
+            errors = {
+                index: {'id': [f"{model.__name__} with ID {pk} not found"]}
+                for index, pk in enumerate(ids) if not (str(pk).isdigit() and int(pk) in instances)
+            }
+            deleted = []
+            if instances and not (errors and self._all_or_nothing(request)):
+                deleted = list(instances.values())
+                with transaction.atomic():
+                    # QuerySet.delete() still sends pre/post_delete per row, which keeps caches in sync
+                    model.objects.filter(pk__in=list(instances)).delete()
+                self.bulk_deleted(deleted)
+                logger.warning(
+                    f"User {request.user.username} bulk deleted {len(deleted)} {model.__name__} objects: {sorted(instances)}")
+            return Response({
+                'deleted': sorted(obj.pk for obj in deleted),
+                'errors': self._error_list(errors),
+            }, status=status.HTTP_200_OK if deleted or not errors else status.HTTP_400_BAD_REQUEST)
+
+        except Exception as e:
+            logger.error(f"Error bulk deleting {model.__name__} objects: {str(e)}")
+            return handle_api_error(e, f"Failed to bulk delete {model.__name__} objects")
@@ -0,0 +1,223 @@
+"""
+This module provides version-based response caching for the API viewsets.
+
+Cached list/retrieve responses live in the default (Redis) cache. Their keys contain the
+version counters of every model the response is built from, so a write never has to find and
+delete keys: signals bump the counters (see api.signals) and stale entries simply stop being
+read and expire with their TTL.
+
+- list responses depend on the model-wide versions of the viewset's cache_models
+- retrieve responses depend on the version of the object itself plus the model-wide versions
+  of the other (nested) models, so updating one object does not evict its siblings
+
+Keys also contain the user role, path and sorted query parameters. Hits and misses are counted
+per viewset and exposed through cache_stats().
+
+The versions are nanosecond timestamps of the last change, so the same lookup also yields a weak
+ETag (hash of the key) and Last-Modified (newest version). Conditional GETs are answered with 304
+before the cached data is fetched or a serializer runs.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+logger = logging.getLogger('omnisyslogger')
+
+KEY_PREFIX = "apicache"
+STATS_KEY = f"{KEY_PREFIX}:stats"
+
+
+def _model_label(model):
+    return model._meta.label_lower
+
+
+def _version_key(model, pk=None):
+    if pk is None:
+        return f"{KEY_PREFIX}:version:{_model_label(model)}"
+    return f"{KEY_PREFIX}:version:{_model_label(model)}:{pk}"
+
+
+def _version_timeout(key):
+    """
+    Model-wide versions (apicache:version:<model>) never expire. Per-object versions
+    (apicache:version:<model>:<pk>) live as long as the responses cached under them, so objects
+    that are never read again leave no key behind; an expired one is re-seeded from the clock,
+    which can only invalidate more.
+    """
+    if key.count(":") < 3:
+        return None
+    return getattr(settings, 'API_CACHE_TTL', 300)
+
+
+def get_versions(keys):
+    """Return the current value of each version key, initialising missing ones."""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Start from the clock so that a flushed cache never hands out an old version again
+            cache.add(key, time.time_ns(), timeout=_version_timeout(key))
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def model_version(model):
+    """Return the current version of a model; it changes whenever one of its rows changes."""
+    return get_versions([_version_key(model)])[0]
+
+
+def versions_etag(models, *parts):
+    """
+    Weak ETag of a response built from the given models and request parts. It comes from the
+    version counters alone, so it can be checked before any query runs.
+    """
+    versions = get_versions([_version_key(model) for model in models])
+    return f'W/"{hashlib.md5(json.dumps([versions, parts]).encode()).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an ETag with the tags of an If-None-Match header."""
+    tags = [tag.strip() for tag in (if_none_match or '').split(',')]
+    return any(tag.removeprefix('W/') == etag.removeprefix('W/') for tag in tags if tag)
+
+
+def bump_version(model, pk=None):
+    """Invalidate all cached responses of a model (and of one object, if pk is given)."""
+    keys = [_version_key(model)]
+    if pk is not None:
+        keys.append(_version_key(model, pk))
+    for key in keys:
+        try:
+            # Versions are the time of the last change in ns, so they double as Last-Modified
+            old = cache.get(key) or 0
+            cache.set(key, max(time.time_ns(), old + 1), timeout=_version_timeout(key))
+        except Exception as e:
+            logger.warning(f"Failed to bump cache version {key}: {str(e)}")
+
+
+def _count(name, outcome):
+    try:
+        key = f"{STATS_KEY}:{name}:{outcome}"
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+    except Exception:
+        pass
+
+
+def cache_stats():
+    """Return hits, misses and hit ratio per cached viewset."""
+    stats = {}
+    for name in CachedResponseMixin.registry:
+        hits = cache.get(f"{STATS_KEY}:{name}:hit", 0)
+        misses = cache.get(f"{STATS_KEY}:{name}:miss", 0)
+        total = hits + misses
+        stats[name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / total, 4) if total else None,
+        }
+    return stats
+
+
+class CachedResponseMixin:
+    """
+    Caches list and retrieve responses of a ModelViewSet.
+    cache_models: models the serialized output depends on, the viewset's own model first.
+    """
+    cache_models = ()
+    registry = set()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.cache_models:
+            CachedResponseMixin.registry.add(cls._cache_name())
+
+    @classmethod
+    def _cache_name(cls):
+        return _model_label(cls.cache_models[0])
+
+    def _version_keys(self, pk=None):
+        model, *nested = self.cache_models
+        if pk is None:
+            return [_version_key(m) for m in self.cache_models]
+        return [_version_key(model, pk)] + [_version_key(m) for m in nested]
+
+    def _cache_key(self, request, action, versions):
+        role = getattr(request.user, 'role', None) or 'anonymous'
+        params = json.dumps(sorted(request.query_params.lists()))
+        digest = hashlib.md5(f"{request.path}?{params}".encode()).hexdigest()
+        versions = ".".join(str(v) for v in versions)
+        return f"{KEY_PREFIX}:{self._cache_name()}:{action}:{role}:{versions}:{digest}"
+
+    def _not_modified(self, request, etag, last_modified, pk=None):
+        """Evaluate If-None-Match (weak comparison) and, without it, If-Modified-Since."""
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags:
+                # "*" matches any current representation, so the object has to exist
+                if pk is not None:
+                    self.get_object()  # raises Http404
+                return True
+            return etag_matches(if_none_match, etag)
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        return since is not None and int(last_modified) <= since
+
+    def _cached_response(self, request, action, render, pk=None):
+        try:
+            versions = get_versions(self._version_keys(pk))
+            key = self._cache_key(request, action, versions)
+        except Exception as e:
+            logger.warning(f"Response cache unavailable, serving uncached: {str(e)}")
+            return render()
+
+        # Validators come from the version counters alone, so a 304 never touches the serializers
+        etag = f'W/"{hashlib.md5(key.encode()).hexdigest()}"'
+        last_modified = max(versions) / 1e9
+        headers = {'ETag': etag, 'Last-Modified': http_date(last_modified)}
+        if self._not_modified(request, etag, last_modified, pk):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        enabled = getattr(settings, 'API_CACHE_ENABLED', True)
+        data = None
+        if enabled:
+            try:
+                data = cache.get(key)
+            except Exception as e:
+                logger.warning(f"Response cache unavailable, serving uncached: {str(e)}")
+                enabled = False
+
+        if data is not None:
+            _count(self._cache_name(), 'hit')
+            return Response(data, headers={**headers, 'X-Cache': 'HIT'})
+
+        response = render()
+        if response.status_code != 200:
+            return response
+        if enabled:
+            _count(self._cache_name(), 'miss')
+            try:
+                # Store plain JSON types; DRF's ReturnList/ReturnDict keep a reference to the serializer
+                plain = json.loads(JSONRenderer().render(response.data))
+                cache.set(key, plain, timeout=getattr(settings, 'API_CACHE_TTL', 300))
+            except Exception as e:
+                logger.warning(f"Failed to cache response: {str(e)}")
+            response['X-Cache'] = 'MISS'
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(request, 'list', lambda: super(CachedResponseMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return self._cached_response(
+            request, 'retrieve', lambda: super(CachedResponseMixin, self).retrieve(request, *args, **kwargs), pk=pk)
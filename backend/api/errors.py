@@ -0,0 +1,25 @@
+"""
+This module formats the error responses of the API views.
+"""
+
+from django.db import IntegrityError
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def handle_api_error(exception, default_message="An error occurred"):
+    """Simple helper to format error responses"""
+    error_message = str(exception) if str(exception) else default_message
+
+    # Customize based on exception type if needed
+    if isinstance(exception, IntegrityError):
+        error_message = "This operation conflicts with existing data"
+    elif isinstance(exception, ValueError):
+        error_message = f"Invalid value: {str(exception)}"
+    elif hasattr(exception, 'detail'):
+        # DRF validation errors
+        error_message = str(exception.detail)
+
+    return Response({
+        'error': error_message
+    }, status=status.HTTP_400_BAD_REQUEST)
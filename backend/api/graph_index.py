@@ -0,0 +1,520 @@
+"""
+This module keeps an in-memory index of the relationship graph for traversal queries.
+
+Agents are the nodes and relationships the directed edges. The index holds the edges twice in
+compressed sparse row (CSR) form, by source and by target, as NumPy arrays:
+
+- nodes: the sorted agent IDs; a node's index is its position (np.searchsorted)
+- indptr (int64, one entry per node + 1) and indices (int32, one entry per edge), so that the
+  targets of node i are indices[indptr[i]:indptr[i + 1]]
+
+That is about 8 bytes per edge for both directions, i.e. ~800 MB for 100M relationships, plus
+the build's chunk buffers. The arrays are filled from two ordered passes over the table in one
+snapshot, without sorting in Python, and the build refuses to run above GRAPH_INDEX_MAX_EDGES.
+
+Changes made after the build go into a small overlay of added and removed pairs, applied by the
+relationship signals after commit and broadcast to the other processes over the Redis pub/sub
+channel of api.tiered_cache. Queries run on a snapshot sharing the arrays and the overlay, so the
+lock guarding the overlay is only held while the snapshot is taken, never during a traversal; the
+first change after a snapshot copies the overlay's dicts (copy on write). Bulk creates, bulk updates that
+move relationships and imports add their pairs with a single broadcast (edges_added). Imports too
+large for the overlay and a lost broadcast connection mark the index stale instead; it is rebuilt
+on the next query, as it is once the overlay outgrows GRAPH_INDEX_MAX_DELTA.
+
+Traversals expand whole BFS frontiers at once with vectorized gathers over the CSR arrays and
+keep their visited nodes in a set until they have reached a sizeable share of the graph, so a
+query near its source costs what it reaches, not the size of the graph.
+"""
+
+import logging
+import time
+from threading import RLock
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from .models import Agent, Relationship
+from .tiered_cache import broadcast, ensure_listener, register_broadcast_handler
+
+logger = logging.getLogger('omnisyslogger')
+
+DIRECTIONS = ('out', 'in', 'both')
+BUILD_CHUNK_SIZE = 100000
+BROADCAST_KIND = 'graph'
+DENSE_SHARE = 64  # a traversal switches to a visited mask once it has seen size / DENSE_SHARE nodes
+
+
+class GraphIndexTooLarge(Exception):
+    pass
+
+
+def _gather(indptr, indices, frontier):
+    """Return (targets, sources): every CSR entry of the frontier nodes and the node it belongs to."""
+    if len(frontier) == 1:  # common on deep, narrow graphs; skips the segment arithmetic
+        node = frontier[0]
+        targets = indices[indptr[node]:indptr[node + 1]].astype(np.int64)
+        return targets, np.full(len(targets), node, dtype=np.int64)
+    starts = indptr[frontier]
+    lengths = indptr[frontier + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    # Position k of a segment maps to starts[segment] + k
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+    return indices[offsets].astype(np.int64), np.repeat(frontier, lengths)
+
+
+class _Visited:
+    """
+    The nodes a traversal has seen: a set while they are few, then a mask over all nodes once
+    allocating it costs no more than the work already done.
+    """
+
+    def __init__(self, size, source):
+        self.size = size
+        self.nodes = {int(source)}
+        self.mask = None
+
+    def __contains__(self, node):
+        return bool(self.mask[node]) if self.mask is not None else int(node) in self.nodes
+
+    def unseen(self, candidates):
+        """Boolean array: which of the candidate nodes have not been seen yet."""
+        if self.mask is None and (len(self.nodes) + len(candidates)) * DENSE_SHARE >= self.size:
+            self.mask = np.zeros(self.size, dtype=bool)
+            self.mask[np.fromiter(self.nodes, dtype=np.int64, count=len(self.nodes))] = True
+            self.nodes = None
+        if self.mask is not None:
+            return ~self.mask[candidates]
+        nodes = self.nodes
+        return np.fromiter((node not in nodes for node in candidates.tolist()), dtype=bool, count=len(candidates))
+
+    def add(self, nodes):
+        if self.mask is not None:
+            self.mask[nodes] = True
+        else:
+            self.nodes.update(nodes.tolist())
+
+
+class Traversal:
+    """The result of GraphIndex.bfs: one (nodes, parents) pair of arrays per depth, sorted by node."""
+
+    def __init__(self, source):
+        self.levels = [(np.array([source], dtype=np.int64), np.array([-1], dtype=np.int64))]
+
+    def depth(self, node):
+        """Distance of node from the source, or None if it was not reached."""
+        for depth in range(len(self.levels) - 1, -1, -1):  # a searched-for target is in the last level
+            nodes = self.levels[depth][0]
+            position = int(np.searchsorted(nodes, node))
+            if position < len(nodes) and nodes[position] == node:
+                return depth
+        return None
+
+    def path(self, node):
+        """Node indexes from the source to a reached node."""
+        path = [node]
+        for depth in range(self.depth(node), 0, -1):
+            nodes, parents = self.levels[depth]
+            path.append(int(parents[np.searchsorted(nodes, path[-1])]))
+        return path[::-1]
+
+    def reached(self):
+        """Return (nodes, distances) of the reached nodes, source excluded."""
+        if len(self.levels) == 1:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        lengths = [len(nodes) for nodes, _ in self.levels[1:]]
+        return (np.concatenate([nodes for nodes, _ in self.levels[1:]]),
+                np.repeat(np.arange(1, len(self.levels)), lengths))
+
+    def count(self):
+        return sum(len(nodes) for nodes, _ in self.levels[1:])
+
+
+class GraphIndex:
+    def __init__(self, nodes, out_csr, in_csr, build_ms=0.0):
+        self.nodes = nodes
+        self.csr = {'out': out_csr, 'in': in_csr}
+        self.base_size = len(nodes)
+        self.extra_ids = []  # agents created after the build, numbered from base_size on
+        self.extra_index = {}
+        # node -> frozenset of nodes; the sets are replaced, never changed, so snapshots can share them
+        self.added = {'out': {}, 'in': {}}
+        self.removed = {'out': {}, 'in': {}}  # only edges of the CSR arrays
+        self.delta_size = 0
+        self._keys = {}  # (overlay, direction) -> sorted node array, see _overlay_keys
+        self._shared = False  # the dicts above are shared with a snapshot, see _unshare
+        self.built_at = time.time()
+        self.build_ms = build_ms
+
+    # -- construction ------------------------------------------------------------
+
+    @classmethod
+    def build(cls):
+        """Load the index from the database (one consistent snapshot)."""
+        started = time.perf_counter()
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            nodes = np.fromiter(Agent.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+            edges = Relationship.objects.filter(agent_from__isnull=False, agent_to__isnull=False)
+            count = edges.count()
+            max_edges = getattr(settings, 'GRAPH_INDEX_MAX_EDGES', 200_000_000)
+            if count > max_edges:
+                raise GraphIndexTooLarge(f"{count} relationships exceed GRAPH_INDEX_MAX_EDGES ({max_edges})")
+            out_csr, late = cls._load_csr(edges, nodes, count, 'agent_from_id', 'agent_to_id')
+            in_csr, _ = cls._load_csr(edges, nodes, count, 'agent_to_id', 'agent_from_id')
+        index = cls(nodes, out_csr, in_csr, round((time.perf_counter() - started) * 1000, 2))
+        for agent_from, agent_to in late:
+            index.add_edge(agent_from, agent_to)
+        logger.info(f"Built relationship graph index: {len(nodes)} agents, {count} edges in {index.build_ms} ms")
+        return index
+
+    @staticmethod
+    def _load_csr(edges, nodes, count, key, other):
+        """
+        Fill one CSR from the edges ordered by (key, other). Returns ((indptr, indices), late)
+        where late lists the (agent_from, agent_to) pairs whose agents are not in nodes.
+        """
+        indices = np.empty(count, dtype=np.int32)
+        degrees = np.zeros(len(nodes) + 1, dtype=np.int64)
+        late = []
+        filled = 0
+        rows = edges.order_by(key, other).values_list(key, other).iterator(chunk_size=BUILD_CHUNK_SIZE)
+        while True:
+            chunk = np.array([row for _, row in zip(range(BUILD_CHUNK_SIZE), rows)], dtype=np.int64).reshape(-1, 2)
+            if not len(chunk):
+                break
+            positions = np.minimum(np.searchsorted(nodes, chunk), max(len(nodes) - 1, 0))
+            known = (nodes[positions] == chunk).all(axis=1) if len(nodes) else np.zeros(len(chunk), bool)
+            for pair in chunk[~known]:
+                late.append((int(pair[0]), int(pair[1])) if key == 'agent_from_id' else (int(pair[1]), int(pair[0])))
+            positions = positions[known]
+            indices[filled:filled + len(positions)] = positions[:, 1]
+            degrees[1:] += np.bincount(positions[:, 0], minlength=len(nodes))
+            filled += len(positions)
+        return (np.cumsum(degrees), indices[:filled]), late
+
+    # -- node numbering --------------------------------------------------------
+
+    @property
+    def size(self):
+        return self.base_size + len(self.extra_ids)
+
+    def node(self, agent_id, create=False):
+        """Return the node index of an agent, or None if the index does not know it."""
+        position = int(np.searchsorted(self.nodes, agent_id))
+        if position < self.base_size and self.nodes[position] == agent_id:
+            return position
+        index = self.extra_index.get(agent_id)
+        if index is None and create:
+            self._unshare()
+            index = self.extra_index[agent_id] = self.size
+            self.extra_ids.append(agent_id)
+        return index
+
+    def agent_ids(self, node_indexes):
+        """Map node indexes back to agent IDs."""
+        node_indexes = np.asarray(node_indexes, dtype=np.int64)
+        result = np.empty(len(node_indexes), dtype=np.int64)
+        base = node_indexes < self.base_size
+        result[base] = self.nodes[node_indexes[base]]
+        extra = np.asarray(self.extra_ids, dtype=np.int64)
+        result[~base] = extra[node_indexes[~base] - self.base_size]
+        return result.tolist()
+
+    # -- overlay ---------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        A copy sharing the CSR arrays and the overlay, unaffected by later changes to this index:
+        whichever of the two changes first copies the overlay dicts (see _unshare). O(1).
+        """
+        for overlay in ('added', 'removed'):
+            for direction in ('out', 'in'):
+                self._overlay_keys(overlay, direction)  # computed once, shared by the snapshot
+        self._shared = True
+        copy = object.__new__(GraphIndex)
+        copy.__dict__.update(self.__dict__)
+        return copy
+
+    def _unshare(self):
+        """Copy the overlay dicts before changing them if a snapshot may still share them."""
+        if self._shared:
+            self.extra_ids = list(self.extra_ids)
+            self.extra_index = dict(self.extra_index)
+            self.added = {direction: dict(nodes) for direction, nodes in self.added.items()}
+            self.removed = {direction: dict(nodes) for direction, nodes in self.removed.items()}
+            self._keys = dict(self._keys)
+            self._shared = False
+
+    def _overlay_keys(self, overlay, direction):
+        """Sorted array of the nodes with a non-empty overlay set (cached until the next change)."""
+        key = (overlay, direction)
+        if key not in self._keys:
+            nodes = getattr(self, overlay)[direction]
+            self._keys[key] = np.array(sorted(node for node, targets in nodes.items() if targets), dtype=np.int64)
+        return self._keys[key]
+
+    def _has_base_edge(self, direction, u, v):
+        if u >= self.base_size or v >= self.base_size:
+            return False
+        indptr, indices = self.csr[direction]
+        targets = indices[indptr[u]:indptr[u + 1]]  # sorted, see _load_csr
+        position = int(np.searchsorted(targets, v))
+        return position < len(targets) and targets[position] == v
+
+    def add_edge(self, agent_from, agent_to):
+        self._unshare()
+        u, v = self.node(agent_from, create=True), self.node(agent_to, create=True)
+        for direction, a, b in (('out', u, v), ('in', v, u)):
+            removed = self.removed[direction].get(a, frozenset())
+            if b in removed:
+                self.removed[direction][a] = removed - {b}
+            elif not self._has_base_edge(direction, a, b):
+                self.added[direction][a] = self.added[direction].get(a, frozenset()) | {b}
+        self.delta_size += 1
+        self._keys = {}
+
+    def remove_edge(self, agent_from, agent_to):
+        """Remove a pair (called once no relationship with it is left)."""
+        u, v = self.node(agent_from), self.node(agent_to)
+        if u is None or v is None:
+            return
+        self._unshare()
+        for direction, a, b in (('out', u, v), ('in', v, u)):
+            added = self.added[direction].get(a, frozenset())
+            if b in added:
+                self.added[direction][a] = added - {b}
+            if self._has_base_edge(direction, a, b):
+                self.removed[direction][a] = self.removed[direction].get(a, frozenset()) | {b}
+        self.delta_size += 1
+        self._keys = {}
+
+    # -- traversal ---------------------------------------------------------------
+
+    def expand(self, frontier, direction):
+        """
+        Return (targets, sources) of all edges leaving the frontier nodes in the direction(s).
+        The work is proportional to the frontier and its edges (plus the overlay), not the graph.
+        """
+        targets, sources = [], []
+        for d in (('out', 'in') if direction == 'both' else (direction,)):
+            indptr, indices = self.csr[d]
+            base = frontier[frontier < self.base_size]
+            dirty_nodes = self._overlay_keys('removed', d)
+            if len(dirty_nodes):
+                dirty = np.isin(base, dirty_nodes)
+                for node in base[dirty]:
+                    row = indices[indptr[node]:indptr[node + 1]].astype(np.int64)
+                    row = row[~np.isin(row, list(self.removed[d][node]))]
+                    targets.append(row)
+                    sources.append(np.full(len(row), node, dtype=np.int64))
+                base = base[~dirty]
+            t, s = _gather(indptr, indices, base)
+            targets.append(t)
+            sources.append(s)
+            added_nodes = self._overlay_keys('added', d)
+            if len(added_nodes):
+                for node in added_nodes[np.isin(added_nodes, frontier)]:
+                    nodes = self.added[d][node]
+                    targets.append(np.fromiter(nodes, dtype=np.int64, count=len(nodes)))
+                    sources.append(np.full(len(nodes), node, dtype=np.int64))
+        return np.concatenate(targets), np.concatenate(sources)
+
+    def _advance(self, traversal, visited, targets, sources):
+        """Append the unseen targets as the next level of the traversal and return them."""
+        new = visited.unseen(targets)
+        frontier, first = np.unique(targets[new], return_index=True)
+        if len(frontier):
+            visited.add(frontier)
+            traversal.levels.append((frontier, sources[new][first]))
+        return frontier
+
+    def bfs(self, source, direction='out', max_depth=None, target=None):
+        """Breadth-first search; returns a Traversal, stopping early once target is reached."""
+        traversal = Traversal(source)
+        visited = _Visited(self.size, source)
+        frontier = traversal.levels[0][0]
+        while len(frontier) and (max_depth is None or len(traversal.levels) - 1 < max_depth):
+            frontier = self._advance(traversal, visited, *self.expand(frontier, direction))
+            if target is not None and target in visited:
+                break
+        return traversal
+
+    def neighbourhood(self, source, hops, direction='out'):
+        """Return (nodes, distances) of the nodes within hops of source (source excluded)."""
+        return self.bfs(source, direction, max_depth=hops).reached()
+
+    def shortest_path(self, source, target, direction='out'):
+        """Return the node indexes of a shortest path, or None."""
+        if source == target:
+            return [source]
+        traversal = self.bfs(source, direction, target=target)
+        return traversal.path(target) if traversal.depth(target) is not None else None
+
+    def shortest_cycle(self, source):
+        """Return a shortest directed cycle through source (first node repeated at the end), or None."""
+        traversal = Traversal(source)
+        visited = _Visited(self.size, source)
+        frontier = traversal.levels[0][0]
+        while len(frontier):
+            targets, sources = self.expand(frontier, 'out')
+            closing = sources[targets == source]
+            if len(closing):
+                return traversal.path(int(closing[0])) + [source]
+            frontier = self._advance(traversal, visited, targets, sources)
+        return None
+
+    def _indegree(self):
+        """Incoming edges per node, counted like expand() yields them."""
+        indptr, indices = self.csr['in']
+        indegree = np.zeros(self.size, dtype=np.int64)
+        indegree[:self.base_size] = np.diff(indptr)
+        for node, nodes in self.added['in'].items():
+            indegree[node] += len(nodes)
+        for node, nodes in self.removed['in'].items():
+            indegree[node] -= int(np.isin(indices[indptr[node]:indptr[node + 1]], list(nodes)).sum())
+        return indegree
+
+    def cyclic_nodes(self):
+        """
+        Kahn's algorithm over the whole graph: returns a boolean mask of the nodes left after
+        repeatedly removing nodes without incoming edges, i.e. nodes on or downstream of a cycle.
+        Each round only touches the edges of its frontier, so the total work is O(N + E).
+        """
+        indegree = self._indegree()
+        remaining = np.ones(self.size, dtype=bool)
+        frontier = np.flatnonzero(indegree == 0)
+        while len(frontier):
+            remaining[frontier] = False
+            targets, _ = self.expand(frontier, 'out')
+            np.subtract.at(indegree, targets, 1)
+            frontier = targets[indegree[targets] == 0]
+            if len(frontier) > 1:
+                frontier = np.unique(frontier)
+        return remaining
+
+    def find_cycle(self, remaining):
+        """Walk incoming edges inside the remaining nodes of cyclic_nodes until a node repeats."""
+        node = int(np.flatnonzero(remaining)[0])
+        seen = {}
+        walk = []
+        while node not in seen:
+            seen[node] = len(walk)
+            walk.append(node)
+            predecessors, _ = self.expand(np.array([node], dtype=np.int64), 'in')
+            node = int(predecessors[remaining[predecessors]][0])
+        cycle = walk[seen[node]:][::-1]
+        return cycle + [cycle[0]]
+
+    def stats(self):
+        arrays = [self.nodes, *self.csr['out'], *self.csr['in']]
+        return {
+            'agents': self.size,
+            'edges': int(len(self.csr['out'][1])),
+            'delta': self.delta_size,
+            'memory_bytes': int(sum(array.nbytes for array in arrays)),
+            'build_ms': self.build_ms,
+            'built_at': self.built_at,
+        }
+
+
+# -- the process' index ----------------------------------------------------------
+
+_lock = RLock()        # guards _state and the overlay of the current index
+_build_lock = RLock()  # one build at a time, without blocking the change listener meanwhile
+_state = {'index': None, 'stale': True, 'building': False, 'pending': []}
+
+
+def get_graph_index():
+    """Return this process' graph index, (re)building it if it is missing or stale."""
+    ensure_listener()
+    with _build_lock:
+        with _lock:
+            if _state['index'] is not None and not _state['stale']:
+                return _state['index']
+            _state.update(building=True, pending=[])
+        try:
+            index = GraphIndex.build()
+        finally:
+            with _lock:
+                _state['building'] = False
+        with _lock:
+            # Changes that arrived during the build may or may not be in the snapshot; add_edge and
+            # remove_edge give the same result either way. A reset means the build may be outdated.
+            stale = False
+            for op, agent_from, agent_to in _state['pending']:
+                if op == 'reset':
+                    stale = True
+                else:
+                    (index.add_edge if op == 'add' else index.remove_edge)(agent_from, agent_to)
+            _state.update(index=index, stale=stale, pending=[])
+        return index
+
+
+def graph_snapshot():
+    """
+    Return a snapshot of this process' graph index for one query. Changes arriving meanwhile go
+    to the live index; _lock is only held while the snapshot is taken.
+    """
+    index = get_graph_index()
+    with _lock:
+        return index.snapshot()
+
+
+def _apply_change(op, agent_from=None, agent_to=None):
+    _apply_changes(op, [(agent_from, agent_to)])
+
+
+def _apply_changes(op, pairs):
+    with _lock:
+        if _state['building']:
+            _state['pending'].extend((op, agent_from, agent_to) for agent_from, agent_to in pairs)
+        index = _state['index']
+        if op == 'reset':
+            _state['stale'] = True
+        elif index is not None and not _state['stale']:
+            if index.delta_size + len(pairs) > getattr(settings, 'GRAPH_INDEX_MAX_DELTA', 100000):
+                _state['stale'] = True  # compact into a fresh build on the next query
+                return
+            for agent_from, agent_to in pairs:
+                (index.add_edge if op == 'add' else index.remove_edge)(agent_from, agent_to)
+
+
+def edge_changed(op, agent_from=None, agent_to=None):
+    """
+    Record an edge change ('add', 'remove' or 'reset' for anything else) here and in the
+    other processes, once the current transaction commits.
+    """
+    def apply():
+        _apply_change(op, agent_from, agent_to)
+        broadcast(BROADCAST_KIND, {'op': op, 'agent_from': agent_from, 'agent_to': agent_to})
+    transaction.on_commit(apply)
+
+
+def edges_added(pairs):
+    """
+    Record many added pairs (bulk inserts) here and in the other processes with one broadcast,
+    once the current transaction commits.
+    """
+    pairs = [[agent_from, agent_to] for agent_from, agent_to in pairs]
+    if not pairs:
+        return
+
+    def apply():
+        _apply_changes('add', pairs)
+        broadcast(BROADCAST_KIND, {'op': 'add_many', 'pairs': pairs})
+    transaction.on_commit(apply)
+
+
+def _on_broadcast(message):
+    if message is None:  # the listener reconnected, changes may have been missed
+        _apply_change('reset')
+    elif message.get('op') == 'add_many':
+        _apply_changes('add', message.get('pairs') or [])
+    elif message.get('op') in ('add', 'remove', 'reset'):
+        _apply_change(message['op'], message.get('agent_from'), message.get('agent_to'))
+
+
+register_broadcast_handler(BROADCAST_KIND, _on_broadcast)
@@ -0,0 +1,51 @@
+"""
+This module provides a static interval tree used for overlap queries where the database has no
+range index (SQLite test runs and development databases).
+
+Intervals are half-open [start, end). The tree is an implicit balanced binary search tree over
+the intervals sorted by start, where each node also stores the largest end in its subtree, so
+an overlap query visits O(log n + k) nodes for k results.
+"""
+
+
+class IntervalTree:
+    def __init__(self, intervals):
+        """intervals: iterable of (start, end, payload)."""
+        self._items = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self._max_end = [None] * len(self._items)
+        self._build(0, len(self._items))
+
+    def _build(self, lo, hi):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        max_end = self._items[mid][1]
+        for child in (self._build(lo, mid), self._build(mid + 1, hi)):
+            if child is not None and child > max_end:
+                max_end = child
+        self._max_end[mid] = max_end
+        return max_end
+
+    def __len__(self):
+        return len(self._items)
+
+    def overlapping(self, start, end):
+        """Return the payloads of all intervals overlapping [start, end), ordered by start."""
+        result = []
+        stack = [(0, len(self._items))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self._max_end[mid] <= start:
+                continue  # nothing in this subtree ends after the query starts
+            item_start, item_end, payload = self._items[mid]
+            # Right subtree starts at or after item_start; skip it if that is past the query
+            if item_start < end:
+                stack.append((mid + 1, hi))
+                if item_end > start:
+                    result.append((item_start, payload))
+            stack.append((lo, mid))
+        result.sort(key=lambda item: item[0])
+        return [payload for _, payload in result]
@@ -0,0 +1,89 @@
+"""
+Benchmarks the agent conflict check of ContextSerializer.validate.
+
+Creates synthetic agents and contexts inside a transaction that is rolled back afterwards, then
+compares the former per-agent loop (one EXISTS query per agent) with the set-based
+find_agent_conflicts (one query for all agents), reporting time and number of queries.
+"""
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from api.caching import bump_version
+from api.models import Agent, Context, DEFAULT_CONTEXT_DURATION
+from api.scheduling import find_agent_conflicts
+
+
+class Rollback(Exception):
+    pass
+
+
+def loop_conflicts(agents, scheduled):
+    """The previous implementation: one query per agent, stopping at the first conflict."""
+    for agent in agents:
+        if Context.objects.filter(
+            agents=agent,
+            scheduled__lt=scheduled + DEFAULT_CONTEXT_DURATION,
+            scheduled__gt=scheduled - DEFAULT_CONTEXT_DURATION
+        ).exists():
+            return [agent]
+    return []
+
+
+class Command(BaseCommand):
+    help = "Compare the per-agent and set-based context conflict checks on synthetic data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agents', type=int, default=200, help="Agents in the new context")
+        parser.add_argument('--contexts', type=int, default=1000, help="Existing contexts")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per implementation")
+
+    def _measure(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(queries)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def _run(self, options):
+        now = timezone.now()
+        agents = Agent.objects.bulk_create(
+            Agent(name=f"Benchmark Agent {i}") for i in range(options['agents']))
+        contexts = Context.objects.bulk_create(
+            Context(name=f"Benchmark Context {i}", scheduled=now + timedelta(hours=i),
+                    ends_at=now + timedelta(hours=i) + DEFAULT_CONTEXT_DURATION)
+            for i in range(options['contexts']))
+        # Every agent is busy in one context; only the last one clashes, so the loop runs to the end
+        Through = Context.agents.through
+        Through.objects.bulk_create(
+            Through(context_id=contexts[(i * 7) % len(contexts)].pk, agent_id=agent.pk)
+            for i, agent in enumerate(agents))
+        bump_version(Context)  # bulk_create sends no signals
+        clash = Context.objects.get(pk=Through.objects.get(agent_id=agents[-1].pk).context_id)
+        scheduled = clash.scheduled + timedelta(minutes=30)
+        ends_at = scheduled + DEFAULT_CONTEXT_DURATION
+
+        loop_time, loop_queries = self._measure(lambda: loop_conflicts(agents, scheduled), options['repeat'])
+        agent_ids = [agent.pk for agent in agents]
+        set_time, set_queries = self._measure(lambda: find_agent_conflicts(agent_ids, scheduled, ends_at), options['repeat'])
+        found = len(find_agent_conflicts(agent_ids, scheduled, ends_at))
+
+        self.stdout.write(f"{options['agents']} agents, {options['contexts']} contexts ({connection.vendor})")
+        self.stdout.write(f"{'Implementation':<16} {'Queries':>8} {'Best ms':>10}")
+        self.stdout.write(f"{'per-agent loop':<16} {loop_queries:>8} {loop_time * 1000:>10.2f}")
+        self.stdout.write(f"{'set-based':<16} {set_queries:>8} {set_time * 1000:>10.2f}")
+        self.stdout.write(self.style.SUCCESS(f"Set-based check found {found} conflicting assignment(s)"))
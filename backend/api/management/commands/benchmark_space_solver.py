@@ -0,0 +1,67 @@
+"""
+Benchmarks the space assignment solver on synthetic schedules.
+
+Generates random contexts and spaces in memory (no database needed), then runs the greedy pass
+alone and greedy plus local search for each time budget, reporting how many contexts were placed,
+the wasted capacity and the time taken.
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+from django.core.management.base import BaseCommand
+from api.space_solver import SpaceSolver
+
+
+def synthetic_schedule(contexts, spaces, days, seed):
+    """Return (contexts, capacities, bookings) with random sizes, starts and durations."""
+    rng = random.Random(seed)
+    origin = datetime(2025, 1, 6, 8, tzinfo=timezone.utc)
+    capacities = {space_id: rng.choice((2, 4, 6, 8, 12, 20)) for space_id in range(1, spaces + 1)}
+    largest = max(capacities.values())
+
+    def interval():
+        start = origin + timedelta(days=rng.randrange(days), minutes=15 * rng.randrange(40))
+        return start, start + timedelta(minutes=rng.choice((30, 45, 60, 90, 120, 180)))
+
+    proposed = [
+        (context_id, *interval(), rng.randint(1, min(largest, 10)))
+        for context_id in range(1, contexts + 1)
+    ]
+    # Roughly a tenth of the space time is already booked
+    bookings = {}
+    for space_id in capacities:
+        bookings[space_id] = [interval() for _ in range(max(1, days // 2))]
+    return proposed, capacities, bookings
+
+
+class Command(BaseCommand):
+    help = "Benchmark the space assignment solver on synthetic schedules"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--contexts', type=int, default=5000, help="Contexts to assign")
+        parser.add_argument('--spaces', type=int, default=300, help="Available spaces")
+        parser.add_argument('--days', type=int, default=5, help="Length of the schedule in days")
+        parser.add_argument('--budgets', type=float, nargs='+', default=[0.5, 2.0], help="Time budgets in seconds")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        contexts, capacities, bookings = synthetic_schedule(
+            options['contexts'], options['spaces'], options['days'], options['seed'])
+        self.stdout.write(
+            f"{len(contexts)} contexts, {len(capacities)} spaces over {options['days']} days (seed {options['seed']})")
+        self.stdout.write(f"{'Run':<20} {'Assigned':>9} {'Unassigned':>11} {'Wasted':>8} {'Moves':>6} {'ms':>9}")
+
+        runs = [("greedy only", SpaceSolver(contexts, capacities, bookings, float('inf'), local_search=False))]
+        runs += [
+            (f"local search {budget:g}s", SpaceSolver(contexts, capacities, bookings, budget))
+            for budget in options['budgets']
+        ]
+        for label, solver in runs:
+            solver.solve()
+            stats = solver.stats
+            moves = stats['relocations'] + stats['downsized']
+            self.stdout.write(
+                f"{label:<20} {stats['assigned']:>9} {stats['unassigned']:>11} {stats['wasted_capacity']:>8} "
+                f"{moves:>6} {stats['elapsed_ms']:>9.1f}")
+            if stats['timed_out']:
+                self.stdout.write(self.style.WARNING("  time budget ran out"))
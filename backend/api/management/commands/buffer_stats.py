@@ -0,0 +1,32 @@
+"""
+Prints the state of the comm nodes' outbound buffer per priority lane.
+"""
+
+import json
+from django.core.management.base import BaseCommand
+from mqtt_backend.core.buffer import lane_stats, eviction_stats
+from mqtt_backend.sharding import get_redis
+
+
+class Command(BaseCommand):
+    help = "Show depth and counters of the outbound buffer per priority lane, and dead-letter evictions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help="Output as JSON")
+
+    def handle(self, *args, **options):
+        redis_client = get_redis()
+        stats = lane_stats(redis_client)
+        evictions = eviction_stats(redis_client)
+        if options['json']:
+            self.stdout.write(json.dumps({'lanes': stats, **evictions}))
+            return
+        self.stdout.write(f"{'Lane':<10} {'Depth':>10} {'Enqueued':>10} {'Drained':>10} {'Failed':>10}")
+        self.stdout.write("-" * 54)
+        for lane, counters in stats.items():
+            self.stdout.write(
+                f"{lane:<10} {counters.get('depth', 0):>10} {counters.get('enqueued', 0):>10} "
+                f"{counters.get('drained', 0):>10} {counters.get('failed', 0):>10}")
+        self.stdout.write("")
+        self.stdout.write(f"Buffered: {evictions['buffered']}")
+        self.stdout.write(f"Dead-lettered: {evictions['evictions']}")
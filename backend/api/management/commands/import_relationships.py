@@ -0,0 +1,53 @@
+"""
+Imports relationships from a CSV or NDJSON file (or stdin) in constant memory.
+
+Rows are validated and loaded in batches (COPY on PostgreSQL, see api.relationship_import);
+progress is printed after every batch. Rerunning an interrupted import is safe since pairs
+that already exist are skipped.
+"""
+
+import io
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from api.relationship_import import FORMATS, detect_format, import_relationships
+
+
+class Command(BaseCommand):
+    help = "Import relationships from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, - for stdin")
+        parser.add_argument('--format', choices=FORMATS, help="Input format (default: from the file extension)")
+        parser.add_argument('--batch-size', type=int, help="Rows per batch (default: RELATIONSHIP_IMPORT_BATCH_SIZE)")
+
+    def _progress(self, stats):
+        rate = stats['read'] / (stats['elapsed_ms'] / 1000) if stats['elapsed_ms'] else 0
+        self.stdout.write(
+            f"batch {stats['batches']}: {stats['read']} read, {stats['inserted']} inserted, "
+            f"{stats['duplicates']} duplicates, {stats['invalid']} invalid ({rate:.0f} rows/s)")
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        if fmt is None:
+            raise CommandError("Cannot tell the format from the file name, pass --format")
+
+        if options['path'] == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        else:
+            try:
+                stream = open(options['path'], encoding='utf-8', newline='')
+            except OSError as e:
+                raise CommandError(str(e))
+        try:
+            with stream:
+                stats, errors = import_relationships(stream, fmt, options['batch_size'], self._progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for error in errors:
+            self.stdout.write(self.style.WARNING(f"line {error['line']}: {error['error']}"))
+        if stats['invalid'] > len(errors):
+            self.stdout.write(self.style.WARNING(f"... and {stats['invalid'] - len(errors)} more invalid rows"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['inserted']} relationships from {stats['read']} rows in {stats['elapsed_ms'] / 1000:.1f}s "
+            f"({stats['duplicates']} duplicates, {stats['invalid']} invalid)"))
@@ -0,0 +1,65 @@
+"""
+Re-injects dead-lettered comm messages into the outbound buffer at a controlled rate.
+
+The owning nodes pick the messages up on their next retry cycle, so replaying does not need
+to know where (on which comm shard) the source agent's node runs.
+"""
+
+import time
+from django.core.management.base import BaseCommand
+from mqtt_backend.core.buffer import (
+    get_buffer, DEAD_LETTER_KEY, pop_dead_letter, requeue_dead_letter, eviction_stats
+)
+from mqtt_backend.sharding import get_redis
+
+
+class Command(BaseCommand):
+    help = "Replay dead-lettered messages back into the outbound buffer at a limited rate"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', action='append', help="Source agent ID (repeatable, default: all)")
+        parser.add_argument('--reason', action='append',
+                            help="Only replay letters with this reason (expired, overflow_destination, overflow_global)")
+        parser.add_argument('--rate', type=float, default=50.0, help="Messages per second")
+        parser.add_argument('--limit', type=int, default=None, help="Maximum number of messages to replay")
+        parser.add_argument('--dry-run', action='store_true', help="Only show what would be replayed")
+
+    def handle(self, *args, **options):
+        redis_client = get_redis()
+        sources = options['source'] or [
+            key.decode().split(":", 1)[1] for key in redis_client.scan_iter(DEAD_LETTER_KEY.format(source="*"))
+        ]
+        reasons = set(options['reason'] or [])
+        interval = 1.0 / options['rate'] if options['rate'] > 0 else 0
+        limit = options['limit']
+
+        if options['dry_run']:
+            for source in sources:
+                count = redis_client.llen(DEAD_LETTER_KEY.format(source=source))
+                self.stdout.write(f"Source {source}: {count} dead letters")
+            self.stdout.write(str(eviction_stats(redis_client)))
+            return
+
+        replayed = skipped = 0
+        for source in sources:
+            buffer = get_buffer(redis_client, source)
+            # Letters with other reasons are rotated back so one pass sees each letter once
+            for _ in range(redis_client.llen(DEAD_LETTER_KEY.format(source=source))):
+                if limit is not None and replayed >= limit:
+                    break
+                letter = pop_dead_letter(redis_client, source)
+                if letter is None:
+                    break
+                if reasons and letter['reason'] not in reasons:
+                    requeue_dead_letter(redis_client, source, letter)
+                    skipped += 1
+                    continue
+                envelope = dict(letter['envelope'])
+                envelope.pop('expires_at', None)  # gets a fresh TTL
+                buffer.push(letter['destination'], envelope)
+                replayed += 1
+                if replayed % 100 == 0:
+                    self.stdout.write(f"Replayed {replayed} messages")
+                time.sleep(interval)
+
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} dead letters ({skipped} skipped)"))
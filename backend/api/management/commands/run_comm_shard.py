@@ -0,0 +1,38 @@
+"""
+Runs a dedicated communication shard process.
+
+Start one or more of these (on one or several machines) with COMM_SHARDING=True.
+Each process joins the shard ring, owns the MQTT nodes of its share of the agents
+and executes commands sent to it by the web workers.
+"""
+
+import signal
+import time
+from django.core.management.base import BaseCommand
+from api.apps import active_agent_ids
+from mqtt_backend.comm_node_manager import CommNodeManager
+
+
+class Command(BaseCommand):
+    help = "Run a communication shard that owns a consistent-hash share of the agents' MQTT nodes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard-id', default=None, help="Shard ID (defaults to <hostname>-<pid>)")
+
+    def handle(self, *args, **options):
+        shard = CommNodeManager.start_shard(active_agent_ids, shard_id=options['shard_id'])
+        self.stdout.write(self.style.SUCCESS(f"Comm shard {shard.shard_id} running"))
+
+        running = True
+
+        def stop(signum, frame):
+            nonlocal running
+            running = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while running:
+            time.sleep(1)
+
+        CommNodeManager.stop_shard()
+        self.stdout.write(f"Comm shard {shard.shard_id} stopped")
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_relationship_created_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='relationship',
+            name='agent_from',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='relationships_from', to='api.agent'),
+        ),
+        migrations.AlterField(
+            model_name='relationship',
+            name='agent_to',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='relationships_to', to='api.agent'),
+        ),
+        migrations.AddIndex(
+            model_name='agent',
+            index=models.Index(fields=['created_at', 'id'], name='agent_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='context',
+            index=models.Index(fields=['scheduled', 'id'], name='context_scheduled_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='relationship',
+            index=models.Index(fields=['created_at', 'id'], name='relationship_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='space',
+            index=models.Index(fields=['created_at', 'id'], name='space_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,88 @@
+import logging
+from datetime import timedelta
+from django.db import migrations, models
+
+logger = logging.getLogger('omnisyslogger')
+
+SPAN = "tstzrange(scheduled, ends_at, '[)')"
+
+
+def backfill_ends_at(apps, schema_editor):
+    Context = apps.get_model('api', 'Context')
+    Context.objects.filter(ends_at__isnull=True).update(ends_at=models.F('scheduled') + timedelta(hours=1))
+
+
+def resolve_backfilled_overlaps(apps, schema_editor):
+    """
+    Before 0004 only identical start times were rejected, so contexts in the same space may start
+    less than an hour apart and overlap once they end one hour after their start. Such a context
+    is shortened to end where the next one in its space starts; of contexts starting at the same
+    time only the first (lowest id) is kept active and the others are archived. Without this
+    the exclusion constraint below cannot be added.
+    """
+    Context = apps.get_model('api', 'Context')
+    rows = (Context.objects.filter(is_archived=False, space__isnull=False)
+            .order_by('space_id', 'scheduled', 'id').values_list('id', 'space_id', 'scheduled', 'ends_at'))
+    shortened, archived = {}, []
+    previous = None  # [id, space_id, scheduled, ends_at] of the last active context
+    for pk, space_id, scheduled, ends_at in rows.iterator(chunk_size=2000):
+        if previous is not None and previous[1] == space_id:
+            if scheduled == previous[2]:
+                archived.append(pk)
+                continue
+            if previous[3] > scheduled:
+                previous[3] = shortened[previous[0]] = scheduled
+        previous = [pk, space_id, scheduled, ends_at]
+    for pk, ends_at in shortened.items():
+        Context.objects.filter(pk=pk).update(ends_at=ends_at)
+    Context.objects.filter(pk__in=archived).update(is_archived=True)
+    if shortened or archived:
+        logger.warning(
+            f"Resolved overlapping contexts: shortened {sorted(shortened)}, archived {archived}")
+
+
+def add_range_index(apps, schema_editor):
+    """PostgreSQL only: range index for overlap queries and the space exclusion constraint."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    schema_editor.execute(f"CREATE INDEX context_span_gist ON api_context USING gist ({SPAN})")
+    schema_editor.execute(
+        "ALTER TABLE api_context ADD CONSTRAINT context_space_no_overlap "
+        f"EXCLUDE USING gist (space_id WITH =, {SPAN} WITH &&) "
+        "WHERE (NOT is_archived AND space_id IS NOT NULL)"
+    )
+
+
+def remove_range_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("ALTER TABLE api_context DROP CONSTRAINT IF EXISTS context_space_no_overlap")
+    schema_editor.execute("DROP INDEX IF EXISTS context_span_gist")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='context',
+            name='ends_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_ends_at, migrations.RunPython.noop),
+        migrations.RunPython(resolve_backfilled_overlaps, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='context',
+            name='ends_at',
+            field=models.DateTimeField(blank=True),
+        ),
+        migrations.AddConstraint(
+            model_name='context',
+            constraint=models.CheckConstraint(condition=models.Q(('ends_at__gt', models.F('scheduled'))), name='context_ends_after_start'),
+        ),
+        migrations.RunPython(add_range_index, remove_range_index),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SPAN = "tstzrange(scheduled, ends_at, '[)')"
+
+
+def _replace_space_constraint(schema_editor, predicate):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("ALTER TABLE api_context DROP CONSTRAINT IF EXISTS context_space_no_overlap")
+    schema_editor.execute(
+        "ALTER TABLE api_context ADD CONSTRAINT context_space_no_overlap "
+        f"EXCLUDE USING gist (space_id WITH =, {SPAN} WITH &&) WHERE ({predicate})"
+    )
+
+
+def exclude_series_from_constraint(apps, schema_editor):
+    """A series row only holds its first occurrence, which an exception may move; check single contexts only."""
+    _replace_space_constraint(schema_editor, "NOT is_archived AND space_id IS NOT NULL AND recurrence_rule = ''")
+
+
+def include_series_in_constraint(apps, schema_editor):
+    _replace_space_constraint(schema_editor, "NOT is_archived AND space_id IS NOT NULL")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_context_ends_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='context',
+            name='original_start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='context',
+            name='recurrence_end',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='context',
+            name='recurrence_parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='api.context'),
+        ),
+        migrations.AddField(
+            model_name='context',
+            name='recurrence_rule',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddConstraint(
+            model_name='context',
+            constraint=models.UniqueConstraint(fields=('recurrence_parent', 'original_start'), name='context_unique_exception'),
+        ),
+        migrations.RunPython(exclude_series_from_constraint, include_series_in_constraint),
+    ]
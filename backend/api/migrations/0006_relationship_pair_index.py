@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_context_recurrence'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='relationship',
+            index=models.Index(fields=['agent_from', 'agent_to'], name='relationship_pair_idx'),
+        ),
+    ]
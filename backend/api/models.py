@@ -2,7 +2,12 @@
 This module defines the data models for the OMNI-SYS backend API.
 """
 
+from datetime import timedelta
 from django.db import models
+from .recurrence import parse_rule
+
+# Duration of contexts created without an explicit end
+DEFAULT_CONTEXT_DURATION = timedelta(hours=1)
 
 class OMNISysObject(models.Model):
     """
@@ -17,16 +22,48 @@ class OMNISysObject(models.Model):
         abstract = True # Prevents Django from creating a DB table for this model
 
 class Agent(OMNISysObject):
-    pass
+    class Meta:
+        # Keyset pagination order (see api.pagination.KeysetPagination)
+        indexes = [models.Index(fields=['created_at', 'id'], name='agent_created_id_idx')]
 
 class Space(OMNISysObject):
     capacity = models.PositiveIntegerField()
 
+    class Meta:
+        indexes = [models.Index(fields=['created_at', 'id'], name='space_created_id_idx')]
+
 class Context(OMNISysObject):
     scheduled = models.DateTimeField()
+    ends_at = models.DateTimeField(blank=True)  # defaults to scheduled + DEFAULT_CONTEXT_DURATION
     space = models.ForeignKey(Space, on_delete=models.SET_NULL, null=True)
     agents = models.ManyToManyField(Agent, related_name='contexts')
 
+    # Recurring contexts (see api.recurrence): a series stores its rule once and scheduled/ends_at
+    # of its first occurrence; recurrence_end is the end of its last occurrence (null if open-ended)
+    recurrence_rule = models.CharField(max_length=200, blank=True, default='')
+    recurrence_end = models.DateTimeField(null=True, blank=True)
+    # An edited or cancelled (archived) occurrence of a series, replacing the one at original_start
+    recurrence_parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True,
+                                          related_name='exceptions')
+    original_start = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['scheduled', 'id'], name='context_scheduled_id_idx')]
+        constraints = [
+            models.CheckConstraint(condition=models.Q(ends_at__gt=models.F('scheduled')), name='context_ends_after_start'),
+            models.UniqueConstraint(fields=['recurrence_parent', 'original_start'], name='context_unique_exception'),
+        ]
+        # On PostgreSQL, migration 0004 adds a GiST index on tstzrange(scheduled, ends_at) and an
+        # exclusion constraint against overlapping non-archived contexts in the same space
+        # (single contexts only since 0005, series are expanded by api.scheduling).
+
+    def save(self, *args, **kwargs):
+        if self.ends_at is None and self.scheduled is not None:
+            self.ends_at = self.scheduled + DEFAULT_CONTEXT_DURATION
+        rule = parse_rule(self.recurrence_rule)
+        self.recurrence_end = rule.last_end(self.scheduled, self.ends_at - self.scheduled) if rule else None
+        super().save(*args, **kwargs)
+
 class Relationship(models.Model):
     agent_from = models.ForeignKey(
         Agent, on_delete=models.CASCADE, null=True, related_name='relationships_from'
@@ -35,4 +72,11 @@ class Relationship(models.Model):
         Agent, on_delete=models.CASCADE, null=True, related_name='relationships_to'
     )
     description = models.CharField(max_length=100, null=True)
-    created_at = models.DateTimeField(auto_now_add=True) 
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='relationship_created_id_idx'),
+            # duplicate checks of creates, bulk endpoints and imports look pairs up
+            models.Index(fields=['agent_from', 'agent_to'], name='relationship_pair_idx'),
+        ]
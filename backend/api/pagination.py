@@ -1,6 +1,203 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from datetime import datetime
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination over a unique ordering such as ('-created_at', '-id').
+
+    Pages are fetched with `WHERE (created_at, id) < (last values)` instead of OFFSET, and no
+    COUNT(*) is run, so page N costs the same as page 1 when the ordering is backed by an index.
+    Cursors are opaque base64 tokens of the boundary row's values and the direction.
+    The ordering comes from the view's `keyset_ordering` and ignores the `ordering` parameter.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    default_ordering = ('-created_at', '-id')
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(values, reverse):
+        data = {'v': [v.isoformat() if isinstance(v, datetime) else v for v in values], 'r': reverse}
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    def decode_cursor(self, token):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode()))
+            values = [parse_datetime(v) if isinstance(v, str) else v for v in data['v']]
+            if len(values) != len(self.ordering) or any(v is None for v in values):
+                raise ValueError
+            return values, bool(data.get('r'))
+        except (ValueError, TypeError, KeyError):
+            raise NotFound("Invalid cursor")
+
+    def _after(self, values, reverse):
+        """Q for rows strictly after the boundary row in the (possibly reversed) ordering."""
+        condition = Q()
+        for i in reversed(range(len(self.ordering))):
+            field = self.ordering[i].lstrip('-')
+            descending = self.ordering[i].startswith('-') != reverse
+            step = Q(**{f"{field}__{'lt' if descending else 'gt'}": values[i]})
+            equal = Q(**{self.ordering[j].lstrip('-'): values[j] for j in range(i)})
+            condition = (equal & step) | condition if i else step | condition
+        # Redundant bound on the leading column lets the database range-scan the composite index
+        field = self.ordering[0].lstrip('-')
+        descending = self.ordering[0].startswith('-') != reverse
+        return Q(**{f"{field}__{'lte' if descending else 'gte'}": values[0]}) & condition
+
+    @staticmethod
+    def _flip(ordering):
+        return [f[1:] if f.startswith('-') else f'-{f}' for f in ordering]
+
+    def _values(self, obj):
+        return [getattr(obj, f.lstrip('-')) for f in self.ordering]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = tuple(getattr(view, 'keyset_ordering', self.default_ordering))
+        self.page_size = self.get_page_size(request)
+
+        token = request.query_params.get(self.cursor_query_param)
+        reverse = False
+        if token:
+            values, reverse = self.decode_cursor(token)
+            queryset = queryset.filter(self._after(values, reverse))
+        ordering = self._flip(self.ordering) if reverse else list(self.ordering)
+
+        # One extra row tells whether there is another page in this direction
+        rows = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        self.next_values = self._values(rows[-1]) if rows and (has_more or reverse) else None
+        self.previous_values = self._values(rows[0]) if rows and token and (has_more or not reverse) else None
+        return rows
+
+    def _link(self, values, reverse):
+        if values is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(values, reverse))
+
+    def get_next_link(self):
+        return self._link(self.next_values, False)
+
+    def get_previous_link(self):
+        if self.previous_values is None:
+            return None
+        return self._link(self.previous_values, True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
 
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 20  # Default number of items per page
     page_size_query_param = 'page_size'  # Allow client to override the page size
-    max_page_size = 100  # Maximum limit for page_size
\ No newline at end of file
+    max_page_size = 100  # Maximum limit for page_size
+
+    # Passing ?cursor= (empty for the first page) switches a request to keyset pagination
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+def estimate_count(queryset):
+    """
+    Return the Postgres planner's row estimate for a queryset, or None where no estimate is
+    available (other databases, never analyzed tables). Unfiltered querysets use pg_class.reltuples,
+    filtered ones the top-level row estimate of EXPLAIN.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ApproximateCountPaginator(Paginator):
+    """Paginator whose count is the planner estimate once that exceeds the threshold."""
+    approximate = False
+
+    @cached_property
+    def count(self):
+        threshold = getattr(settings, 'API_APPROXIMATE_COUNT_THRESHOLD', 100000)
+        estimate = estimate_count(self.object_list) if hasattr(self.object_list, 'query') else None
+        if estimate is not None and estimate >= threshold:
+            self.approximate = True
+            return estimate
+        return super().count
+
+    def validate_number(self, number):
+        self.count  # decides whether the count is approximate
+        # An estimate may be too low, so pages past it are not rejected (they may just be empty)
+        if self.approximate and str(number).isdigit() and int(number) >= 1:
+            return int(number)
+        return super().validate_number(number)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.approximate:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
+class ApproximateCountPagination(StandardResultsSetPagination):
+    """
+    Page-number pagination for big tables: above API_APPROXIMATE_COUNT_THRESHOLD rows the count
+    comes from the Postgres planner instead of COUNT(*), and `count_is_approximate` says so.
+    Small result sets keep exact counts.
+    """
+    django_paginator_class = ApproximateCountPaginator
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.keyset is None:
+            response.data['count_is_approximate'] = self.page.paginator.approximate
+        return response
@@ -0,0 +1,183 @@
+"""
+This module parses and expands recurrence rules of recurring contexts.
+
+A recurring context (a series) is stored once, with an RRULE-style rule such as
+`FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;COUNT=10`; its scheduled/ends_at are the first occurrence.
+Occurrences are never stored. They are expanded on demand for the window being queried.
+Supported parts: FREQ (DAILY, WEEKLY, MONTHLY), INTERVAL, BYDAY (weekly rules only), COUNT (at
+most MAX_OCCURRENCES) and UNTIL (at most MAX_UNTIL_YEARS ahead), so that a bounded series never has
+more occurrences than can be expanded when it is saved. Occurrences keep their wall-clock time in
+the current time zone across DST changes.
+
+Edited or cancelled occurrences are materialized as exception rows (see Context.recurrence_parent
+and original_start) that replace the occurrence starting at original_start.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY')
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# Upper bound of occurrences expanded for one series and window, and of COUNT
+MAX_OCCURRENCES = 5000
+# UNTIL may lie at most this far in the future (a daily rule then has ~3650 occurrences)
+MAX_UNTIL_YEARS = 10
+
+
+class RecurrenceRule:
+    def __init__(self, freq, interval=1, byday=None, count=None, until=None):
+        self.freq = freq
+        self.interval = interval
+        self.byday = sorted(byday) if byday else None
+        self.count = count
+        self.until = until
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a rule; raises ValueError with a readable message if it is invalid or unsupported."""
+        parts = {}
+        for part in text.strip().removeprefix('RRULE:').split(';'):
+            if not part:
+                continue
+            name, _, value = part.partition('=')
+            if not value:
+                raise ValueError(f"Invalid rule part '{part}'")
+            parts[name.strip().upper()] = value.strip().upper()
+
+        freq = parts.pop('FREQ', None)
+        if freq not in FREQUENCIES:
+            raise ValueError(f"FREQ must be one of {', '.join(FREQUENCIES)}")
+        interval = _positive_int(parts.pop('INTERVAL', '1'), 'INTERVAL')
+        count = _positive_int(parts.pop('COUNT'), 'COUNT') if 'COUNT' in parts else None
+        if count is not None and count > MAX_OCCURRENCES:
+            raise ValueError(f"COUNT cannot exceed {MAX_OCCURRENCES}")
+        until = None
+        if 'UNTIL' in parts:
+            until = _parse_until(parts.pop('UNTIL'))
+            if until > timezone.now() + timedelta(days=365 * MAX_UNTIL_YEARS):
+                raise ValueError(f"UNTIL cannot be more than {MAX_UNTIL_YEARS} years ahead")
+        if count is not None and until is not None:
+            raise ValueError("COUNT and UNTIL cannot be combined")
+        byday = None
+        if 'BYDAY' in parts:
+            if freq != 'WEEKLY':
+                raise ValueError("BYDAY is only supported for weekly rules")
+            days = parts.pop('BYDAY').split(',')
+            if any(day not in WEEKDAYS for day in days):
+                raise ValueError(f"BYDAY must list days out of {', '.join(WEEKDAYS)}")
+            byday = {WEEKDAYS.index(day) for day in days}
+        if parts:
+            raise ValueError(f"Unsupported rule parts: {', '.join(sorted(parts))}")
+        return cls(freq, interval, byday, count, until)
+
+    def _candidates(self, wall_start, skip_to=None):
+        """
+        Yield (index, wall-clock start) of all occurrences in order, index counting from 0 at the
+        first occurrence. skip_to lets daily and weekly rules jump close to a later wall-clock time.
+        """
+        if self.freq == 'MONTHLY':
+            index = 0
+            for step in range(0, 12 * 10000, self.interval):
+                year, month = divmod(wall_start.month - 1 + step, 12)
+                try:
+                    yield index, wall_start.replace(year=wall_start.year + year, month=month + 1)
+                except ValueError:
+                    continue  # months without this day are skipped, as in RFC 5545
+                index += 1
+            return
+
+        if self.freq == 'DAILY':
+            period_days, offsets = self.interval, [0]
+            period_start = wall_start
+        else:
+            period_days = 7 * self.interval
+            offsets = self.byday or [wall_start.weekday()]
+            period_start = wall_start - timedelta(days=wall_start.weekday())
+        first = [offset for offset in offsets if period_start + timedelta(days=offset) >= wall_start]
+
+        period = 0
+        if skip_to is not None and skip_to > wall_start:
+            period = max(0, (skip_to - wall_start).days // period_days - 1)
+        index = len(first) + (period - 1) * len(offsets) if period else 0
+        while True:
+            for offset in (first if period == 0 else offsets):
+                yield index, period_start + timedelta(days=period * period_days + offset)
+                index += 1
+            period += 1
+
+    def occurrences(self, start, duration, window_start=None, window_end=None, limit=MAX_OCCURRENCES):
+        """
+        Return the aware start times of the occurrences of a series starting at `start` whose
+        [occurrence, occurrence + duration) overlaps [window_start, window_end).
+        Without window_end the rule must be bounded by COUNT or UNTIL.
+        """
+        if window_end is None and self.count is None and self.until is None:
+            raise ValueError("An open-ended rule needs a window")
+        result = []
+        for occurrence in self._iter_occurrences(start, duration, window_start, window_end):
+            result.append(occurrence)
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+    def _iter_occurrences(self, start, duration, window_start, window_end):
+        """Yield the occurrences of occurrences() in order, without a limit."""
+        tz = timezone.get_current_timezone()
+        wall_start = timezone.localtime(start, tz).replace(tzinfo=None)
+        skip_to = None
+        if window_start is not None:
+            skip_to = timezone.localtime(window_start - duration, tz).replace(tzinfo=None)
+
+        for index, wall in self._candidates(wall_start, skip_to):
+            if self.count is not None and index >= self.count:
+                return
+            occurrence = timezone.make_aware(wall, tz)
+            if self.until is not None and occurrence > self.until:
+                return
+            if window_end is not None and occurrence >= window_end:
+                return
+            if window_start is None or occurrence + duration > window_start:
+                yield occurrence
+
+    def last_end(self, start, duration):
+        """End of the last occurrence, or None for an open-ended rule."""
+        if self.count is None and self.until is None:
+            return None
+        window_start = None
+        if self.until is not None and self.freq != 'MONTHLY':
+            # Daily and weekly occurrences are at most one period apart, so the last one before
+            # UNTIL lies within the period (plus a day for DST) before it
+            period_days = self.interval * (1 if self.freq == 'DAILY' else 7)
+            window_start = self.until - timedelta(days=period_days + 1)
+        last = start
+        for last in self._iter_occurrences(start, duration, window_start, None):
+            pass  # only the last occurrence is kept
+        return last + duration
+
+
+def _positive_int(value, name):
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return int(value)
+
+
+def _parse_until(value):
+    try:
+        if len(value) == 8:
+            parsed = datetime.strptime(value, '%Y%m%d').replace(hour=23, minute=59, second=59)
+        else:
+            parsed = datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+            if value.endswith('Z'):
+                return parsed.replace(tzinfo=dt_timezone.utc)
+    except ValueError:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError("UNTIL must be a date (YYYYMMDD) or date-time (YYYYMMDDTHHMMSSZ)")
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+def parse_rule(text):
+    """Return the RecurrenceRule of a rule text, or None for an empty text."""
+    return RecurrenceRule.parse(text) if text else None
@@ -0,0 +1,220 @@
+"""
+This module imports relationships (agent_from, agent_to, description) from CSV or NDJSON streams.
+
+Rows are read and validated one batch at a time, so memory use does not grow with the input:
+
+- agent IDs are checked against the set of existing agent IDs, loaded once per import
+- malformed rows, unknown agents, self-references and pairs repeated within the batch are skipped
+- on PostgreSQL the batch is COPYed into a temporary table and inserted with one
+  INSERT ... SELECT that skips pairs which already exist (looked up through relationship_pair_idx)
+- other databases look the batch's existing pairs up in one query and use bulk_create
+
+Each batch is committed on its own, so an interrupted import keeps the batches already loaded
+and can simply be run again. Neither COPY nor bulk_create sends signals, so the relationship
+response caches are invalidated once per batch. The inserted pairs of each batch are added to the
+graph index (api.graph_index) with one broadcast while the import stays within
+GRAPH_INDEX_MAX_DELTA pairs; a larger import marks the index stale once, when it ends, so it is
+rebuilt once rather than after every batch.
+"""
+
+import csv
+import io
+import json
+import logging
+import time
+from django.conf import settings
+from django.db import connection, transaction
+from .models import Agent, Relationship
+from .graph_index import edge_changed, edges_added
+from .signals import invalidate_cached
+
+logger = logging.getLogger('omnisyslogger')
+
+FORMATS = ('csv', 'ndjson')
+DESCRIPTION_MAX_LENGTH = Relationship._meta.get_field('description').max_length
+
+# Invalid rows are all counted, but only the first ones are reported with their line
+MAX_REPORTED_ERRORS = 100
+
+TEMP_TABLE = 'relationship_import'
+
+
+def detect_format(filename):
+    """Guess the format from a file name; None if it cannot be told."""
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return None
+
+
+def read_rows(stream, fmt):
+    """
+    Yield (line number, row dict) from a text stream; row is None for a malformed line.
+    CSV needs a header naming agent_from and agent_to (description is optional), NDJSON has
+    one object per line.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        if not {'agent_from', 'agent_to'} <= set(reader.fieldnames or ()):
+            raise ValueError("CSV header must contain agent_from and agent_to")
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_no, row if isinstance(row, dict) else None
+
+
+class RelationshipImporter:
+    """
+    Runs one import. progress is called with the stats after every batch.
+    stats: read, inserted, duplicates (within the input or already stored), invalid, batches,
+    elapsed_ms; errors lists the first MAX_REPORTED_ERRORS invalid rows as {line, error}.
+    """
+
+    def __init__(self, batch_size=None, progress=None):
+        self.batch_size = batch_size or settings.RELATIONSHIP_IMPORT_BATCH_SIZE
+        self.progress = progress
+        self.stats = {'read': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'batches': 0, 'elapsed_ms': 0}
+        self.errors = []
+        self.announced = 0  # inserted pairs sent to the graph index so far
+        self.graph_reset = False  # too many for the overlay, reset the index at the end
+
+    def run(self, stream, fmt):
+        if fmt not in FORMATS:
+            raise ValueError(f"Format must be one of {', '.join(FORMATS)}")
+        self.started = time.perf_counter()
+        self.agent_ids = set(Agent.objects.values_list('id', flat=True))
+        try:
+            self._run(stream, fmt)
+        finally:
+            if self.graph_reset:
+                edge_changed('reset')
+        return self.stats
+
+    def _run(self, stream, fmt):
+        batch = {}  # (agent_from, agent_to) -> description
+        for line_no, row in read_rows(stream, fmt):
+            self.stats['read'] += 1
+            edge = self._clean(line_no, row)
+            if edge is None:
+                continue
+            pair, description = edge
+            if pair in batch:
+                self.stats['duplicates'] += 1
+                continue
+            batch[pair] = description
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = {}
+        if batch:
+            self._flush(batch)
+        self._update_elapsed()
+
+    def _update_elapsed(self):
+        self.stats['elapsed_ms'] = round((time.perf_counter() - self.started) * 1000, 2)
+
+    def _invalid(self, line_no, message):
+        self.stats['invalid'] += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_no, 'error': message})
+
+    def _clean(self, line_no, row):
+        """Return ((agent_from, agent_to), description) of a valid row, else record the error."""
+        if row is None:
+            return self._invalid(line_no, "Malformed row")
+        try:
+            agent_from, agent_to = int(row.get('agent_from')), int(row.get('agent_to'))
+        except (TypeError, ValueError):
+            return self._invalid(line_no, "agent_from and agent_to must be agent IDs")
+        missing = [agent_id for agent_id in (agent_from, agent_to) if agent_id not in self.agent_ids]
+        if missing:
+            return self._invalid(line_no, f"Agents not found: {missing}")
+        if agent_from == agent_to:
+            return self._invalid(line_no, "An agent cannot have a relationship with itself")
+        description = row.get('description') or None
+        if description is not None:
+            description = str(description)
+            if len(description) > DESCRIPTION_MAX_LENGTH:
+                return self._invalid(line_no, f"Description cannot exceed {DESCRIPTION_MAX_LENGTH} characters")
+        return (agent_from, agent_to), description
+
+    def _flush(self, batch):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                inserted = self._copy(batch)
+            else:
+                inserted = self._bulk_create(batch)
+            invalidate_cached(Relationship)
+            self._announce(inserted)
+        self.stats['inserted'] += len(inserted)
+        self.stats['duplicates'] += len(batch) - len(inserted)
+        self.stats['batches'] += 1
+        self._update_elapsed()
+        if self.progress:
+            self.progress(self.stats)
+
+    def _announce(self, pairs):
+        """Add the inserted pairs to the graph index, unless the import outgrew its overlay."""
+        if not pairs or self.graph_reset:
+            return
+        if self.announced + len(pairs) > getattr(settings, 'GRAPH_INDEX_MAX_DELTA', 100000):
+            self.graph_reset = True
+            return
+        edges_added(pairs)
+        self.announced += len(pairs)
+
+    def _copy(self, batch):
+        """
+        COPY the batch into a temporary table and insert the pairs that are not stored yet.
+        Returns the inserted (agent_from, agent_to) pairs.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for (agent_from, agent_to), description in batch.items():
+            writer.writerow([agent_from, agent_to, description])  # None is written unquoted, i.e. NULL
+        buffer.seek(0)
+        table = Relationship._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS {TEMP_TABLE} "
+                f"(agent_from_id integer, agent_to_id integer, description varchar({DESCRIPTION_MAX_LENGTH})) "
+                f"ON COMMIT DELETE ROWS"
+            )
+            cursor.copy_expert(
+                f"COPY {TEMP_TABLE} (agent_from_id, agent_to_id, description) FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute(
+                f"INSERT INTO {table} (agent_from_id, agent_to_id, description, created_at) "
+                f"SELECT t.agent_from_id, t.agent_to_id, t.description, now() FROM {TEMP_TABLE} t "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} r "
+                f"WHERE r.agent_from_id = t.agent_from_id AND r.agent_to_id = t.agent_to_id) "
+                f"RETURNING agent_from_id, agent_to_id"
+            )
+            return cursor.fetchall()
+
+    def _bulk_create(self, batch):
+        """Fallback for other databases: one query for the batch's stored pairs, then bulk_create."""
+        existing = set(Relationship.objects.filter(
+            agent_from_id__in={pair[0] for pair in batch},
+            agent_to_id__in={pair[1] for pair in batch},
+        ).values_list('agent_from_id', 'agent_to_id'))
+        new = [
+            Relationship(agent_from_id=agent_from, agent_to_id=agent_to, description=description)
+            for (agent_from, agent_to), description in batch.items() if (agent_from, agent_to) not in existing
+        ]
+        Relationship.objects.bulk_create(new, batch_size=1000)
+        return [(r.agent_from_id, r.agent_to_id) for r in new]
+
+
+def import_relationships(stream, fmt, batch_size=None, progress=None):
+    """Import the relationships of a text stream; returns (stats, errors)."""
+    importer = RelationshipImporter(batch_size, progress)
+    importer.run(stream, fmt)
+    return importer.stats, importer.errors
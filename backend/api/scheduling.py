@@ -0,0 +1,394 @@
+"""
+This module provides set-based scheduling queries used by the serializers and views.
+
+Contexts occupy the half-open interval [scheduled, ends_at). Overlap queries ignore archived
+contexts and run on one of two backends:
+
+- PostgreSQL: `tstzrange(scheduled, ends_at, '[)') && tstzrange(start, end)`, served by the GiST
+  index (and, for spaces, the exclusion constraint) created in migration 0004
+- other databases: an in-memory IntervalTree of all non-archived contexts, rebuilt only when the
+  Context cache version changes (see api.caching), so each check is O(log n + k)
+
+Recurring contexts (series, see api.recurrence) are fetched by the same queries whenever their
+first start and last end could span the window, and are expanded into the occurrences that
+overlap it, minus the occurrences replaced by exception rows.
+"""
+
+import copy
+from django.db import connection
+from django.db.models import F, Func, Q
+from .caching import model_version
+from .interval_tree import IntervalTree
+from .models import Context, Space
+from .recurrence import parse_rule
+
+_tree_cache = {'version': None, 'tree': None}
+
+
+class Span(Func):
+    """tstzrange(start, end, '[)') of two datetime expressions (PostgreSQL)."""
+    function = 'tstzrange'
+    template = "%(function)s(%(expressions)s, '[)')"
+
+    def __init__(self, start, end, **extra):
+        from django.contrib.postgres.fields import DateTimeRangeField
+        super().__init__(start, end, output_field=DateTimeRangeField(), **extra)
+
+
+def uses_range_index():
+    return connection.vendor == 'postgresql'
+
+
+def context_tree():
+    """Return the interval tree of non-archived single contexts, payload (context_id, space_id)."""
+    version = model_version(Context)
+    if _tree_cache['version'] != version:
+        rows = Context.objects.filter(is_archived=False, recurrence_rule='').values_list(
+            'scheduled', 'ends_at', 'id', 'space_id')
+        _tree_cache['tree'] = IntervalTree((start, end, (pk, space_id)) for start, end, pk, space_id in rows)
+        _tree_cache['version'] = version
+    return _tree_cache['tree']
+
+
+def _overlap_filter(prefix, start, end):
+    """Filter kwargs/annotation for rows whose context overlaps [start, end) on PostgreSQL."""
+    from django.db.backends.postgresql.psycopg_any import DateTimeTZRange
+    span = Span(F(f'{prefix}scheduled'), F(f'{prefix}ends_at'))
+    return span, {'span__overlap': DateTimeTZRange(start, end, '[)')}
+
+
+def series_q(prefix, start, end):
+    """Q for series (reached through prefix) that may have an occurrence overlapping [start, end)."""
+    return (~Q(**{f'{prefix}recurrence_rule': ''}) & Q(**{f'{prefix}scheduled__lt': end})
+            & (Q(**{f'{prefix}recurrence_end__isnull': True}) | Q(**{f'{prefix}recurrence_end__gt': start})))
+
+
+def replaced_occurrences(series_ids):
+    """Return the (series_id, original_start) pairs that have an exception row."""
+    if not series_ids:
+        return set()
+    return set(Context.objects.filter(recurrence_parent_id__in=series_ids).values_list(
+        'recurrence_parent_id', 'original_start'))
+
+
+def series_occurrences(series_id, rule_text, first_start, first_end, start, end, replaced):
+    """Return the (start, end) of a series' occurrences overlapping [start, end) without exceptions."""
+    duration = first_end - first_start
+    return [
+        (occurrence, occurrence + duration)
+        for occurrence in parse_rule(rule_text).occurrences(first_start, duration, start, end)
+        if (series_id, occurrence) not in replaced
+    ]
+
+
+def expand_series(rows, start, end, prefix='', id_key='id'):
+    """
+    Replace each series among rows (dicts from values(), which must include the prefixed
+    scheduled, ends_at and recurrence_rule) by one copy per occurrence overlapping [start, end),
+    with scheduled/ends_at set to the occurrence. Costs one query if there are series.
+    """
+    series_ids = {row[id_key] for row in rows if row[f'{prefix}recurrence_rule']}
+    if not series_ids:
+        return rows
+    replaced = replaced_occurrences(series_ids)
+    expanded = []
+    for row in rows:
+        if not row[f'{prefix}recurrence_rule']:
+            expanded.append(row)
+            continue
+        for occurrence_start, occurrence_end in series_occurrences(
+                row[id_key], row[f'{prefix}recurrence_rule'], row[f'{prefix}scheduled'], row[f'{prefix}ends_at'],
+                start, end, replaced):
+            expanded.append({**row, f'{prefix}scheduled': occurrence_start, f'{prefix}ends_at': occurrence_end})
+    return expanded
+
+
+def expand_contexts(contexts, start, end):
+    """
+    Like expand_series for Context instances: each series becomes unsaved copies (keeping the
+    series id and prefetched relations) with scheduled/ends_at of an occurrence and original_start
+    set to it. Returns the contexts ordered by start.
+    """
+    replaced = replaced_occurrences({context.pk for context in contexts if context.recurrence_rule})
+    expanded = []
+    for context in contexts:
+        if not context.recurrence_rule:
+            expanded.append(context)
+            continue
+        for occurrence_start, occurrence_end in series_occurrences(
+                context.pk, context.recurrence_rule, context.scheduled, context.ends_at, start, end, replaced):
+            occurrence = copy.copy(context)
+            occurrence.scheduled, occurrence.ends_at = occurrence_start, occurrence_end
+            occurrence.original_start = occurrence_start
+            expanded.append(occurrence)
+    expanded.sort(key=lambda context: (context.scheduled, context.pk))
+    return expanded
+
+
+def overlapping_context_ids(start, end, space_id=None, exclude_context_id=None):
+    """Return IDs of non-archived single contexts overlapping [start, end), optionally in one space."""
+    if uses_range_index():
+        span, lookup = _overlap_filter('', start, end)
+        queryset = Context.objects.filter(is_archived=False, recurrence_rule='').annotate(span=span).filter(**lookup)
+        if space_id is not None:
+            queryset = queryset.filter(space_id=space_id)
+        if exclude_context_id is not None:
+            queryset = queryset.exclude(pk=exclude_context_id)
+        return list(queryset.order_by('scheduled').values_list('id', flat=True))
+    return [
+        pk for pk, context_space_id in context_tree().overlapping(start, end)
+        if (space_id is None or context_space_id == space_id) and pk != exclude_context_id
+    ]
+
+
+def _overlapping(queryset, prefix, start, end):
+    """Filter a queryset to single contexts overlapping [start, end) and series that may do so."""
+    if uses_range_index():
+        span, lookup = _overlap_filter(prefix, start, end)
+        return queryset.annotate(span=span).filter(Q(**{f'{prefix}recurrence_rule': ''}, **lookup) | series_q(prefix, start, end))
+    ids = [pk for pk, _ in context_tree().overlapping(start, end)]
+    return queryset.filter(Q(**{f'{prefix}id__in': ids}) | series_q(prefix, start, end))
+
+
+def find_space_conflicts(space_id, start, end, exclude_context_id=None):
+    """
+    Return the non-archived contexts in a space overlapping [start, end), ordered by start;
+    occurrences of series are returned as unsaved copies (see expand_contexts).
+    """
+    if space_id is None:
+        return []
+    queryset = _overlapping(Context.objects.filter(is_archived=False, space_id=space_id), '', start, end)
+    if exclude_context_id is not None:
+        queryset = queryset.exclude(pk=exclude_context_id)
+    return expand_contexts(list(queryset), start, end)
+
+
+def find_agent_conflicts(agent_ids, start, end, exclude_context_id=None):
+    """
+    Return all (agent, context) pairs that clash with [start, end) for the given agents, in one
+    query over the Context.agents join table (plus one for exceptions if series are involved), as
+    a list of dicts with agent_id, agent_name, context_id, context_name and scheduled.
+    """
+    if not agent_ids:
+        return []
+    conflicts = Context.agents.through.objects.filter(agent_id__in=agent_ids, context__is_archived=False)
+    conflicts = _overlapping(conflicts, 'context__', start, end)
+    if exclude_context_id is not None:
+        conflicts = conflicts.exclude(context_id=exclude_context_id)
+    rows = expand_series(list(conflicts.values(
+        'agent_id', 'agent__name', 'context_id', 'context__name', 'context__scheduled', 'context__ends_at',
+        'context__recurrence_rule')), start, end, prefix='context__', id_key='context_id')
+    rows.sort(key=lambda row: (row['agent__name'], row['context__scheduled']))
+    return [
+        {'agent_id': row['agent_id'], 'agent_name': row['agent__name'], 'context_id': row['context_id'],
+         'context_name': row['context__name'], 'scheduled': row['context__scheduled']}
+        for row in rows
+    ]
+
+
+def format_agent_conflicts(conflicts):
+    """Return one readable message per conflicting agent, listing all clashing contexts."""
+    by_agent = {}
+    for conflict in conflicts:
+        by_agent.setdefault(conflict['agent_name'], []).append(
+            f"{conflict['context_name']} at {conflict['scheduled']}")
+    return [
+        f"Agent '{agent_name}' is already scheduled at this time: {', '.join(contexts)}"
+        for agent_name, contexts in by_agent.items()
+    ]
+
+
+# -- free-slot search ---------------------------------------------------------
+
+def merge_intervals(intervals):
+    """Sweep-line union of (start, end) intervals, returned sorted and non-overlapping."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def free_gaps(busy, window_start, window_end):
+    """Complement of merged busy intervals within [window_start, window_end)."""
+    gaps = []
+    cursor = window_start
+    for start, end in busy:
+        if start > cursor:
+            gaps.append((cursor, min(start, window_end)))
+        cursor = max(cursor, end)
+        if cursor >= window_end:
+            break
+    if cursor < window_end:
+        gaps.append((cursor, window_end))
+    return [(start, end) for start, end in gaps if start < end]
+
+
+def intersect_gaps(a, b):
+    """Two-pointer intersection of two sorted, non-overlapping interval lists."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def busy_in_window(queryset, prefix, window_start, window_end):
+    """
+    Filter to non-archived single contexts (reached through prefix) overlapping
+    [window_start, window_end) and series that may do so; see busy_rows for the expanded rows.
+    """
+    return queryset.filter(**{f'{prefix}is_archived': False}).filter(
+        Q(**{f'{prefix}recurrence_rule': '', f'{prefix}scheduled__lt': window_end, f'{prefix}ends_at__gt': window_start})
+        | series_q(prefix, window_start, window_end)
+    )
+
+
+def busy_rows(queryset, prefix, window_start, window_end, *fields):
+    """Return values(*fields) of busy_in_window, with series expanded into their occurrences."""
+    id_key = f'{prefix[:-2]}_id' if prefix else 'id'  # 'context__' -> 'context_id'
+    names = {id_key, f'{prefix}scheduled', f'{prefix}ends_at', f'{prefix}recurrence_rule', *fields}
+    rows = list(busy_in_window(queryset, prefix, window_start, window_end).values(*names))
+    return expand_series(rows, window_start, window_end, prefix=prefix, id_key=id_key)
+
+
+def find_free_slots(agent_ids, duration, window_start, window_end, space_id=None, min_capacity=None, limit=5):
+    """
+    Return up to `limit` earliest non-overlapping slots of `duration` within the window in which
+    all agents are free and, if a space or minimum capacity is requested, one suitable space is
+    free as well. Busy intervals are loaded with one query per resource type and merged with a
+    sweep line. Each slot is a dict with start, end and space_id (None without a space constraint).
+    """
+    rows = busy_rows(Context.agents.through.objects.filter(agent_id__in=agent_ids), 'context__', window_start, window_end)
+    agent_busy = merge_intervals((row['context__scheduled'], row['context__ends_at']) for row in rows)
+    agent_free = free_gaps(agent_busy, window_start, window_end)
+
+    if space_id is None and min_capacity is None:
+        candidates = [(None, agent_free)]
+    else:
+        spaces = Space.objects.filter(is_archived=False, capacity__gte=max(min_capacity or 1, len(agent_ids)))
+        if space_id is not None:
+            spaces = spaces.filter(pk=space_id)
+        capacities = dict(spaces.values_list('id', 'capacity'))
+        space_busy = {pk: [] for pk in capacities}
+        for row in busy_rows(Context.objects.filter(space_id__in=capacities), '', window_start, window_end, 'space_id'):
+            space_busy[row['space_id']].append((row['scheduled'], row['ends_at']))
+        # Best fit first: on equal start times the smallest sufficient space wins
+        candidates = [
+            (pk, intersect_gaps(agent_free, free_gaps(merge_intervals(space_busy[pk]), window_start, window_end)))
+            for pk in sorted(capacities, key=lambda pk: (capacities[pk], pk))
+        ]
+
+    gaps = sorted(
+        ((start, end, rank, pk) for rank, (pk, free) in enumerate(candidates) for start, end in free
+         if end - start >= duration),
+        key=lambda gap: (gap[0], gap[2])
+    )
+    slots = []
+    cursor = window_start
+    while len(slots) < limit:
+        best = None
+        for start, end, rank, pk in gaps:
+            slot_start = max(start, cursor)
+            if end - slot_start < duration:
+                continue
+            if best is None or (slot_start, rank) < (best[0], best[1]):
+                best = (slot_start, rank, pk)
+            if start >= cursor and best[0] <= start:
+                break  # gaps are sorted by start, none later can begin earlier
+        if best is None:
+            break
+        slots.append({'start': best[0], 'end': best[0] + duration, 'space_id': best[2]})
+        cursor = best[0] + duration
+    return slots
+
+
+# -- batch validation -----------------------------------------------------------
+
+def sweep_conflicts(intervals):
+    """
+    Yield (earlier_key, later_key, resource) for every pair of intervals that overlap and share a
+    resource. intervals: iterable of (start, end, key, resources). One sweep in start order; per
+    resource only the intervals still running at the current start are kept.
+    """
+    active = {}
+    for start, end, key, resources in sorted(intervals, key=lambda item: item[0]):
+        for resource in resources:
+            running = [(other_end, other) for other_end, other in active.get(resource, ()) if other_end > start]
+            for _, other in running:
+                yield other, key, resource
+            running.append((end, key))
+            active[resource] = running
+
+
+def _existing_intervals(items, exclude_context_ids=()):
+    """
+    Load the non-archived contexts (and occurrences of series) that overlap the batch's time span
+    and use one of its spaces or agents, as sweep intervals keyed by (context_id, start).
+    One query per resource type, plus one for exceptions if series are involved.
+    """
+    space_ids = {item['space_id'] for item in items if item.get('space_id') is not None}
+    agent_ids = {agent_id for item in items for agent_id in item['agent_ids']}
+    lo = min(item['scheduled'] for item in items)
+    hi = max(item['ends_at'] for item in items)
+
+    contexts = {}
+    if space_ids:
+        queryset = Context.objects.filter(space_id__in=space_ids)
+        if exclude_context_ids:
+            queryset = queryset.exclude(pk__in=list(exclude_context_ids))
+        for row in busy_rows(queryset, '', lo, hi, 'name', 'space_id'):
+            contexts.setdefault((row['id'], row['scheduled']), [row['ends_at'], row['name'], set()])[2].add(
+                ('space', row['space_id']))
+    if agent_ids:
+        queryset = Context.agents.through.objects.filter(agent_id__in=agent_ids)
+        if exclude_context_ids:
+            queryset = queryset.exclude(context_id__in=list(exclude_context_ids))
+        for row in busy_rows(queryset, 'context__', lo, hi, 'context__name', 'agent_id'):
+            contexts.setdefault((row['context_id'], row['context__scheduled']),
+                                [row['context__ends_at'], row['context__name'], set()])[2].add(('agent', row['agent_id']))
+    return contexts
+
+
+def find_batch_conflicts(items, exclude_context_ids=()):
+    """
+    Check proposed contexts against each other and against existing contexts in one sorted sweep.
+    items: list of dicts with scheduled, ends_at, space_id and agent_ids. Returns every conflict as
+    a dict with the batch index, resource ('space' or 'agent'), resource_id and either the
+    other_index of a clashing batch item or the context_id, context_name and scheduled of a
+    clashing existing context (or occurrence). exclude_context_ids leaves out existing contexts,
+    e.g. the series that items are the new occurrences of, or contexts that items are updating.
+    """
+    if not items:
+        return []
+    existing = _existing_intervals(items, exclude_context_ids)
+    intervals = [(key[1], end, ('context', key), resources) for key, (end, _, resources) in existing.items()]
+    for index, item in enumerate(items):
+        resources = {('agent', agent_id) for agent_id in item['agent_ids']}
+        if item.get('space_id') is not None:
+            resources.add(('space', item['space_id']))
+        intervals.append((item['scheduled'], item['ends_at'], ('item', index), resources))
+
+    conflicts = []
+    for first, second, (resource, resource_id) in sweep_conflicts(intervals):
+        if first[0] == 'context' and second[0] == 'context':
+            continue  # clashes between existing contexts are not the batch's concern
+        if first[0] == 'context' or second[0] == 'context':
+            item, (_, (pk, start)) = (second, first) if first[0] == 'context' else (first, second)
+            conflicts.append({'index': item[1], 'resource': resource, 'resource_id': resource_id,
+                              'context_id': pk, 'context_name': existing[(pk, start)][1], 'scheduled': start})
+        else:
+            conflicts.append({'index': second[1], 'resource': resource, 'resource_id': resource_id,
+                              'other_index': first[1]})
+    conflicts.sort(key=lambda conflict: (conflict['index'], conflict['resource'], conflict['resource_id']))
+    return conflicts
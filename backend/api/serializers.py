@@ -5,11 +5,18 @@ used in RESTful APIs for the OMNI-SYS API.
 
 from django.db import models
 from rest_framework import serializers
-from .models import Agent, Space, Context, Relationship
+from .models import Agent, Space, Context, Relationship, DEFAULT_CONTEXT_DURATION
+from .scheduling import (
+    find_agent_conflicts, find_space_conflicts, format_agent_conflicts, find_batch_conflicts, replaced_occurrences
+)
+from .recurrence import parse_rule
 from django.utils import timezone
 import re
 from datetime import timedelta
 
+# Occurrences of a recurring context are checked for conflicts this far ahead of its first start
+RECURRENCE_CHECK_HORIZON = timedelta(days=730)
+
 
 class AgentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -33,8 +40,10 @@ class AgentSerializer(serializers.ModelSerializer):
                 "Name can only contain letters, numbers, spaces, hyphens, periods, and apostrophes"
             )
 
-        # Check for duplicate names (case-insensitive)
-        if self.instance:  # Update operation
+        # Check for duplicate names (case-insensitive); bulk requests check the whole batch at once
+        if self.context.get('bulk'):
+            exists = False
+        elif self.instance:  # Update operation
             exists = Agent.objects.exclude(pk=self.instance.pk).filter(
                 name__iexact=value.strip()
             ).exists()
@@ -59,8 +68,10 @@ class SpaceSerializer(serializers.ModelSerializer):
         if len(value.strip()) < 3:
             raise serializers.ValidationError("Space name must be at least 3 characters long")
 
-        # Ensure unique name (case-insensitive)
-        if self.instance:
+        # Ensure unique name (case-insensitive); bulk requests check the whole batch at once
+        if self.context.get('bulk'):
+            exists = False
+        elif self.instance:
             exists = Space.objects.exclude(pk=self.instance.pk).filter(
                 name__iexact=value.strip()
             ).exists()
@@ -80,30 +91,31 @@ class SpaceSerializer(serializers.ModelSerializer):
         if value > 1000:
             raise serializers.ValidationError("Capacity cannot exceed 1000")
 
-        # If updating, check if reducing capacity would affect existing contexts
-        if self.instance and value < self.instance.capacity:
+        # If updating, check if reducing capacity would affect existing contexts (batched for bulk requests)
+        if self.instance and value < self.instance.capacity and not self.context.get('bulk'):
             # Check if any contexts have more agents than new capacity
             over_capacity_contexts = self.instance.context_set.annotate(
                 agent_count=models.Count('agents')
             ).filter(agent_count__gt=value)
 
-            if over_capacity_contexts.exists():
-                # Get the names of the over-capacity contexts
-                context_names = list(over_capacity_contexts.values_list('name', flat=True))
+            # Get the names of the over-capacity contexts
+            context_names = list(over_capacity_contexts.values_list('name', flat=True))
+            if context_names:
+                raise serializers.ValidationError(over_capacity_message(value, context_names))
 
-                # Create a readable list of context names
-                if len(context_names) <= 3:
-                    names_str = ", ".join(context_names)
-                else:
-                    # Show first 3 and indicate there are more
-                    names_str = f"{', '.join(context_names[:3])}, and {len(context_names) - 3} more"
+        return value
 
-                raise serializers.ValidationError(
-                    f"Cannot reduce capacity to {value}. "
-                    f"{over_capacity_contexts.count()} contexts have more agents than this capacity: {names_str}"
-                )
 
-        return value
+def over_capacity_message(capacity, context_names):
+    """Error for a capacity reduction that the named contexts would no longer fit in"""
+    # Create a readable list of context names
+    if len(context_names) <= 3:
+        names_str = ", ".join(context_names)
+    else:
+        # Show first 3 and indicate there are more
+        names_str = f"{', '.join(context_names[:3])}, and {len(context_names) - 3} more"
+    return (f"Cannot reduce capacity to {capacity}. "
+            f"{len(context_names)} contexts have more agents than this capacity: {names_str}")
 
 
 class ContextSerializer(serializers.ModelSerializer):
@@ -128,10 +140,11 @@ class ContextSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Context
-        fields = ['id', 'name', 'scheduled', 'space', 'agents',
+        fields = ['id', 'name', 'scheduled', 'ends_at', 'space', 'agents',
                   'space_detail', 'agents_detail', 'space_id', 'agent_ids',
-                  'created_at', 'is_archived']
-        read_only_fields = ['id', 'created_at']
+                  'created_at', 'is_archived', 'recurrence_rule', 'recurrence_end',
+                  'recurrence_parent', 'original_start']
+        read_only_fields = ['id', 'created_at', 'recurrence_end', 'recurrence_parent', 'original_start']
 
     def validate_name(self, value):
         """Validate context name"""
@@ -162,11 +175,23 @@ class ContextSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Duplicate agents are not allowed")
         return value
 
+    def validate_recurrence_rule(self, value):
+        """Validate the recurrence rule (see api.recurrence for the supported subset)"""
+        try:
+            parse_rule(value)
+        except ValueError as e:
+            raise serializers.ValidationError(f"Invalid recurrence rule: {str(e)}")
+        if value and self.instance and self.instance.recurrence_parent_id:
+            raise serializers.ValidationError("An occurrence of a recurring context cannot recur itself")
+        return value
+
     def validate(self, data):
         """Object-level validation"""
         space = data.get('space') or (self.instance.space if self.instance else None)
         agents = data.get('agents') or (list(self.instance.agents.all()) if self.instance else [])
         scheduled = data.get('scheduled') or (self.instance.scheduled if self.instance else None)
+        ends_at = self._resolve_ends_at(data, scheduled)
+        exclude_id = self.instance.pk if self.instance else None
 
         # Validate capacity
         if space and agents:
@@ -174,43 +199,96 @@ class ContextSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError({
                     'agent_ids': f"Number of agents ({len(agents)}) exceeds space capacity ({space.capacity})"
                 })
+        if self.context.get('bulk'):
+            return data  # conflicts are checked for the whole batch (see ContextViewSet.bulk_check)
 
-        # Check for scheduling conflicts
-        if space and scheduled:
-            start_time = scheduled
-
-            # Find overlapping contexts in the same space
-            overlapping = Context.objects.filter(
-                space=space,
-                scheduled=start_time
-            )
-
-            if self.instance:
-                overlapping = overlapping.exclude(pk=self.instance.pk)
+        rule = parse_rule(data.get('recurrence_rule', self.instance.recurrence_rule if self.instance else ''))
+        if rule and scheduled:
+            self._validate_occurrences(rule, space, agents, scheduled, ends_at, exclude_id)
+            return data
 
-            if overlapping.exists():
+        # Check for overlapping contexts in the same space
+        if space and scheduled:
+            overlapping = find_space_conflicts(space.pk, scheduled, ends_at, exclude_context_id=exclude_id)
+            if overlapping:
                 conflicts = [f"{c.name} at {c.scheduled}" for c in overlapping[:3]]
                 raise serializers.ValidationError({
                     'scheduled': f"Scheduling conflict with: {', '.join(conflicts)}"
                 })
 
-        # Check agent availability
+        # Check agent availability for all agents in one query, reporting every conflict
         if agents and scheduled:
-            for agent in agents:
-                # Check if agent is already scheduled at this time
-                agent_conflicts = Context.objects.filter(
-                    agents=agent,
-                    scheduled__lt=scheduled + timedelta(hours=1),
-                    scheduled__gt=scheduled - timedelta(hours=1)
-                )
-
-                if self.instance:
-                    agent_conflicts = agent_conflicts.exclude(pk=self.instance.pk)
-
-                if agent_conflicts.exists():
-                    raise serializers.ValidationError({
-                        'agent_ids': f"Agent '{agent.name}' is already scheduled at this time"
-                    })
+            conflicts = find_agent_conflicts(
+                [agent.pk for agent in agents], scheduled, ends_at, exclude_context_id=exclude_id
+            )
+            if conflicts:
+                raise serializers.ValidationError({'agent_ids': format_agent_conflicts(conflicts)})
+        return data
+
+    def _validate_occurrences(self, rule, space, agents, scheduled, ends_at, exclude_id):
+        """Check every occurrence within RECURRENCE_CHECK_HORIZON in one sweep (see find_batch_conflicts)."""
+        duration = ends_at - scheduled
+        replaced = replaced_occurrences({exclude_id}) if exclude_id else set()
+        items = [
+            {'scheduled': start, 'ends_at': start + duration, 'space_id': space.pk if space else None,
+             'agent_ids': [agent.pk for agent in agents]}
+            for start in rule.occurrences(scheduled, duration, scheduled, scheduled + RECURRENCE_CHECK_HORIZON)
+            if (exclude_id, start) not in replaced
+        ]
+        conflicts = find_batch_conflicts(items, exclude_context_ids=[exclude_id] if exclude_id else ())
+        if any('other_index' in conflict for conflict in conflicts):
+            raise serializers.ValidationError({'recurrence_rule': "Occurrences of this rule overlap each other"})
+        space_conflicts = [f"{c['context_name']} at {c['scheduled']}" for c in conflicts if c['resource'] == 'space']
+        if space_conflicts:
+            raise serializers.ValidationError({
+                'scheduled': f"Scheduling conflict with: {', '.join(space_conflicts[:3])}"
+            })
+        names = {agent.pk: agent.name for agent in agents}
+        agent_conflicts = [
+            {'agent_name': names[c['resource_id']], 'context_name': c['context_name'], 'scheduled': c['scheduled']}
+            for c in conflicts if c['resource'] == 'agent'
+        ]
+        if agent_conflicts:
+            raise serializers.ValidationError({'agent_ids': format_agent_conflicts(agent_conflicts)})
+
+    def _resolve_ends_at(self, data, scheduled):
+        """
+        Work out the end of the context: the given ends_at, else the current duration moved
+        along with a new start, else DEFAULT_CONTEXT_DURATION. Stores it in data.
+        """
+        if scheduled is None:
+            return None
+        ends_at = data.get('ends_at')
+        if ends_at is None:
+            if self.instance and self.instance.ends_at:
+                ends_at = scheduled + (self.instance.ends_at - self.instance.scheduled)
+            else:
+                ends_at = scheduled + DEFAULT_CONTEXT_DURATION
+        if ends_at <= scheduled:
+            raise serializers.ValidationError({'ends_at': "End must be after the scheduled start"})
+        data['ends_at'] = ends_at
+        return ends_at
+
+class ContextBatchItemSerializer(serializers.Serializer):
+    """
+    One proposed context of a batch (see ContextViewSet.batch). Only checks the item itself;
+    existence, capacity and conflicts are checked for the whole batch at once.
+    """
+    name = serializers.CharField(max_length=100)
+    scheduled = serializers.DateTimeField()
+    ends_at = serializers.DateTimeField(required=False, allow_null=True)
+    space_id = serializers.IntegerField(required=False, allow_null=True)
+    agent_ids = serializers.ListField(child=serializers.IntegerField())
+
+    validate_name = ContextSerializer.validate_name
+    validate_scheduled = ContextSerializer.validate_scheduled
+    validate_agent_ids = ContextSerializer.validate_agent_ids
+
+    def validate(self, data):
+        if data.get('ends_at') is None:
+            data['ends_at'] = data['scheduled'] + DEFAULT_CONTEXT_DURATION
+        if data['ends_at'] <= data['scheduled']:
+            raise serializers.ValidationError({'ends_at': "End must be after the scheduled start"})
         return data
 
 class RelationshipSerializer(serializers.ModelSerializer):
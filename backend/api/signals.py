@@ -1,25 +1,40 @@
 """
 This module listens for model changes and logs field-level updates.
+It also keeps the communication nodes' context multicast subscriptions in sync with Context.agents
+and bumps the response cache versions (see api.caching) whenever cached data changes.
 """
 
 import logging
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
+from mqtt_backend.comm_node_manager import CommNodeManager
 from .models import Agent, Space, Context, Relationship
+from .caching import bump_version
+from .tiered_cache import agent_names, agents_by_username
+from .graph_index import edge_changed, edges_added
+from users.models import CustomUser, AgentProfile
 
 db_logger = logging.getLogger('db_logger')
 
+# Fields whose changes are written to the audit log, per model
+LOGGED_FIELDS = {
+    Agent: ['name', 'is_archived'],
+    Space: ['name', 'capacity', 'is_archived'],
+    Context: ['name', 'scheduled', 'space', 'is_archived', 'recurrence_rule'],
+    Relationship: ['agent_from', 'agent_to', 'description'],
+}
+
 def format_related_agent(value):
     # If value is an Agent instance, format name and id
     if isinstance(value, Agent):
         return f"{value.name} (ID {value.id})"
-    # If value is a primary key (int), try to fetch Agent
+    # If value is a primary key (int), look the name up through the two-tier cache
     if isinstance(value, int):
-        try:
-            agent = Agent.objects.get(id=value)
-            return f"{agent.name} (ID {agent.id})"
-        except Agent.DoesNotExist:
+        name = agent_names.get(value, lambda: Agent.objects.filter(id=value).values_list('name', flat=True).first())
+        if name is None:
             return f"Agent ID {value} (not found)"
+        return f"{name} (ID {value})"
     return str(value)
 
 def get_changes(old, new, fields):
@@ -28,10 +43,15 @@ def get_changes(old, new, fields):
     """
     changes = []
     for field in fields:
-        old_val = getattr(old, field, None) 
-        new_val = getattr(new, field, None) 
+        # Special handling for Relationship foreign keys: compare IDs and format them through the
+        # agent name cache instead of loading both related agents
+        if field in ['agent_from', 'agent_to']:
+            old_val = getattr(old, f"{field}_id", None)
+            new_val = getattr(new, f"{field}_id", None)
+        else:
+            old_val = getattr(old, field, None)
+            new_val = getattr(new, field, None)
 
-        # Special handling for Relationship foreign keys
         if field in ['agent_from', 'agent_to']:
             old_val_str = format_related_agent(old_val)
             new_val_str = format_related_agent(new_val)
@@ -52,7 +72,7 @@ def log_agent_changes(sender, instance, **kwargs):
     if not instance.pk:
         return
     old = Agent.objects.get(pk=instance.pk)
-    changes = get_changes(old, instance, ['name', 'is_archived'])
+    changes = get_changes(old, instance, LOGGED_FIELDS[Agent])
     if changes:
         db_logger.info(f"Agent ID {instance.pk} was updated | Changes: " + "; ".join(changes))
 
@@ -64,7 +84,7 @@ def log_space_changes(sender, instance, **kwargs):
     if not instance.pk:
         return
     old = Space.objects.get(pk=instance.pk)
-    changes = get_changes(old, instance, ['name', 'capacity', 'is_archived'])
+    changes = get_changes(old, instance, LOGGED_FIELDS[Space])
     if changes:
         db_logger.info(f"Space ID {instance.pk} was updated | Changes: " + "; ".join(changes))
 
@@ -76,7 +96,7 @@ def log_context_changes(sender, instance, **kwargs):
     if not instance.pk:
         return
     old = Context.objects.get(pk=instance.pk)
-    changes = get_changes(old, instance, ['name', 'scheduled', 'space', 'is_archived'])
+    changes = get_changes(old, instance, LOGGED_FIELDS[Context])
     if changes:
         db_logger.info(f"Context ID {instance.pk} was updated | Changes: " + "; ".join(changes))
 
@@ -88,6 +108,219 @@ def log_relationship_changes(sender, instance, **kwargs):
     if not instance.pk:
         return
     old = Relationship.objects.get(pk=instance.pk)
-    changes = get_changes(old, instance, ['agent_from', 'agent_to', 'description'])
+    instance._previous_pair = (old.agent_from_id, old.agent_to_id)  # see update_graph_index_on_save
+    changes = get_changes(old, instance, LOGGED_FIELDS[Relationship])
     if changes:
         db_logger.info(f"Relationship ID {instance.pk} was updated | Changes: " + "; ".join(changes))
+
+@receiver(m2m_changed, sender=Context.agents.through)
+def sync_context_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to (un)subscribe agents' comm nodes to a context's multicast topic
+    whenever Context.agents changes (from either side of the relation).
+    """
+    if action == "pre_clear":
+        # pk_set is not provided for clears, so remember the current members before they are removed
+        if reverse:
+            instance._cleared_memberships = [(instance.pk, c) for c in instance.contexts.values_list('id', flat=True)]
+        else:
+            instance._cleared_memberships = [(a, instance.pk) for a in instance.agents.values_list('id', flat=True)]
+        return
+    if action == "post_clear":
+        pairs = getattr(instance, '_cleared_memberships', [])
+        join = False
+    elif action in ("post_add", "post_remove"):
+        pairs = [(instance.pk, pk) if reverse else (pk, instance.pk) for pk in (pk_set or ())]
+        join = action == "post_add"
+    else:
+        return
+
+    def apply():
+        for agent_id, context_id in pairs:
+            if join:
+                CommNodeManager.join_context(agent_id, context_id)
+            else:
+                CommNodeManager.leave_context(agent_id, context_id)
+    transaction.on_commit(apply)
+
+@receiver(pre_delete, sender=Context)
+def leave_deleted_context(sender, instance, **kwargs):
+    """
+    Signal handler to unsubscribe all members of a context that is being deleted
+    (cascade deletes of the M2M rows do not send m2m_changed).
+    """
+    agent_ids = list(instance.agents.values_list('id', flat=True))
+    context_id = instance.pk
+    transaction.on_commit(lambda: [CommNodeManager.leave_context(a, context_id) for a in agent_ids])
+
+def invalidate_cached(model, pks=(None,)):
+    """
+    Bump the cache versions of a model (and objects) now and again after commit, so that
+    a response cached from the old rows while the transaction was open is not served later.
+    """
+    def bump():
+        for pk in pks:
+            bump_version(model, pk)
+    bump()
+    transaction.on_commit(bump)
+
+@receiver(post_save, sender=Agent)
+@receiver(post_save, sender=Space)
+@receiver(post_save, sender=Context)
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Agent)
+@receiver(post_delete, sender=Space)
+@receiver(post_delete, sender=Context)
+@receiver(post_delete, sender=Relationship)
+def invalidate_cached_responses(sender, instance, **kwargs):
+    """
+    Signal handler to invalidate cached API responses of a saved or deleted object.
+    """
+    invalidate_cached(sender, [instance.pk])
+
+@receiver(m2m_changed, sender=Context.agents.through)
+def invalidate_cached_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to invalidate cached contexts whose agents changed.
+    """
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        context_ids = [instance.pk]
+    elif action == "post_clear":
+        # remembered by sync_context_memberships on pre_clear
+        context_ids = [c for _, c in getattr(instance, '_cleared_memberships', [])] or [None]
+    else:
+        context_ids = list(pk_set or ())
+    invalidate_cached(Context, context_ids)
+
+def contexts_bulk_created(memberships):
+    """
+    Do for contexts inserted with bulk_create what post_save and m2m_changed would have done:
+    invalidate cached context responses and, after commit, subscribe the members' comm nodes.
+    memberships: (agent_id, context_id) pairs of the new contexts.
+    """
+    invalidate_cached(Context)
+    transaction.on_commit(lambda: [CommNodeManager.join_context(a, c) for a, c in memberships])
+
+def objects_bulk_written(model, objects, old_objects=None):
+    """
+    Do for rows written with bulk_create or bulk_update what the save signals would have done:
+    log the changes of updated rows (old_objects maps their pks to the rows before the update)
+    and invalidate cached responses and agent lookups.
+    """
+    for obj in objects if old_objects else ():
+        changes = get_changes(old_objects[obj.pk], obj, LOGGED_FIELDS[model])
+        if changes:
+            db_logger.info(f"{model.__name__} ID {obj.pk} was updated | Changes: " + "; ".join(changes))
+    pks = [obj.pk for obj in objects]
+    invalidate_cached(model, [None] + pks)
+    if model is Relationship:
+        if old_objects:
+            relationships_redirected([
+                ((old_objects[obj.pk].agent_from_id, old_objects[obj.pk].agent_to_id), (obj.agent_from_id, obj.agent_to_id))
+                for obj in objects
+            ])
+        else:
+            edges_added((obj.agent_from_id, obj.agent_to_id) for obj in objects)
+    if model is Agent:
+        for pk in pks:
+            invalidate_lookup(agent_names, pk)
+        if old_objects:
+            usernames = AgentProfile.objects.filter(agent_object_id__in=pks).values_list('user__username', flat=True)
+            for username in usernames:
+                invalidate_lookup(agents_by_username, username)
+
+def relationships_redirected(changes):
+    """
+    Update the graph index for bulk-updated relationships, given (old pair, new pair) per row.
+    Rows whose agents did not change (e.g. description edits) leave the index alone; old pairs
+    are removed unless another relationship still links the agents (one query for all of them).
+    """
+    moved = [(old, new) for old, new in changes if old != new]
+    if not moved:
+        return
+    old_pairs = {old for old, _ in moved if None not in old}
+    still_linked = set(Relationship.objects.filter(
+        agent_from_id__in={pair[0] for pair in old_pairs},
+        agent_to_id__in={pair[1] for pair in old_pairs},
+    ).values_list('agent_from_id', 'agent_to_id')) if old_pairs else set()
+    for pair in old_pairs - still_linked:
+        edge_changed('remove', *pair)
+    edges_added(new for _, new in moved if None not in new)
+
+def invalidate_lookup(tiered, key):
+    """Drop a tiered cache entry in all processes, now and again after commit."""
+    tiered.invalidate(key)
+    transaction.on_commit(lambda: tiered.invalidate(key))
+
+@receiver(post_save, sender=Agent)
+@receiver(post_delete, sender=Agent)
+def invalidate_agent_lookups(sender, instance, **kwargs):
+    """
+    Signal handler to drop cached names and username lookups of a changed agent.
+    """
+    invalidate_lookup(agent_names, instance.pk)
+    if not kwargs.get('created'):
+        for username in AgentProfile.objects.filter(agent_object_id=instance.pk).values_list('user__username', flat=True):
+            invalidate_lookup(agents_by_username, username)
+
+@receiver(post_save, sender=AgentProfile)
+@receiver(post_delete, sender=AgentProfile)
+def invalidate_agent_profile_lookup(sender, instance, **kwargs):
+    """
+    Signal handler to drop the cached username lookup of a changed agent profile.
+    """
+    invalidate_cached(AgentProfile)
+    try:
+        invalidate_lookup(agents_by_username, instance.user.username)
+    except CustomUser.DoesNotExist:
+        pass  # user deleted in the same cascade, handled by invalidate_deleted_user_lookup
+
+@receiver(pre_save, sender=CustomUser)
+def invalidate_renamed_user_lookup(sender, instance, **kwargs):
+    """
+    Signal handler to drop the cached lookup of a user's old username when it changes.
+    """
+    if not instance.pk:
+        return
+    old_username = CustomUser.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+    if old_username and old_username != instance.username:
+        invalidate_lookup(agents_by_username, old_username)
+        invalidate_cached(AgentProfile)  # the agent directory is keyed by username
+
+@receiver(post_delete, sender=CustomUser)
+def invalidate_deleted_user_lookup(sender, instance, **kwargs):
+    """
+    Signal handler to drop the cached lookup of a deleted user.
+    """
+    invalidate_lookup(agents_by_username, instance.username)
+
+def _edge_removed(agent_from_id, agent_to_id):
+    """Remove a pair from the graph index unless another relationship still links the agents."""
+    if agent_from_id is None or agent_to_id is None:
+        return
+    if not Relationship.objects.filter(agent_from_id=agent_from_id, agent_to_id=agent_to_id).exists():
+        edge_changed('remove', agent_from_id, agent_to_id)
+
+@receiver(post_save, sender=Relationship)
+def update_graph_index_on_save(sender, instance, created, **kwargs):
+    """
+    Signal handler to add a new or redirected relationship to the graph index (see api.graph_index).
+    """
+    pair = (instance.agent_from_id, instance.agent_to_id)
+    previous = getattr(instance, '_previous_pair', None)
+    if not created and previous == pair:
+        return
+    if previous is not None:
+        _edge_removed(*previous)
+    if None not in pair:
+        edge_changed('add', *pair)
+    instance._previous_pair = pair
+
+@receiver(post_delete, sender=Relationship)
+def update_graph_index_on_delete(sender, instance, **kwargs):
+    """
+    Signal handler to remove a deleted relationship from the graph index.
+    """
+    _edge_removed(instance.agent_from_id, instance.agent_to_id)
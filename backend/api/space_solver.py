@@ -0,0 +1,260 @@
+"""
+This module assigns spaces to contexts automatically.
+
+The solver works on plain data so it can run (and be benchmarked) without the database:
+
+- contexts: (context_id, start, end, size) tuples, size being the number of agents
+- capacities: {space_id: capacity}
+- bookings: {space_id: [(start, end), ...]} intervals that are already taken and cannot move
+- current: {context_id: space_id} the spaces contexts already have, if any
+
+It first runs a greedy interval colouring in start order, giving each context the smallest free
+space that is large enough (best fit). Within the time budget a local search then places contexts
+the greedy pass left over by moving the contexts blocking them to other spaces, and finally moves
+contexts into smaller free spaces to reduce wasted capacity. Whatever has been found when the
+budget runs out is returned, after contexts left over get their current space back where it is
+still free.
+
+assign_spaces() loads the contexts of a time window from the database, runs the solver and
+optionally saves the result.
+"""
+
+import time
+from bisect import bisect_left, insort
+from django.db import transaction
+from django.db.models import Count, Q
+from .models import Context, Space
+from .scheduling import merge_intervals, sweep_conflicts, busy_in_window, busy_rows
+from .signals import invalidate_cached
+
+
+class SpaceSchedule:
+    """The non-overlapping bookings of one space, sorted by start."""
+
+    def __init__(self, capacity, bookings=()):
+        self.capacity = capacity
+        self.entries = [(start, end, None) for start, end in merge_intervals(bookings)]
+        self.starts = [entry[0] for entry in self.entries]
+
+    def blockers(self, start, end):
+        """Return the entries overlapping [start, end); context_id is None for fixed bookings."""
+        i = bisect_left(self.starts, end)
+        found = []
+        while i > 0 and self.entries[i - 1][1] > start:
+            i -= 1
+            found.append(self.entries[i])
+        return found
+
+    def is_free(self, start, end):
+        i = bisect_left(self.starts, end)
+        return i == 0 or self.entries[i - 1][1] <= start
+
+    def add(self, start, end, context_id):
+        insort(self.entries, (start, end, context_id), key=lambda entry: entry[0])
+        self.starts.insert(bisect_left(self.starts, start), start)
+
+    def remove(self, start, end, context_id):
+        i = self.entries.index((start, end, context_id))
+        del self.entries[i]
+        del self.starts[i]
+
+
+class SpaceSolver:
+    def __init__(self, contexts, capacities, bookings=None, time_budget=2.0, local_search=True, current=None):
+        self.contexts = {context_id: (start, end, size) for context_id, start, end, size in contexts}
+        self.schedules = {
+            space_id: SpaceSchedule(capacity, (bookings or {}).get(space_id, ()))
+            for space_id, capacity in capacities.items()
+        }
+        # Best fit: the smallest sufficient space comes first
+        self.by_capacity = sorted(capacities, key=lambda space_id: (capacities[space_id], space_id))
+        self.time_budget = time_budget
+        self.local_search = local_search
+        self.current = current or {}
+        self.assignment = {}
+        self.stats = {'greedy_assigned': 0, 'relocations': 0, 'downsized': 0, 'kept': 0, 'timed_out': False}
+
+    def _out_of_time(self):
+        if time.perf_counter() - self.started >= self.time_budget:
+            self.stats['timed_out'] = True
+            return True
+        return False
+
+    def _fitting_spaces(self, size, exclude=None):
+        return [s for s in self.by_capacity if self.schedules[s].capacity >= size and s != exclude]
+
+    def _place(self, context_id, space_id):
+        start, end, _ = self.contexts[context_id]
+        self.schedules[space_id].add(start, end, context_id)
+        self.assignment[context_id] = space_id
+
+    def _unplace(self, context_id):
+        start, end, _ = self.contexts[context_id]
+        self.schedules[self.assignment.pop(context_id)].remove(start, end, context_id)
+
+    def _first_free(self, context_id, exclude=None):
+        start, end, size = self.contexts[context_id]
+        for space_id in self._fitting_spaces(size, exclude):
+            if self.schedules[space_id].is_free(start, end):
+                return space_id
+        return None
+
+    def _greedy(self):
+        for context_id in sorted(self.contexts, key=lambda c: (self.contexts[c][0], -self.contexts[c][2], c)):
+            if self._out_of_time():
+                break
+            space_id = self._first_free(context_id)
+            if space_id is not None:
+                self._place(context_id, space_id)
+        self.stats['greedy_assigned'] = len(self.assignment)
+
+    def _relocate_for(self, context_id, max_blockers=2):
+        """Place a context by moving the few contexts that block it in some space elsewhere."""
+        start, end, size = self.contexts[context_id]
+        for space_id in self._fitting_spaces(size):
+            blockers = self.schedules[space_id].blockers(start, end)
+            if len(blockers) > max_blockers or any(entry[2] is None for entry in blockers):
+                continue
+            moved = []
+            for _, _, blocker in blockers:
+                self._unplace(blocker)
+                target = self._first_free(blocker, exclude=space_id)
+                if target is None:
+                    self._place(blocker, space_id)
+                    break
+                self._place(blocker, target)
+                moved.append(blocker)
+            else:
+                self._place(context_id, space_id)
+                self.stats['relocations'] += len(moved)
+                return True
+            for blocker in moved:  # undo the partial move
+                self._unplace(blocker)
+                self._place(blocker, space_id)
+        return False
+
+    def _local_search(self):
+        improved = True
+        while improved:
+            improved = False
+            for context_id in sorted(c for c in self.contexts if c not in self.assignment):
+                if self._out_of_time():
+                    return
+                if self._relocate_for(context_id):
+                    improved = True
+
+    def _downsize(self):
+        for context_id in sorted(self.assignment):
+            if self._out_of_time():
+                return
+            current = self.assignment[context_id]
+            space_id = self._first_free(context_id, exclude=current)
+            if space_id is not None and self.schedules[space_id].capacity < self.schedules[current].capacity:
+                self._unplace(context_id)
+                self._place(context_id, space_id)
+                self.stats['downsized'] += 1
+
+    def _keep_current(self):
+        """Give contexts the passes left unplaced their current space back if it is still free."""
+        for context_id, space_id in sorted(self.current.items()):
+            if context_id in self.assignment or context_id not in self.contexts or space_id not in self.schedules:
+                continue
+            start, end, _ = self.contexts[context_id]
+            if self.schedules[space_id].is_free(start, end):
+                self._place(context_id, space_id)
+                self.stats['kept'] += 1
+
+    def solve(self):
+        """Return {context_id: space_id} for every context that could be placed."""
+        self.started = time.perf_counter()
+        self._greedy()
+        if self.local_search:
+            self._local_search()
+            self._downsize()
+        self._keep_current()  # not bound by the time budget, it is a single pass
+        self.stats['elapsed_ms'] = round((time.perf_counter() - self.started) * 1000, 2)
+        self.stats['assigned'] = len(self.assignment)
+        self.stats['unassigned'] = len(self.contexts) - len(self.assignment)
+        self.stats['wasted_capacity'] = sum(
+            self.schedules[space_id].capacity - self.contexts[context_id][2]
+            for context_id, space_id in self.assignment.items()
+        )
+        return self.assignment
+
+
+def solve_space_assignment(contexts, capacities, bookings=None, time_budget=2.0, current=None):
+    """Run the solver; returns (assignment, stats)."""
+    solver = SpaceSolver(contexts, capacities, bookings, time_budget, current=current)
+    return solver.solve(), solver.stats
+
+
+def _agent_clashes(context_ids, window_start, window_end):
+    """IDs of the given contexts that share an agent with an overlapping context or occurrence."""
+    Through = Context.agents.through
+    agents = Through.objects.filter(context_id__in=context_ids).values('agent_id')
+    rows = busy_rows(Through.objects.filter(agent_id__in=agents), 'context__', window_start, window_end, 'agent_id')
+    contexts = {}
+    for row in rows:
+        key = (row['context_id'], row['context__scheduled'])  # occurrences of a series share the id
+        contexts.setdefault(key, [row['context__ends_at'], set()])[1].add(row['agent_id'])
+    clashing = set()
+    for first, second, _ in sweep_conflicts((key[1], end, key, agents) for key, (end, agents) in contexts.items()):
+        clashing.update((first[0], second[0]))
+    return clashing & set(context_ids)
+
+
+def assign_spaces(window_start, window_end, context_ids=(), space_ids=None, time_budget=2.0, commit=False):
+    """
+    Assign spaces to the non-archived contexts overlapping the window that have no space, plus the
+    given context_ids (flexible contexts whose current space may change). Contexts of other spaces
+    and recurring contexts stay where they are. Contexts that clash with another context through a shared agent are left
+    alone, as no space can fix that; their current spaces count as bookings. Returns a dict with assignments
+    ({context_id: space_id}), unassigned, agent_conflicts and stats. Flexible contexts the solver cannot
+    place (e.g. when the time budget runs out) keep their current space if it is still free. With
+    commit the assignments are saved; unassigned contexts lose their space only if it was given to
+    another context.
+    """
+    flexible = list(
+        busy_in_window(Context.objects.filter(recurrence_rule=''), '', window_start, window_end)
+        .filter(Q(space__isnull=True) | Q(pk__in=list(context_ids)))
+        .annotate(size=Count('agents'))
+        .values_list('id', 'scheduled', 'ends_at', 'size', 'space_id')
+    )
+    spaces = Space.objects.filter(is_archived=False)
+    if space_ids is not None:
+        spaces = spaces.filter(pk__in=space_ids)
+    capacities = dict(spaces.values_list('id', 'capacity'))
+    if not flexible:
+        return {'assignments': {}, 'unassigned': [], 'agent_conflicts': [], 'stats': {}}
+
+    flexible_ids = [row[0] for row in flexible]
+    span_start = min(row[1] for row in flexible)
+    span_end = max(row[2] for row in flexible)
+    clashing = _agent_clashes(flexible_ids, span_start, span_end)
+    solvable = [row[:4] for row in flexible if row[0] not in clashing]
+    solvable_ids = [row[0] for row in solvable]
+    current = {row[0]: row[4] for row in flexible if row[0] not in clashing and row[4] is not None}
+
+    bookings = {}
+    booked = Context.objects.filter(space_id__in=capacities).exclude(pk__in=solvable_ids)
+    for row in busy_rows(booked, '', span_start, span_end, 'space_id'):
+        bookings.setdefault(row['space_id'], []).append((row['scheduled'], row['ends_at']))
+
+    assignment, stats = solve_space_assignment(solvable, capacities, bookings, time_budget, current)
+
+    if commit:
+        # Unplaced contexts in spaces outside space_ids are untouched; the solver never used those spaces
+        moved = [pk for pk in solvable_ids if pk in assignment or current.get(pk) in capacities]
+        with transaction.atomic():
+            # Clear first so that swapping two contexts never trips the Postgres exclusion constraint;
+            # unplaced contexts whose space was given to another context are left without one
+            Context.objects.filter(pk__in=moved).update(space=None)
+            Context.objects.bulk_update(
+                [Context(pk=pk, space_id=space_id) for pk, space_id in assignment.items()], ['space'])
+            invalidate_cached(Context, [None] + solvable_ids)  # update() and bulk_update() send no signals
+    return {
+        'assignments': assignment,
+        'unassigned': sorted(pk for pk, *_ in solvable if pk not in assignment),
+        'agent_conflicts': sorted(clashing),
+        'stats': stats,
+    }
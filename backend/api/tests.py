@@ -1,13 +1,53 @@
 # backend/api/tests.py
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework.test import APITestCase
 from rest_framework import status
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
+from django.utils.dateparse import parse_datetime
 from .models import Agent, Space, Context, Relationship
-from users.models import AdminProfile
+from users.models import AdminProfile, AgentProfile
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.apps import apps as django_apps
+from .pagination import estimate_count
+from .scheduling import (
+    find_agent_conflicts, find_space_conflicts, context_tree, merge_intervals, free_gaps, intersect_gaps
+)
+from .interval_tree import IntervalTree
+from .space_solver import solve_space_assignment
+from .recurrence import RecurrenceRule
+from .relationship_import import import_relationships
+from .tiered_cache import TieredCache, LRUCache, agents_by_username
+from . import caching, graph_index
+from .graph_index import GraphIndex
+from mqtt_backend.core import buffer as outbound_buffer
+from mqtt_backend.core.dispatcher import CONTEXT_TOPIC, Dispatcher
+from mqtt_backend.remote.api_client import AgentDirectory, ApiClient, ApiError
+from mqtt_backend import sharding
+from mqtt_backend.sharding import CommShard, HashRing
+from mqtt_backend.remote.spool import HEADER, Spool
+from mqtt_backend.core.buffer import RedisListBuffer, RedisStreamBuffer, classify, dead_letters, eviction_stats
+import importlib
+import base64
+import io
 import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+try:
+    import fakeredis
+except ImportError:  # test-only dependency
+    fakeredis = None
 
 User = get_user_model()
 
@@ -694,4 +734,1927 @@ class PermissionTest(BaseAPITest):
             '/api/spaces/',
             '/api/contexts/',
             '/api/relationships/'
-        ]
\ No newline at end of file
+        ]
+
+
+class BaseSchemaAPITest(APITestCase):
+    """Base test class with fixtures matching the current models (no access levels)"""
+
+    def setUp(self):
+        self.admin_user = User.objects.create_user(
+            username='admin',
+            password='testpass123',
+            role='admin'
+        )
+        self.client.force_authenticate(user=self.admin_user)
+
+        self.agent1 = Agent.objects.create(name='Dr. Smith')
+        self.agent2 = Agent.objects.create(name='Dr. Johnson')
+        self.agent3 = Agent.objects.create(name='Nurse Williams')
+        self.space1 = Space.objects.create(name='Operating Room 1', capacity=5)
+        self.context1 = Context.objects.create(
+            name='Morning Surgery Session',
+            scheduled=timezone.now() + timedelta(days=1),
+            space=self.space1
+        )
+        self.context1.agents.add(self.agent1, self.agent2)
+
+
+class ContextMulticastTest(BaseSchemaAPITest):
+    """Test context multicast messaging and membership sync"""
+
+    def test_notify_publishes_once_to_context(self):
+        """Test that notifying a context sends a single multicast"""
+        url = f'/api/contexts/{self.context1.id}/notify/'
+        data = {'agent_id': self.agent1.id, 'protocol': 'HL7', 'type': 'alert', 'payload': 'ping'}
+        with mock.patch('api.views.CommNodeManager.send_context_message') as send:
+            response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['recipients'], 2)
+        send.assert_called_once_with(self.agent1.id, self.context1.id, 'HL7', 'alert', 'ping')
+
+    def test_notify_requires_sender(self):
+        """Test that a sender agent is required"""
+        url = f'/api/contexts/{self.context1.id}/notify/'
+        response = self.client.post(url, {'protocol': 'HL7', 'payload': 'ping'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_membership_changes_update_subscriptions(self):
+        """Test that adding/removing agents joins/leaves the context topic"""
+        with mock.patch('api.signals.CommNodeManager') as manager:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.context1.agents.add(self.agent3)
+            manager.join_context.assert_called_once_with(self.agent3.id, self.context1.id)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.agent1.contexts.remove(self.context1)
+            manager.leave_context.assert_called_once_with(self.agent1.id, self.context1.id)
+
+
+class AgentResolveTest(BaseSchemaAPITest):
+    """Test bulk username to agent ID resolution"""
+
+    def setUp(self):
+        super().setUp()
+        for username, agent in (('doctor-1', self.agent1), ('doctor-2', self.agent2)):
+            user = User.objects.create_user(username=username, password='testpass123', role='agent')
+            AgentProfile.objects.create(user=user, agent_object=agent)
+
+    def test_resolve_many_usernames(self):
+        """Test that all known usernames are resolved and unknown ones reported"""
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/agents/resolve/',
+                                        {'usernames': ['doctor-1', 'doctor-2', 'nobody']}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['agents']['doctor-1']['agent_id'], self.agent1.id)
+        self.assertEqual(response.data['agents']['doctor-2']['agent_name'], 'Dr. Johnson')
+        self.assertEqual(response.data['missing'], ['nobody'])
+
+    def test_resolve_skips_archived_agents(self):
+        """Test that archived agents are reported as missing"""
+        self.agent2.is_archived = True
+        self.agent2.save()
+        response = self.client.get('/api/agents/resolve/?usernames=doctor-1,doctor-2')
+        self.assertEqual(list(response.data['agents']), ['doctor-1'])
+        self.assertEqual(response.data['missing'], ['doctor-2'])
+
+    def test_resolve_conditional_request(self):
+        """Test that an unchanged directory is revalidated with a 304"""
+        url = '/api/agents/resolve/?usernames=doctor-1,doctor-2'
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.agent1.name = 'Dr. Smith Jr.'
+        self.agent1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Renaming a user changes the directory without touching the agents
+        user = User.objects.get(username='doctor-2')
+        user.username = 'doctor-3'
+        user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['missing'], ['doctor-2'])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_resolve_requires_usernames(self):
+        """Test that an empty request is rejected"""
+        response = self.client.get('/api/agents/resolve/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/agents/resolve/', ['doctor-1'], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ResponseCacheTest(BaseSchemaAPITest):
+    """Test response caching and signal-driven invalidation"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @override_settings(API_CACHE_TTL=120)
+    def test_object_versions_expire(self):
+        """Test that per-object version keys get a TTL while model-wide ones are permanent"""
+        with mock.patch('api.caching.cache') as fake_cache:
+            fake_cache.get_many.return_value = {}
+            fake_cache.get.return_value = 1
+            caching.get_versions([caching._version_key(Agent), caching._version_key(Agent, 'no-such-pk')])
+            self.assertEqual([c.kwargs['timeout'] for c in fake_cache.add.call_args_list], [None, 120])
+
+            caching.bump_version(Agent, 5)
+            self.assertEqual([c.kwargs['timeout'] for c in fake_cache.set.call_args_list], [None, 120])
+
+    def test_repeated_list_is_served_from_cache(self):
+        """Test that a repeated list request does not hit the database"""
+        first = self.client.get('/api/agents/')
+        self.assertEqual(first['X-Cache'], 'MISS')
+
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/agents/')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+
+    def test_query_params_are_part_of_the_key(self):
+        """Test that different filters are cached separately"""
+        self.client.get('/api/agents/?search=Smith')
+        response = self.client.get('/api/agents/?search=Johnson')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['name'], 'Dr. Johnson')
+
+    def test_nested_model_change_invalidates_contexts(self):
+        """Test that renaming an agent invalidates cached contexts listing it"""
+        self.client.get('/api/contexts/')
+        self.agent1.name = 'Dr. Smithson'
+        self.agent1.save()
+
+        response = self.client.get('/api/contexts/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        names = [a['name'] for a in response.data['results'][0]['agents_detail']]
+        self.assertIn('Dr. Smithson', names)
+
+    def test_membership_change_invalidates_context(self):
+        """Test that adding an agent invalidates the cached context"""
+        url = f'/api/contexts/{self.context1.id}/'
+        self.client.get(url)
+        self.context1.agents.add(self.agent3)
+
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn(self.agent3.id, response.data['agents'])
+
+    def test_update_keeps_other_objects_cached(self):
+        """Test that updating one space does not evict another space"""
+        space2 = Space.objects.create(name='Operating Room 2', capacity=3)
+        self.client.get(f'/api/spaces/{space2.id}/')
+        self.client.get(f'/api/spaces/{self.space1.id}/')
+        self.space1.capacity = 6
+        self.space1.save()
+
+        self.assertEqual(self.client.get(f'/api/spaces/{space2.id}/')['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get(f'/api/spaces/{self.space1.id}/')['X-Cache'], 'MISS')
+
+    def test_cache_stats(self):
+        """Test that hits and misses are reported"""
+        self.client.get('/api/spaces/')
+        self.client.get('/api/spaces/')
+        response = self.client.get('/api/cache/stats/')
+        self.assertEqual(response.data['responses']['api.space'], {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+
+class TieredCacheTest(BaseSchemaAPITest):
+    """Test the two-tier lookup cache used for agent names and usernames"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for tiered in TieredCache.registry.values():
+            tiered.local.clear()
+        user = User.objects.create_user(username='doctor-1', password='testpass123', role='agent')
+        AgentProfile.objects.create(user=user, agent_object=self.agent1)
+
+    def test_lookup_falls_through_tiers(self):
+        """Test that repeated lookups are served locally, then from Redis after a local eviction"""
+        url = '/api/agents/by-username/doctor-1/'
+        self.assertEqual(self.client.get(url).data['agent_id'], self.agent1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['agent_name'], 'Dr. Smith')
+
+        agents_by_username.local.clear()
+        before = dict(agents_by_username.counters)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.assertEqual(agents_by_username.counters['redis_hits'], before['redis_hits'] + 1)
+
+    def test_agent_change_invalidates_lookup(self):
+        """Test that renaming or archiving an agent is visible immediately"""
+        url = '/api/agents/by-username/doctor-1/'
+        self.client.get(url)
+        self.agent1.name = 'Dr. Smithson'
+        self.agent1.save()
+        self.assertEqual(self.client.get(url).data['agent_name'], 'Dr. Smithson')
+
+        self.agent1.is_archived = True
+        self.agent1.save()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_lru_evicts_least_recently_used(self):
+        """Test that the local tier is size-bounded"""
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual((lru.get('a'), lru.get('c')), (1, 3))
+
+
+class ConditionalRequestTest(BaseSchemaAPITest):
+    """Test ETag/Last-Modified validators and 304 responses"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_if_none_match_returns_304_without_queries(self):
+        """Test that an unchanged list is revalidated without touching the database"""
+        etag = self.client.get('/api/contexts/')['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/contexts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_change_produces_new_etag(self):
+        """Test that a write invalidates the validator"""
+        url = f'/api/agents/{self.agent1.id}/'
+        etag = self.client.get(url)['ETag']
+        self.agent1.name = 'Dr. Smithson'
+        self.agent1.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['name'], 'Dr. Smithson')
+
+    def test_etag_depends_on_query_params(self):
+        """Test that another filter of the same list is not revalidated by a foreign ETag"""
+        etag = self.client.get('/api/agents/?search=Smith')['ETag']
+        response = self.client.get('/api/agents/?search=Johnson', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_none_match_star_requires_existing_object(self):
+        """Test that If-None-Match: * only answers 304 for objects that exist"""
+        response = self.client.get(f'/api/agents/{self.agent1.id}/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        missing = self.client.get('/api/agents/999999/')
+        response = self.client.get('/api/agents/999999/', HTTP_IF_NONE_MATCH='*')
+        self.assertNotEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual((response.status_code, response.data), (missing.status_code, missing.data))
+        response = self.client.get('/api/agents/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_if_modified_since(self):
+        """Test that Last-Modified can be used for revalidation"""
+        last_modified = self.client.get('/api/spaces/')['Last-Modified']
+        response = self.client.get('/api/spaces/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class KeysetPaginationTest(BaseSchemaAPITest):
+    """Test opt-in keyset (cursor) pagination"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for i in range(7):
+            Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2, description=f'Link {i}')
+
+    def _walk(self, url):
+        names, previous = [], None
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            names.extend(r['description'] for r in response.data['results'])
+            url, previous = response.data['next'], response.data['previous']
+        return names, previous
+
+    def test_cursor_walk_matches_full_ordering(self):
+        """Test that following next links visits every row once in order"""
+        names, previous = self._walk('/api/relationships/?cursor=&page_size=3')
+        expected = list(Relationship.objects.order_by('-created_at', '-id').values_list('description', flat=True))
+        self.assertEqual(names, expected)
+        self.assertIsNotNone(previous)
+
+    def test_previous_link_returns_preceding_page(self):
+        """Test that the previous cursor of page 2 yields page 1"""
+        first = self.client.get('/api/relationships/?cursor=&page_size=3').data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual(back['results'], first['results'])
+
+    def test_contexts_page_by_schedule(self):
+        """Test that contexts use the (scheduled, id) keyset"""
+        later = Context.objects.create(name='Evening Surgery Session', scheduled=timezone.now() + timedelta(days=2),
+                                       space=self.space1)
+        response = self.client.get('/api/contexts/?cursor=&page_size=1')
+        self.assertEqual(response.data['results'][0]['id'], self.context1.id)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['id'], later.id)
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        """Test that a tampered cursor is rejected"""
+        response = self.client.get('/api/relationships/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', response.data)
+
+    def test_page_numbers_still_default(self):
+        """Test that requests without a cursor keep page-number pagination"""
+        response = self.client.get('/api/relationships/?page=2&page_size=5')
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual(len(response.data['results']), 2)
+
+
+class ApproximateCountTest(BaseSchemaAPITest):
+    """Test planner-estimated counts for relationship pages"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for i in range(5):
+            Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2, description=f'Link {i}')
+
+    def test_small_tables_keep_exact_counts(self):
+        """Test that counts below the threshold are exact"""
+        with mock.patch('api.pagination.estimate_count', return_value=10):
+            response = self.client.get('/api/relationships/')
+        self.assertEqual(response.data['count'], 5)
+        self.assertFalse(response.data['count_is_approximate'])
+
+    @mock.patch('api.pagination.estimate_count', return_value=250000)
+    def test_large_tables_use_estimate(self, estimate):
+        """Test that the planner estimate replaces COUNT(*) above the threshold"""
+        with self.settings(API_APPROXIMATE_COUNT_THRESHOLD=1000), self.assertNumQueries(1):
+            response = self.client.get('/api/relationships/?page_size=2')
+        self.assertEqual(response.data['count'], 250000)
+        self.assertTrue(response.data['count_is_approximate'])
+        self.assertEqual(len(response.data['results']), 2)
+
+    @mock.patch('api.pagination.estimate_count', return_value=2)
+    def test_underestimate_does_not_truncate_pages(self, estimate):
+        """Test that pages beyond a too-low estimate are still served"""
+        with self.settings(API_APPROXIMATE_COUNT_THRESHOLD=1):
+            response = self.client.get('/api/relationships/?page=2&page_size=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_estimate_unavailable_without_postgres(self):
+        """Test that other databases fall back to exact counts"""
+        self.assertIsNone(estimate_count(Relationship.objects.all()))
+
+
+class ContextQueryCountTest(BaseSchemaAPITest):
+    """Test that context responses use a constant number of queries"""
+
+    def setUp(self):
+        super().setUp()
+        space2 = Space.objects.create(name='Operating Room 2', capacity=5)
+        for i in range(12):
+            context = Context.objects.create(
+                name=f'Ward Round {i}',
+                scheduled=timezone.now() + timedelta(days=2, hours=i),
+                space=space2 if i % 2 else self.space1
+            )
+            context.agents.add(self.agent1, self.agent3)
+
+    def _queries_for(self, url):
+        with self.settings(API_CACHE_ENABLED=False), CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_list_query_count_independent_of_page_size(self):
+        """Test that a bigger page does not issue more queries"""
+        small = self._queries_for('/api/contexts/?page_size=2')
+        large = self._queries_for('/api/contexts/?page_size=13')
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 3)  # count, contexts with spaces, agents
+
+    def test_has_availability_query_count(self):
+        """Test that the availability annotation does not add per-row queries"""
+        small = self._queries_for('/api/contexts/?has_availability=true&page_size=2')
+        large = self._queries_for('/api/contexts/?has_availability=true&page_size=13')
+        self.assertEqual(small, large)
+
+    def test_space_contexts_query_count(self):
+        """Test that the contexts of a space are loaded with their relations"""
+        url = f'/api/spaces/{self.space1.id}/contexts/'
+        before = self._queries_for(url)
+        Context.objects.create(name='Extra Round', scheduled=timezone.now() + timedelta(days=3),
+                               space=self.space1).agents.add(self.agent2)
+        self.assertEqual(self._queries_for(url), before)
+
+
+class AgentConflictTest(BaseSchemaAPITest):
+    """Test the set-based agent conflict check"""
+
+    def test_all_conflicting_agents_are_reported(self):
+        """Test that every busy agent is listed, not just the first"""
+        space2 = Space.objects.create(name='Operating Room 2', capacity=5)
+        data = {
+            'name': 'Overlapping Session',
+            'scheduled': (self.context1.scheduled + timedelta(minutes=30)).isoformat(),
+            'space_id': space2.id,
+            'agent_ids': [self.agent1.id, self.agent2.id, self.agent3.id]
+        }
+        data['agents'] = data['agent_ids']
+        response = self.client.post('/api/contexts/', data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = str(response.data)
+        self.assertIn('Dr. Smith', errors)
+        self.assertIn('Dr. Johnson', errors)
+        self.assertNotIn('Nurse Williams', errors)
+
+    def test_conflicts_found_in_one_query(self):
+        """Test that the check costs one query regardless of the number of agents"""
+        agents = [self.agent1, self.agent2, self.agent3]
+        agents += [Agent.objects.create(name=f'Agent {i}') for i in range(20)]
+        context_tree()  # without a range index, the interval tree is loaded once per Context version
+        with self.assertNumQueries(1):
+            conflicts = find_agent_conflicts([a.id for a in agents], self.context1.scheduled, self.context1.ends_at)
+        self.assertEqual({c['agent_id'] for c in conflicts}, {self.agent1.id, self.agent2.id})
+        self.assertEqual({c['context_id'] for c in conflicts}, {self.context1.id})
+
+    def test_context_does_not_conflict_with_itself(self):
+        """Test that an update excludes the context being edited"""
+        conflicts = find_agent_conflicts([self.agent1.id], self.context1.scheduled, self.context1.ends_at,
+                                         exclude_context_id=self.context1.id)
+        self.assertEqual(conflicts, [])
+
+
+class ContextIntervalTest(BaseSchemaAPITest):
+    """Test context durations and interval overlap checks"""
+
+    def test_default_duration(self):
+        """Test that contexts without an end last one hour"""
+        self.assertEqual(self.context1.ends_at - self.context1.scheduled, timedelta(hours=1))
+
+    def test_migration_resolves_backfilled_overlaps(self):
+        """Test the data step of migration 0004 that makes existing contexts fit the exclusion constraint"""
+        migration = importlib.import_module('api.migrations.0004_context_ends_at')
+        start = self.context1.scheduled
+        close = Context.objects.create(name='Close Follow-up', scheduled=start + timedelta(minutes=20), space=self.space1)
+        same = Context.objects.create(name='Same Start', scheduled=start + timedelta(minutes=20), space=self.space1)
+        later = Context.objects.create(name='Later Session', scheduled=start + timedelta(hours=3), space=self.space1)
+
+        migration.resolve_backfilled_overlaps(django_apps, None)
+        for context in (self.context1, close, same, later):
+            context.refresh_from_db()
+        self.assertEqual(self.context1.ends_at, close.scheduled)
+        self.assertEqual(close.ends_at - close.scheduled, timedelta(hours=1))
+        self.assertTrue(same.is_archived)
+        self.assertFalse(later.is_archived)
+        self.assertEqual(later.ends_at - later.scheduled, timedelta(hours=1))
+
+    def test_space_overlap_detected_for_different_starts(self):
+        """Test that overlapping intervals in one space conflict even with different start times"""
+        start = self.context1.scheduled + timedelta(minutes=45)
+        conflicts = find_space_conflicts(self.space1.id, start, start + timedelta(hours=2))
+        self.assertEqual([c.id for c in conflicts], [self.context1.id])
+
+        # Touching intervals are not overlapping
+        after = self.context1.ends_at
+        self.assertEqual(find_space_conflicts(self.space1.id, after, after + timedelta(hours=1)), [])
+
+    def test_long_context_blocks_agents(self):
+        """Test that agent conflicts follow the real duration instead of a fixed window"""
+        self.context1.ends_at = self.context1.scheduled + timedelta(hours=5)
+        self.context1.save()
+        start = self.context1.scheduled + timedelta(hours=4)
+        conflicts = find_agent_conflicts([self.agent1.id], start, start + timedelta(hours=1))
+        self.assertEqual([c['context_id'] for c in conflicts], [self.context1.id])
+
+    def test_archived_contexts_do_not_conflict(self):
+        """Test that archived contexts free their space and agents"""
+        self.context1.is_archived = True
+        self.context1.save()
+        self.assertEqual(find_space_conflicts(self.space1.id, self.context1.scheduled, self.context1.ends_at), [])
+
+    def test_create_rejects_end_before_start(self):
+        """Test that ends_at must be after scheduled"""
+        scheduled = timezone.now() + timedelta(days=3)
+        data = {
+            'name': 'Backwards Session',
+            'scheduled': scheduled.isoformat(),
+            'ends_at': (scheduled - timedelta(hours=1)).isoformat(),
+            'space_id': self.space1.id,
+            'agent_ids': [self.agent3.id],
+            'agents': [self.agent3.id]
+        }
+        response = self.client.post('/api/contexts/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('ends_at', response.data['error'])
+
+    def test_interval_tree_matches_brute_force(self):
+        """Test the interval tree against a linear scan"""
+        intervals = [(start, start + length, i) for i, (start, length) in
+                     enumerate([(0, 10), (5, 3), (8, 20), (12, 1), (30, 5), (2, 40), (50, 1)])]
+        tree = IntervalTree(intervals)
+        for start, end in [(0, 1), (9, 13), (13, 30), (35, 50), (51, 60), (-5, 100)]:
+            expected = sorted(p for s, e, p in intervals if s < end and e > start)
+            self.assertEqual(sorted(tree.overlapping(start, end)), expected)
+
+
+class FreeSlotTest(BaseSchemaAPITest):
+    """Test the free-slot finder"""
+
+    def setUp(self):
+        super().setUp()
+        self.day = (timezone.now() + timedelta(days=5)).replace(hour=8, minute=0, second=0, microsecond=0)
+        busy = Context.objects.create(name='Busy Block', scheduled=self.day, ends_at=self.day + timedelta(hours=2),
+                                      space=self.space1)
+        busy.agents.add(self.agent1)
+        self.url = '/api/contexts/free_slots/'
+
+    def _request(self, **extra):
+        data = {
+            'agent_ids': [self.agent1.id, self.agent2.id],
+            'duration_minutes': 60,
+            'window_start': self.day.isoformat(),
+            'window_end': (self.day + timedelta(hours=6)).isoformat(),
+            **extra
+        }
+        return self.client.post(self.url, data, format='json')
+
+    def test_earliest_slots_after_busy_agents(self):
+        """Test that slots start once every agent is free"""
+        response = self._request(limit=3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        starts = [parse_datetime(str(slot['start'])) for slot in response.data['slots']]
+        expected = [self.day + timedelta(hours=h) for h in (2, 3, 4)]
+        self.assertEqual(starts, expected)
+        self.assertIsNone(response.data['slots'][0]['space_id'])
+
+    def test_slots_with_space_capacity(self):
+        """Test that a free space with enough capacity is assigned, preferring the smallest"""
+        small = Space.objects.create(name='Consultation Room', capacity=2)
+        Context.objects.create(name='Small Room Block', scheduled=self.day + timedelta(hours=2),
+                               ends_at=self.day + timedelta(hours=3), space=small)
+        response = self._request(min_capacity=2, limit=2)
+        slots = response.data['slots']
+        self.assertEqual(parse_datetime(str(slots[0]['start'])), self.day + timedelta(hours=2))
+        self.assertEqual(slots[0]['space_id'], self.space1.id)  # the small room is taken until 11:00
+        self.assertEqual(slots[1]['space_id'], small.id)
+
+    def test_queries_per_resource_type(self):
+        """Test that the search costs one query for agents and two for spaces"""
+        with self.assertNumQueries(3):
+            self._request(min_capacity=1, limit=10)
+
+    def test_invalid_window(self):
+        """Test that a window shorter than the duration is rejected"""
+        response = self._request(duration_minutes=600)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sweep_helpers(self):
+        """Test merging busy intervals and computing free gaps"""
+        busy = merge_intervals([(5, 8), (1, 3), (2, 4), (8, 9)])
+        self.assertEqual(busy, [(1, 4), (5, 9)])
+        self.assertEqual(free_gaps(busy, 0, 12), [(0, 1), (4, 5), (9, 12)])
+        self.assertEqual(intersect_gaps([(0, 5), (7, 10)], [(3, 8)]), [(3, 5), (7, 8)])
+
+
+class ContextBatchTest(BaseSchemaAPITest):
+    """Test batch validation and creation of contexts"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = '/api/contexts/batch/'
+        self.start = self.context1.scheduled + timedelta(days=1)
+        self.space2 = Space.objects.create(name='Operating Room 2', capacity=2)
+
+    def _item(self, name, hours, agents, space=None, duration=1):
+        scheduled = self.start + timedelta(hours=hours)
+        return {
+            'name': name,
+            'scheduled': scheduled.isoformat(),
+            'ends_at': (scheduled + timedelta(hours=duration)).isoformat(),
+            'space_id': space.id if space else None,
+            'agent_ids': [agent.id for agent in agents],
+        }
+
+    def test_dry_run_reports_batch_and_existing_conflicts(self):
+        """Test that conflicts within the batch and with existing contexts are all reported"""
+        contexts = [
+            self._item('First Round', 0, [self.agent1], self.space1),
+            self._item('Second Round', 0.5, [self.agent1, self.agent3], self.space1),  # clashes with item 0
+            {**self._item('Clashing Session', 0, [self.agent2]),
+             'scheduled': self.context1.scheduled.isoformat(),
+             'ends_at': (self.context1.scheduled + timedelta(minutes=30)).isoformat()},
+            self._item('Evening Round', 5, [self.agent3], self.space2),
+        ]
+        response = self.client.post(self.url, {'contexts': contexts, 'dry_run': True}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['accepted'], [3])
+        self.assertEqual(response.data['rejected'], [0, 1, 2])
+        conflicts = {(c['index'], c['resource'], c.get('other_index'), c.get('context_id'))
+                     for c in response.data['conflicts']}
+        self.assertEqual(conflicts, {
+            (1, 'agent', 0, None), (1, 'space', 0, None), (2, 'agent', None, self.context1.id)
+        })
+        self.assertEqual(response.data['created'], [])
+        self.assertEqual(Context.objects.count(), 1)
+
+    def test_commit_creates_accepted_contexts(self):
+        """Test that accepted contexts and their agents are inserted, rejected ones reported"""
+        contexts = [
+            self._item('First Round', 0, [self.agent1, self.agent3], self.space2),
+            self._item('Second Round', 2, [self.agent1], self.space2),
+            self._item('Too Crowded', 4, [self.agent1, self.agent2, self.agent3], self.space2),
+            {'name': 'Bad', 'scheduled': 'tomorrow', 'agent_ids': []},
+        ]
+        with mock.patch('api.signals.CommNodeManager.join_context') as join, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'contexts': contexts}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['rejected'], [2, 3])
+        self.assertEqual([e['index'] for e in response.data['errors']], [2, 3])
+        created = Context.objects.filter(pk__in=response.data['created']).order_by('scheduled')
+        self.assertEqual([c.name for c in created], ['First Round', 'Second Round'])
+        self.assertEqual(set(created[0].agents.values_list('id', flat=True)), {self.agent1.id, self.agent3.id})
+        self.assertEqual(join.call_count, 3)
+
+    def test_all_or_nothing(self):
+        """Test that all_or_nothing inserts nothing when one item is rejected"""
+        contexts = [
+            self._item('First Round', 0, [self.agent1]),
+            self._item('Second Round', 0, [self.agent1]),
+        ]
+        response = self.client.post(self.url, {'contexts': contexts, 'all_or_nothing': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Context.objects.count(), 1)
+
+    def test_string_flags_are_parsed_strictly(self):
+        """Test that "true"/"false" strings are read as booleans and other values rejected"""
+        contexts = [self._item('First Round', 0, [self.agent1])]
+        response = self.client.post(self.url, {'contexts': contexts, 'dry_run': 'true'}, format='json')
+        self.assertEqual(response.data['created'], [])
+        response = self.client.post(self.url, {'contexts': contexts, 'dry_run': 'maybe'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Context.objects.count(), 1)
+        response = self.client.post(self.url, {'contexts': contexts, 'dry_run': 'false'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Context.objects.count(), 2)
+
+    def test_query_count_independent_of_batch_size(self):
+        """Test that validating a large batch costs a constant number of queries"""
+        contexts = [self._item(f'Round Number {i}', i * 2, [self.agent3], self.space2) for i in range(50)]
+        with self.assertNumQueries(4):
+            response = self.client.post(self.url, {'contexts': contexts, 'dry_run': True}, format='json')
+        self.assertEqual(len(response.data['accepted']), 50)
+
+
+class SpaceSolverTest(BaseSchemaAPITest):
+    """Test automatic space assignment"""
+
+    def setUp(self):
+        super().setUp()
+        self.t0 = (timezone.now() + timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+
+    def _at(self, hours):
+        return self.t0 + timedelta(hours=hours)
+
+    def test_best_fit_and_bookings(self):
+        """Test that the smallest free space is chosen and fixed bookings are respected"""
+        contexts = [(1, self._at(0), self._at(1), 2), (2, self._at(0), self._at(1), 2), (3, self._at(2), self._at(3), 6)]
+        capacities = {10: 2, 11: 4, 12: 8}
+        bookings = {10: [(self._at(0), self._at(0.5))]}
+        assignment, stats = solve_space_assignment(contexts, capacities, bookings)
+        self.assertEqual(assignment, {1: 11, 2: 12, 3: 12})
+        self.assertEqual(stats['unassigned'], 0)
+
+    def test_local_search_relocates_blocker(self):
+        """Test that a context left over by the greedy pass is placed by moving a blocker"""
+        # Greedy puts context 2 into room 11; context 3 then fits nowhere until 2 moves to room 12
+        contexts = [(1, self._at(0), self._at(2), 1), (2, self._at(1), self._at(4), 1), (3, self._at(3), self._at(5), 2)]
+        capacities = {10: 1, 11: 2, 12: 3}
+        bookings = {12: [(self._at(4), self._at(5))]}
+        assignment, stats = solve_space_assignment(contexts, capacities, bookings)
+        self.assertEqual(stats['greedy_assigned'], 2)
+        self.assertEqual(assignment, {1: 10, 2: 12, 3: 11})
+        self.assertEqual(stats['relocations'], 1)
+
+    def test_time_budget(self):
+        """Test that an exhausted time budget still returns a (partial) result"""
+        contexts = [(i, self._at(i), self._at(i + 1), 1) for i in range(20)]
+        assignment, stats = solve_space_assignment(contexts, {10: 1}, time_budget=0)
+        self.assertTrue(stats['timed_out'])
+        self.assertLessEqual(len(assignment), 20)
+
+    def test_assign_spaces_endpoint(self):
+        """Test proposing and committing space assignments, skipping agent conflicts"""
+        space2 = Space.objects.create(name='Consultation Room', capacity=2)
+        free = Context.objects.create(name='Ward Round', scheduled=self._at(0), ends_at=self._at(1))
+        free.agents.add(self.agent3)
+        clash = Context.objects.create(name='Double Booked', scheduled=self._at(5), ends_at=self._at(6))
+        other = Context.objects.create(name='Other Meeting', scheduled=self._at(5), ends_at=self._at(6), space=self.space1)
+        clash.agents.add(self.agent1)
+        other.agents.add(self.agent1)
+        data = {'window_start': self._at(-1).isoformat(), 'window_end': self._at(8).isoformat()}
+
+        response = self.client.post('/api/contexts/assign_spaces/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['assignments'], [{'context_id': free.id, 'space_id': space2.id}])
+        self.assertEqual(response.data['agent_conflicts'], [clash.id])
+        free.refresh_from_db()
+        self.assertIsNone(free.space_id)
+
+        response = self.client.post('/api/contexts/assign_spaces/', {**data, 'commit': True}, format='json')
+        self.assertTrue(response.data['committed'])
+        free.refresh_from_db()
+        self.assertEqual(free.space_id, space2.id)
+
+    def test_clashing_contexts_keep_their_bookings(self):
+        """Test that the space of a flexible context skipped for an agent clash is not given away"""
+        space2 = Space.objects.create(name='Consultation Room', capacity=2)
+        clash = Context.objects.create(name='Double Booked', scheduled=self._at(5), ends_at=self._at(6), space=self.space1)
+        other = Context.objects.create(name='Other Meeting', scheduled=self._at(5), ends_at=self._at(6), space=space2)
+        clash.agents.add(self.agent1)
+        other.agents.add(self.agent1)
+        waiting = Context.objects.create(name='Ward Round', scheduled=self._at(5), ends_at=self._at(6))
+        waiting.agents.add(self.agent3)
+
+        response = self.client.post('/api/contexts/assign_spaces/', {
+            'window_start': self._at(4).isoformat(), 'window_end': self._at(7).isoformat(),
+            'context_ids': [clash.id], 'space_ids': [self.space1.id], 'commit': True,
+        }, format='json')
+        self.assertEqual(response.data['agent_conflicts'], [clash.id])
+        self.assertEqual(response.data['unassigned'], [waiting.id])
+        clash.refresh_from_db()
+        waiting.refresh_from_db()
+        self.assertEqual(clash.space_id, self.space1.id)
+        self.assertIsNone(waiting.space_id)
+
+    def test_timed_out_commit_keeps_current_spaces(self):
+        """Test that contexts the solver did not get to keep a space that is still free"""
+        booked = Context.objects.create(name='Ward Round', scheduled=self._at(0), ends_at=self._at(1), space=self.space1)
+        booked.agents.add(self.agent3)
+        data = {'window_start': self._at(-1).isoformat(), 'window_end': self._at(2).isoformat(),
+                'context_ids': [booked.id], 'time_budget': 0}
+
+        response = self.client.post('/api/contexts/assign_spaces/', {**data, 'commit': 'false'}, format='json')
+        self.assertFalse(response.data['committed'])
+        response = self.client.post('/api/contexts/assign_spaces/', {**data, 'commit': 'true'}, format='json')
+        self.assertTrue(response.data['stats']['timed_out'])
+        self.assertEqual(response.data['stats']['kept'], 1)
+        self.assertEqual(response.data['assignments'], [{'context_id': booked.id, 'space_id': self.space1.id}])
+        booked.refresh_from_db()
+        self.assertEqual(booked.space_id, self.space1.id)
+
+
+class RecurringContextTest(BaseSchemaAPITest):
+    """Test recurring contexts and their lazily expanded occurrences"""
+
+    def setUp(self):
+        super().setUp()
+        self.start = (timezone.now() + timedelta(days=7)).replace(hour=9, minute=0, second=0, microsecond=0)
+        self.space2 = Space.objects.create(name='Clinic Room', capacity=4)
+        self.series = Context.objects.create(
+            name='Weekly Ward Round', scheduled=self.start, ends_at=self.start + timedelta(hours=1),
+            space=self.space2, recurrence_rule='FREQ=WEEKLY;COUNT=10'
+        )
+        self.series.agents.add(self.agent3)
+
+    def _week(self, n, hours=0):
+        return self.start + timedelta(weeks=n, hours=hours)
+
+    def test_rule_expansion(self):
+        """Test the supported rule parts and window expansion"""
+        rule = RecurrenceRule.parse('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;COUNT=5')
+        monday = self.start - timedelta(days=self.start.weekday())
+        starts = rule.occurrences(monday, timedelta(hours=1))
+        self.assertEqual([(s - monday).days for s in starts], [0, 3, 14, 17, 28])
+        self.assertEqual(rule.occurrences(monday, timedelta(hours=1), monday + timedelta(days=10),
+                                          monday + timedelta(days=20)), starts[2:4])
+        self.assertEqual(self.series.recurrence_end, self._week(9, 1))
+        with self.assertRaises(ValueError):
+            RecurrenceRule.parse('FREQ=HOURLY')
+
+    def test_bounded_rules_are_capped(self):
+        """Test that COUNT and UNTIL are capped and the last occurrence is found without expanding all"""
+        for text in ('FREQ=DAILY;COUNT=999999999', 'FREQ=DAILY;UNTIL=29991231'):
+            with self.assertRaises(ValueError):
+                RecurrenceRule.parse(text)
+        response = self.client.post('/api/contexts/', {
+            'name': 'Endless Round', 'scheduled': self._week(0, 4).isoformat(), 'agent_ids': [self.agent1.id],
+            'recurrence_rule': 'FREQ=DAILY;COUNT=999999999'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        until = (self.start + timedelta(days=400)).strftime('%Y%m%d')
+        for text in (f'FREQ=DAILY;INTERVAL=3;UNTIL={until}', f'FREQ=WEEKLY;BYDAY=MO,FR;UNTIL={until}',
+                     'FREQ=WEEKLY;INTERVAL=2;COUNT=7', f'FREQ=MONTHLY;UNTIL={until}'):
+            rule = RecurrenceRule.parse(text)
+            occurrences = rule.occurrences(self.start, timedelta(hours=1), limit=None)
+            self.assertEqual(rule.last_end(self.start, timedelta(hours=1)), occurrences[-1] + timedelta(hours=1), text)
+
+    def test_list_expands_occurrences_in_window(self):
+        """Test that ?expand=true lists each occurrence within the window once"""
+        params = {'expand': 'true', 'from_date': self._week(2, -1).isoformat(), 'to_date': self._week(5, -1).isoformat(),
+                  'space': self.space2.id}
+        response = self.client.get('/api/contexts/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([parse_datetime(str(r['scheduled'])) for r in results], [self._week(n) for n in (2, 3, 4)])
+        self.assertTrue(all(r['id'] == self.series.id for r in results))
+        self.assertEqual(Context.objects.count(), 2)
+
+    def test_occurrences_conflict_with_new_contexts(self):
+        """Test that a later occurrence blocks its space and agents"""
+        start = self._week(6, 0.5)
+        self.assertEqual([c.id for c in find_space_conflicts(self.space2.id, start, start + timedelta(hours=1))],
+                         [self.series.id])
+        conflicts = find_agent_conflicts([self.agent3.id], start, start + timedelta(hours=1))
+        self.assertEqual([c['scheduled'] for c in conflicts], [self._week(6)])
+        # After the last occurrence the space is free again
+        self.assertEqual(find_space_conflicts(self.space2.id, self._week(10), self._week(10, 1)), [])
+
+    def test_new_series_checked_against_existing_contexts(self):
+        """Test that creating a series validates all of its occurrences"""
+        Context.objects.create(name='One-off Meeting', scheduled=self._week(3, 2), ends_at=self._week(3, 3),
+                               space=self.space1)
+        data = {'name': 'Weekly Planning', 'scheduled': self._week(0, 2).isoformat(), 'space_id': self.space1.id,
+                'agent_ids': [self.agent3.id], 'agents': [self.agent3.id], 'recurrence_rule': 'FREQ=WEEKLY;COUNT=5'}
+        response = self.client.post('/api/contexts/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('One-off Meeting', response.data['error'])
+
+        data['recurrence_rule'] = 'FREQ=DAILY;COUNT=3'
+        response = self.client.post('/api/contexts/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_edit_occurrence_materializes_exception(self):
+        """Test that editing one occurrence moves only that occurrence"""
+        url = f'/api/contexts/{self.series.id}/edit_occurrence/'
+        moved = self._week(2, 3)
+        response = self.client.post(url, {'original_start': self._week(2).isoformat(),
+                                           'scheduled': moved.isoformat()}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['recurrence_parent'], self.series.id)
+        self.assertEqual(Context.objects.filter(recurrence_parent=self.series).count(), 1)
+
+        # The original slot is free now, the new one is taken by the exception
+        self.assertEqual(find_space_conflicts(self.space2.id, self._week(2), self._week(2, 1)), [])
+        self.assertEqual([c.id for c in find_space_conflicts(self.space2.id, moved, moved + timedelta(hours=1))],
+                         [response.data['id']])
+
+        response = self.client.post(url, {'original_start': self._week(4).isoformat(), 'cancel': True}, format='json')
+        self.assertTrue(response.data['is_archived'])
+        self.assertEqual(find_agent_conflicts([self.agent3.id], self._week(4), self._week(4, 1)), [])
+
+        response = self.client.post(url, {'original_start': self._week(5).isoformat(), 'cancel': 'false',
+                                           'name': 'Renamed Round'}, format='json')
+        self.assertFalse(response.data['is_archived'])
+        self.assertEqual(response.data['name'], 'Renamed Round')
+
+    def test_edit_occurrence_requires_real_occurrence(self):
+        """Test that only existing occurrences can be edited"""
+        url = f'/api/contexts/{self.series.id}/edit_occurrence/'
+        response = self.client.post(url, {'original_start': self._week(2, 1).isoformat(), 'cancel': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BulkEndpointTest(BaseSchemaAPITest):
+    """Test the bulk create/update/delete endpoints"""
+
+    def test_agent_bulk_create_reports_errors_per_item(self):
+        """Test that valid agents are created and duplicates or invalid names reported by index"""
+        items = [{'name': 'Dr. Adams'}, {'name': 'dr. smith'}, {'name': 'Dr. Adams'}, {'name': 'Bad#Name'},
+                 {'name': 'Nurse Brown'}]
+        response = self.client.post('/api/agents/bulk_create/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([agent['name'] for agent in response.data['created']], ['Dr. Adams', 'Nurse Brown'])
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2, 3])
+        self.assertIn('already exists', response.data['errors'][0]['errors']['name'][0])
+        self.assertEqual(Agent.objects.count(), 5)
+
+    def test_bulk_create_query_count_independent_of_size(self):
+        """Test that uniqueness checks and related lookups are batched"""
+        agents = [{'name': f'Agent Number {i}'} for i in range(30)]
+        with CaptureQueriesContext(connection) as small:
+            self.client.post('/api/agents/bulk_create/', agents[:3], format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post('/api/agents/bulk_create/', agents[3:], format='json')
+        self.assertEqual(len(small), len(large))
+
+        targets = list(Agent.objects.filter(name__startswith='Agent Number').values_list('id', flat=True))
+        relationships = [{'agent_from': self.agent1.id, 'agent_to': agent_id} for agent_id in targets]
+        with CaptureQueriesContext(connection) as small:
+            self.client.post('/api/relationships/bulk_create/', relationships[:3], format='json')
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post('/api/relationships/bulk_create/', relationships[3:], format='json')
+        self.assertEqual(len(response.data['created']), 27)
+        self.assertEqual(len(small), len(large))
+
+    def test_agent_bulk_update_swaps_names_and_logs_changes(self):
+        """Test that names can be swapped within a batch and changes reach the audit log"""
+        items = [{'id': self.agent1.id, 'name': 'Dr. Johnson'}, {'id': self.agent2.id, 'name': 'Dr. Smith'}]
+        with self.assertLogs('db_logger', level='INFO') as logs:
+            response = self.client.patch('/api/agents/bulk_update/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['errors'], [])
+        self.agent1.refresh_from_db()
+        self.assertEqual(self.agent1.name, 'Dr. Johnson')
+        self.assertTrue(any(f"Agent ID {self.agent2.id} was updated" in line for line in logs.output))
+
+        response = self.client.patch('/api/agents/bulk_update/', [
+            {'id': self.agent3.id, 'name': 'Nurse Jones'}, {'id': self.agent1.id, 'created_at': 'now'},
+            {'id': 999999, 'name': 'Nobody Here'},
+        ], format='json', QUERY_STRING='all_or_nothing=true')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertFalse(Agent.objects.filter(name='Nurse Jones').exists())
+
+    def test_space_capacity_reduction_checked_in_bulk(self):
+        """Test that reducing a capacity below a context's agent count is rejected"""
+        space2 = Space.objects.create(name='Consultation Room', capacity=4)
+        items = [{'id': self.space1.id, 'capacity': 1}, {'id': space2.id, 'capacity': 2}]
+        response = self.client.patch('/api/spaces/bulk_update/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([space['id'] for space in response.data['updated']], [space2.id])
+        self.assertIn('Morning Surgery Session', response.data['errors'][0]['errors']['capacity'][0])
+        self.space1.refresh_from_db()
+        self.assertEqual(self.space1.capacity, 5)
+
+    def test_relationship_bulk_create_checks(self):
+        """Test the self-reference, duplicate and unknown agent checks"""
+        Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2)
+        items = [
+            {'agent_from': self.agent1.id, 'agent_to': self.agent2.id},
+            {'agent_from': self.agent3.id, 'agent_to': self.agent3.id},
+            {'agent_from': self.agent2.id, 'agent_to': self.agent3.id},
+            {'agent_from': self.agent2.id, 'agent_to': self.agent3.id},
+            {'agent_from': self.agent2.id, 'agent_to': 999999},
+        ]
+        response = self.client.post('/api/relationships/bulk_create/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['created']), 1)
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 1, 3, 4])
+        self.assertIn('agent_to', response.data['errors'][3]['errors'])
+
+    def test_context_bulk_update_checks_conflicts(self):
+        """Test that moved contexts are checked against each other and the rest of the schedule"""
+        start = self.context1.scheduled + timedelta(days=1)
+        other = Context.objects.create(name='Ward Round Meeting', scheduled=start, ends_at=start + timedelta(hours=1))
+        other.agents.add(self.agent1)
+        items = [
+            {'id': self.context1.id, 'scheduled': (start + timedelta(minutes=30)).isoformat()},  # clashes with other
+            {'id': other.id, 'scheduled': (start + timedelta(hours=1)).isoformat(), 'name': 'Late Ward Round'},
+        ]
+        response = self.client.patch('/api/contexts/bulk_update/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors'][0]['index'], 0)
+        self.assertIn('Overlaps item 1', response.data['errors'][0]['errors']['agent_ids'][0])
+
+        items[0]['scheduled'] = (start + timedelta(hours=3)).isoformat()
+        response = self.client.patch('/api/contexts/bulk_update/', items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        other.refresh_from_db()
+        self.assertEqual(other.name, 'Late Ward Round')
+        self.assertEqual(other.ends_at - other.scheduled, timedelta(hours=1))
+
+    def test_bulk_delete(self):
+        """Test that listed agents are deleted, their comm nodes shut down and unknown ids reported"""
+        with mock.patch('api.views.CommNodeManager.shutdown_node') as shutdown:
+            response = self.client.post('/api/agents/bulk_delete/', [self.agent3.id, 999999], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['deleted'], [self.agent3.id])
+        self.assertEqual(response.data['errors'][0]['index'], 1)
+        shutdown.assert_called_once_with(self.agent3.id)
+        self.assertFalse(Agent.objects.filter(pk=self.agent3.id).exists())
+
+    def test_context_bulk_create_is_a_batch(self):
+        """Test that bulk creation of contexts goes through the batch checks"""
+        start = self.context1.scheduled + timedelta(days=1)
+        items = [{'name': 'Evening Ward Round', 'scheduled': start.isoformat(), 'agent_ids': [self.agent3.id]}]
+        response = self.client.post('/api/contexts/bulk_create/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['created']), 1)
+
+
+class RelationshipImportTest(BaseSchemaAPITest):
+    """Test the batched relationship import"""
+
+    def test_import_skips_invalid_and_duplicate_rows(self):
+        """Test validation and deduplication within batches, across batches and against stored rows"""
+        Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2)
+        a1, a2, a3 = self.agent1.id, self.agent2.id, self.agent3.id
+        data = (
+            "agent_from,agent_to,description\n"
+            f"{a1},{a2},stored already\n"
+            f"{a1},{a3},colleagues\n"
+            f"{a1},{a3},repeated in batch\n"
+            f"{a2},{a2},self\n"
+            f"{a2},999999,unknown\n"
+            f"x,{a1},malformed\n"
+            f"{a2},{a3},\n"
+            f"{a1},{a3},repeated in a later batch\n"
+        )
+        progress = []
+        stats, errors = import_relationships(io.StringIO(data), 'csv', batch_size=2,
+                                             progress=lambda s: progress.append(dict(s)))
+
+        self.assertEqual(stats['read'], 8)
+        self.assertEqual(stats['inserted'], 2)
+        self.assertEqual(stats['duplicates'], 3)
+        self.assertEqual(stats['invalid'], 3)
+        self.assertEqual([error['line'] for error in errors], [5, 6, 7])
+        self.assertEqual(len(progress), stats['batches'])
+        self.assertEqual(Relationship.objects.filter(agent_from=self.agent1, agent_to=self.agent3).count(), 1)
+        self.assertIsNone(Relationship.objects.get(agent_from=self.agent2, agent_to=self.agent3).description)
+
+    def test_import_updates_graph_index_without_per_batch_resets(self):
+        """Test that batches add their pairs to the graph index and only a large import resets it once"""
+        agents = [Agent.objects.create(name=f'Import {i}') for i in range(4)]
+        rows = [(a.id, b.id) for a in agents for b in agents if a != b][:7]
+        data = "agent_from,agent_to\n" + "".join(f"{a},{b}\n" for a, b in rows)
+
+        with mock.patch('api.relationship_import.edges_added') as added, \
+                mock.patch('api.relationship_import.edge_changed') as changed:
+            import_relationships(io.StringIO(data), 'csv', batch_size=2)
+        self.assertEqual([list(map(tuple, c.args[0])) for c in added.call_args_list],
+                         [rows[0:2], rows[2:4], rows[4:6], rows[6:7]])
+        changed.assert_not_called()
+
+        Relationship.objects.all().delete()
+        with override_settings(GRAPH_INDEX_MAX_DELTA=3), \
+                mock.patch('api.relationship_import.edges_added') as added, \
+                mock.patch('api.relationship_import.edge_changed') as changed:
+            import_relationships(io.StringIO(data), 'csv', batch_size=2)
+        self.assertEqual(added.call_count, 1)
+        changed.assert_called_once_with('reset')
+
+    def test_upload_endpoint_and_command(self):
+        """Test importing NDJSON through the upload endpoint and CSV through the command"""
+        lines = [json.dumps({'agent_from': self.agent1.id, 'agent_to': self.agent3.id}), 'not json']
+        upload = SimpleUploadedFile('edges.ndjson', "\n".join(lines).encode())
+        response = self.client.post('/api/relationships/upload/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stats']['inserted'], 1)
+        self.assertEqual(response.data['errors'], [{'line': 2, 'error': 'Malformed row'}])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'edges.csv')
+            with open(path, 'w') as f:
+                f.write(f"agent_from,agent_to\n{self.agent3.id},{self.agent2.id}\n")
+            out = io.StringIO()
+            call_command('import_relationships', path, stdout=out)
+        self.assertIn('Imported 1 relationships', out.getvalue())
+        self.assertEqual(Relationship.objects.count(), 2)
+
+
+class ExportTest(BaseSchemaAPITest):
+    """Test the streaming export endpoints"""
+
+    def _content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_context_ndjson_export_includes_agents(self):
+        """Test that contexts are streamed as NDJSON with their agent IDs"""
+        response = self.client.get('/api/contexts/export/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['name'], 'Morning Surgery Session')
+        self.assertEqual(rows[0]['agent_ids'], sorted([self.agent1.id, self.agent2.id]))
+
+    def test_relationship_csv_export(self):
+        """Test the CSV header, rows and list filters"""
+        Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2, description='colleagues')
+        Relationship.objects.create(agent_from=self.agent2, agent_to=self.agent3)
+        response = self.client.get('/api/relationships/export/', {'export_format': 'csv', 'agent_from': self.agent1.id})
+        self.assertIn('attachment; filename="relationships.csv"', response['Content-Disposition'])
+        lines = self._content(response).splitlines()
+        self.assertEqual(lines[0], 'id,agent_from_id,agent_to_id,description,created_at')
+        self.assertEqual(len(lines), 2)
+        self.assertIn(f'{self.agent1.id},{self.agent2.id},colleagues', lines[1])
+
+        response = self.client.get('/api/relationships/export/', {'export_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_reads_in_chunks(self):
+        """Test that related data is loaded with one query per chunk, not per row"""
+        for i in range(4):
+            context = Context.objects.create(name=f'Extra Session {i}', scheduled=self.context1.scheduled + timedelta(days=i + 1))
+            context.agents.add(self.agent3)
+        with mock.patch('api.export.EXPORT_CHUNK_SIZE', 2):
+            response = self.client.get('/api/contexts/export/', {'export_format': 'csv'})
+            with CaptureQueriesContext(connection) as queries:
+                lines = self._content(response).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].endswith(',agent_ids'))
+        self.assertEqual(len(queries), 1 + 3)  # the cursor plus one membership query per chunk
+
+
+class GraphIndexTest(BaseSchemaAPITest):
+    """Test the in-memory relationship graph index and its traversal endpoints"""
+
+    def setUp(self):
+        super().setUp()
+        graph_index._state.update(index=None, stale=True, building=False, pending=[])
+        self.agent4 = Agent.objects.create(name='Nurse Brown')
+        # agent4 -> agent1 -> agent2 -> agent3
+        for agent_from, agent_to in ((self.agent4, self.agent1), (self.agent1, self.agent2), (self.agent2, self.agent3)):
+            Relationship.objects.create(agent_from=agent_from, agent_to=agent_to)
+
+    def _get(self, name, **params):
+        response = self.client.get(f'/api/relationships/{name}/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data
+
+    def test_neighbourhood_and_path(self):
+        """Test hop-limited neighbourhoods and shortest paths in each direction"""
+        data = self._get('graph_neighbourhood', agent=self.agent1.id, hops=2)
+        self.assertEqual(data['agents'], [
+            {'agent_id': self.agent2.id, 'distance': 1}, {'agent_id': self.agent3.id, 'distance': 2}])
+        data = self._get('graph_neighbourhood', agent=self.agent1.id, direction='both', limit=1)
+        self.assertEqual(data['count'], 2)
+        self.assertTrue(data['truncated'])
+
+        data = self._get('graph_path', **{'from': self.agent4.id, 'to': self.agent3.id})
+        self.assertEqual(data['path'], [self.agent4.id, self.agent1.id, self.agent2.id, self.agent3.id])
+        self.assertEqual(data['distance'], 3)
+        self.assertFalse(self._get('graph_path', **{'from': self.agent3.id, 'to': self.agent4.id})['reachable'])
+        self.assertTrue(self._get('graph_path', **{'from': self.agent3.id, 'to': self.agent4.id, 'direction': 'in'})['reachable'])
+
+        self.assertEqual(self._get('graph_reachability', agent=self.agent4.id)['count'], 3)
+        data = self._get('graph_reachability', agent=self.agent1.id, to=self.agent4.id)
+        self.assertFalse(data['reachable'])
+
+    def test_overlay_follows_changes(self):
+        """Test that saved and deleted relationships update the built index without a rebuild"""
+        self.assertFalse(self._get('graph_cycles')['has_cycle'])
+        index = graph_index._state['index']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            closing = Relationship.objects.create(agent_from=self.agent3, agent_to=self.agent1)
+        data = self._get('graph_cycles')
+        cycle = data['cycle'][:-1]
+        self.assertEqual(data['cycle'][-1], cycle[0])
+        start = cycle.index(self.agent1.id)  # any rotation of the cycle is a valid answer
+        self.assertEqual(cycle[start:] + cycle[:start], [self.agent1.id, self.agent2.id, self.agent3.id])
+        self.assertEqual(data['cyclic_agents'], 3)
+        self.assertEqual(self._get('graph_cycles', agent=self.agent2.id)['cycle'],
+                         [self.agent2.id, self.agent3.id, self.agent1.id, self.agent2.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            closing.agent_from = self.agent4
+            closing.save()
+        self.assertFalse(self._get('graph_cycles')['has_cycle'])
+        self.assertEqual(self._get('graph_neighbourhood', agent=self.agent4.id)['count'], 1)  # pair already existed
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Relationship.objects.filter(agent_from=self.agent1).delete()
+        self.assertFalse(self._get('graph_path', **{'from': self.agent4.id, 'to': self.agent2.id})['reachable'])
+        self.assertTrue(self._get('graph_path', **{'from': self.agent4.id, 'to': self.agent1.id})['reachable'])
+        self.assertIs(graph_index._state['index'], index)
+
+    def test_bulk_writes_and_broadcasts(self):
+        """Test that bulk writes and imports update the index, lost broadcasts mark it stale, deltas from other processes apply"""
+        self._get('graph_stats')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/relationships/bulk_create/', [
+                {'agent_from': self.agent3.id, 'agent_to': self.agent4.id}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._get('graph_reachability', agent=self.agent3.id)['count'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            import_relationships(io.StringIO('agent_from,agent_to\n%d,%d\n' % (self.agent2.id, self.agent4.id)), 'csv')
+        self.assertFalse(graph_index._state['stale'])  # imported pairs go to the overlay
+        index = graph_index._state['index']
+        self.assertEqual(self._get('graph_neighbourhood', agent=self.agent2.id)['count'], 2)
+
+        agent5 = Agent.objects.create(name='Nurse Green')
+        graph_index._on_broadcast({'op': 'add_many', 'pairs': [[self.agent4.id, agent5.id], [agent5.id, self.agent1.id]]})
+        self.assertEqual(self._get('graph_neighbourhood', agent=agent5.id)['count'], 1)
+        self.assertIs(graph_index._state['index'], index)
+
+        graph_index._on_broadcast({'op': 'remove', 'agent_from': self.agent2.id, 'agent_to': self.agent3.id})
+        self.assertEqual(self._get('graph_neighbourhood', agent=self.agent2.id)['agents'], [
+            {'agent_id': self.agent4.id, 'distance': 1}])
+        graph_index._on_broadcast(None)
+        self.assertTrue(graph_index._state['stale'])
+        self.assertEqual(self._get('graph_neighbourhood', agent=self.agent2.id)['count'], 2)
+
+    def test_bulk_update_changes_only_moved_pairs(self):
+        """Test that bulk updates only touch the index for relationships whose agents changed"""
+        self._get('graph_stats')
+        index = graph_index._state['index']
+        link = Relationship.objects.get(agent_from=self.agent1, agent_to=self.agent2)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch('/api/relationships/bulk_update/', [
+                {'id': link.id, 'description': 'Referral'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertFalse(graph_index._state['stale'])
+        self.assertEqual(graph_index._state['index'].delta_size, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch('/api/relationships/bulk_update/', [
+                {'id': link.id, 'agent_to': self.agent3.id}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertFalse(graph_index._state['stale'])
+        self.assertIs(graph_index._state['index'], index)
+        self.assertEqual(self._get('graph_neighbourhood', agent=self.agent1.id)['agents'], [
+            {'agent_id': self.agent3.id, 'distance': 1}])
+
+    def test_errors_and_new_agents(self):
+        """Test validation, unknown agents, agents without relationships and the size limit"""
+        self._get('graph_stats')
+        newcomer = Agent.objects.create(name='Dr. Newcomer')
+        data = self._get('graph_neighbourhood', agent=newcomer.id, direction='both')
+        self.assertEqual(data['count'], 0)
+        self.assertFalse(self._get('graph_path', **{'from': newcomer.id, 'to': self.agent1.id})['reachable'])
+
+        response = self.client.get('/api/relationships/graph_neighbourhood/', {'agent': 999999})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        for params in ({'agent': self.agent1.id, 'direction': 'sideways'}, {'agent': self.agent1.id, 'hops': 7}, {}):
+            response = self.client.get('/api/relationships/graph_neighbourhood/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        graph_index._state['stale'] = True
+        with override_settings(GRAPH_INDEX_MAX_EDGES=2):
+            response = self.client.get('/api/relationships/graph_stats/')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        agent_user = User.objects.create_user(username='doctor-1', password='testpass123', role='agent')
+        self.client.force_authenticate(user=agent_user)
+        self.assertEqual(self.client.get('/api/relationships/graph_stats/').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_index_overlay_and_duplicates(self):
+        """Test the CSR arrays with duplicate pairs and overlay edits on the GraphIndex itself"""
+        Relationship.objects.create(agent_from=self.agent1, agent_to=self.agent2, description='duplicate')
+        index = GraphIndex.build()
+        self.assertEqual(index.stats()['edges'], 4)
+        node = {agent.id: index.node(agent.id) for agent in (self.agent1, self.agent2, self.agent3, self.agent4)}
+
+        index.remove_edge(self.agent1.id, self.agent2.id)
+        targets, _ = index.expand(np.array([node[self.agent1.id]]), 'out')
+        self.assertEqual(len(targets), 0)
+        index.add_edge(self.agent1.id, self.agent2.id)
+        index.add_edge(self.agent3.id, self.agent2.id)
+        targets, sources = index.expand(np.array([node[self.agent1.id], node[self.agent3.id]]), 'out')
+        self.assertEqual(sorted(index.agent_ids(targets)), [self.agent2.id] * 3)
+        self.assertEqual(sorted(index.agent_ids(sources)), sorted([self.agent1.id] * 2 + [self.agent3.id]))
+
+        # agent2 <-> agent3 is a cycle, agent4 and agent1 lead into it
+        remaining = index.cyclic_nodes()
+        self.assertEqual(sorted(index.agent_ids(np.flatnonzero(remaining))), [self.agent2.id, self.agent3.id])
+        self.assertEqual(index.find_cycle(remaining)[0], index.find_cycle(remaining)[-1])
+
+    def test_snapshots_and_long_chains(self):
+        """Test that snapshots ignore later changes and cycle detection handles deep graphs"""
+        self._get('graph_stats')
+        snapshot = graph_index.graph_snapshot()
+        graph_index._apply_change('add', self.agent3.id, self.agent4.id)
+        self.assertFalse(snapshot.cyclic_nodes().any())
+        self.assertTrue(graph_index.graph_snapshot().cyclic_nodes().any())
+
+        # 0 -> 1 -> ... -> n-1 -> n-2: a chain as deep as the graph ending in a two-node cycle
+        n = 50000
+        nodes = np.arange(n, dtype=np.int64)
+        targets = np.append(np.arange(1, n), n - 2)  # one outgoing edge per node
+        order = np.lexsort((nodes, targets))
+        in_indptr = np.concatenate([[0], np.cumsum(np.bincount(targets, minlength=n))])
+        index = GraphIndex(nodes, (np.arange(n + 1), targets.astype(np.int32)),
+                           (in_indptr, nodes[order].astype(np.int32)))
+        remaining = index.cyclic_nodes()
+        self.assertEqual(np.flatnonzero(remaining).tolist(), [n - 2, n - 1])
+        self.assertEqual(sorted(index.find_cycle(remaining)[:-1]), [n - 2, n - 1])
+
+        # Bounded queries only touch what they reach; deep ones switch to a mask over all nodes
+        def small(allocate):
+            def wrapper(shape, *args, **kwargs):
+                self.assertLess(np.prod(shape), n // 2)
+                return allocate(shape, *args, **kwargs)
+            return wrapper
+        with mock.patch.object(graph_index.np, 'full', small(np.full)), \
+                mock.patch.object(graph_index.np, 'zeros', small(np.zeros)):
+            nodes, distances = index.neighbourhood(10, 3)
+            self.assertEqual((nodes.tolist(), distances.tolist()), ([11, 12, 13], [1, 2, 3]))
+            self.assertEqual(index.shortest_cycle(n - 1), [n - 1, n - 2, n - 1])
+            self.assertEqual(index.shortest_path(100, 105), [100, 101, 102, 103, 104, 105])
+        self.assertIsNone(index.shortest_cycle(0))
+        self.assertEqual(index.bfs(0).count(), n - 1)
+        self.assertEqual(len(index.shortest_path(0, n - 1)), n)
+
+    def test_snapshots_share_the_overlay_until_it_changes(self):
+        """Test that taking a snapshot does not copy the overlay and later changes do not leak into it"""
+        self._get('graph_stats')
+        graph_index._apply_change('add', self.agent3.id, self.agent4.id)
+        live = graph_index._state['index']
+        snapshot = graph_index.graph_snapshot()
+        self.assertIs(snapshot.added['out'], live.added['out'])
+
+        graph_index._apply_change('remove', self.agent3.id, self.agent4.id)
+        self.assertIsNot(snapshot.added['out'], live.added['out'])
+        source, target = snapshot.node(self.agent3.id), snapshot.node(self.agent4.id)
+        self.assertEqual(snapshot.shortest_path(source, target), [source, target])
+        self.assertIsNone(graph_index.graph_snapshot().shortest_path(source, target))
+
+        newcomer = snapshot.node(999999, create=True)  # as the views do for agents newer than the build
+        self.assertIsNone(live.node(999999))
+        self.assertEqual(snapshot.neighbourhood(newcomer, 1)[0].tolist(), [])
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class OutboundBufferCapTest(TestCase):
+    """Test the TTLs, caps and dead-lettering of the outbound message buffer"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.buffer = RedisListBuffer(self.redis, 'node-a')
+
+    def _message(self, msg_type='ADT', protocol='HL7'):
+        return {'protocol': protocol, 'type': msg_type, 'payload': 'x' * 10}
+
+    def _buffered(self, buffer, destination, lane):
+        return [json.loads(m)['type'] for m in self.redis.lrange(buffer.key(destination, lane), 0, -1)][::-1]
+
+    def test_destination_cap_evicts_oldest_of_lowest_lane(self):
+        """Test that a full destination loses its oldest bulk message first"""
+        with mock.patch.object(outbound_buffer, 'MAX_MESSAGES_PER_DESTINATION', 3):
+            for msg_type in ('first-scan', 'second-scan'):
+                self.buffer.push('agent-2', self._message(msg_type, 'DICOM'))
+            self.buffer.push('agent-2', self._message('ADT'))
+            self.buffer.push('agent-2', self._message('alert'))
+
+        self.assertEqual(self._buffered(self.buffer, 'agent-2', 'bulk'), ['second-scan'])
+        letters = dead_letters(self.redis, 'node-a')
+        self.assertEqual([(l['reason'], l['envelope']['type']) for l in letters], [('overflow_destination', 'first-scan')])
+        self.assertEqual(eviction_stats(self.redis)['buffered']['count'], 3)
+
+    def test_global_cap_evicts_across_sources_and_spares_urgent(self):
+        """Test that the global cap evicts the oldest bulk/normal message of any source, never urgent ones"""
+        other = RedisListBuffer(self.redis, 'node-b')
+        with mock.patch.object(outbound_buffer, 'MAX_MESSAGES', 2):
+            other.push('agent-9', self._message('old-scan', 'DICOM'))
+            self.buffer.push('agent-2', self._message('ADT'))
+            self.buffer.push('agent-2', self._message('alert'))  # over the cap: node-b's scan goes
+            self.assertEqual(self._buffered(other, 'agent-9', 'bulk'), [])
+            self.assertEqual(dead_letters(self.redis, 'node-b')[0]['reason'], 'overflow_global')
+            self.assertEqual(int(self.redis.hget('bufmeta:node-b:agent-9', 'count')), 0)
+
+            self.buffer.push('agent-3', self._message('alarm'))
+            self.buffer.push('agent-3', self._message('critical'))
+        self.assertEqual(self._buffered(self.buffer, 'agent-2', 'normal'), [])
+        self.assertEqual(self._buffered(self.buffer, 'agent-2', 'urgent'), ['alert'])
+        self.assertEqual(self._buffered(self.buffer, 'agent-3', 'urgent'), ['alarm', 'critical'])
+        self.assertEqual(eviction_stats(self.redis)['evictions'], {'overflow_global': 2})
+
+    def test_global_cap_follows_index_without_scanning(self):
+        """Test that global eviction picks the oldest head from the index, correcting stale scores"""
+        other = RedisListBuffer(self.redis, 'node-b')
+        self.buffer._seed_index()
+        clock = mock.patch('mqtt_backend.core.buffer.time.time')
+        with clock as now, mock.patch.object(self.redis, 'scan_iter', side_effect=AssertionError('SCAN')):
+            for at, buffer, msg_type in ((100, other, 'b1'), (200, self.buffer, 'a1'), (400, other, 'b2')):
+                now.return_value = at
+                buffer.push('agent-9', self._message(msg_type, 'DICOM'))
+            self.redis.rpop(other.key('agent-9', 'bulk'))  # b1 delivered elsewhere, index score of node-b is stale
+            now.return_value = 500
+            with mock.patch.object(outbound_buffer, 'MAX_MESSAGES', 3):
+                self.buffer.push('agent-2', self._message('alert'))
+        self.assertEqual(self._buffered(self.buffer, 'agent-9', 'bulk'), [])
+        self.assertEqual(self._buffered(other, 'agent-9', 'bulk'), ['b2'])
+        self.assertEqual(self.redis.zscore('bufindex:buffer:bulk', other.key('agent-9', 'bulk')), 400)
+
+    def test_global_cap_indexes_keys_buffered_before_the_index(self):
+        """Test that keys buffered before the index existed are indexed once and can be evicted"""
+        legacy = 'buffer:node-c:agent-1:bulk'
+        self.redis.lpush(legacy, json.dumps(self._message('old-scan', 'DICOM')))
+        self.redis.hincrby('bufmeta:global', 'count', 1)
+        with mock.patch.object(outbound_buffer, 'MAX_MESSAGES', 1):
+            self.buffer.push('agent-2', self._message('ADT'))
+        self.assertEqual(self.redis.llen(legacy), 0)
+        self.assertEqual(dead_letters(self.redis, 'node-c')[0]['envelope']['type'], 'old-scan')
+        self.assertTrue(self.redis.exists('bufindex:buffer:seeded'))
+
+    def test_expired_messages_are_dead_lettered_while_draining(self):
+        """Test that messages past their TTL are not published but moved to the dead letters"""
+        self.buffer.push('agent-2', self._message('alert'))
+        self.buffer.push('agent-2', self._message('ADT'))
+        publish = mock.Mock()
+        later = time.time() + 2 * 60 * 60  # alerts live one hour, HL7 messages a day
+        with mock.patch('mqtt_backend.core.buffer.time.time', return_value=later):
+            self.assertEqual(self.buffer.drain(publish), 1)
+        self.assertEqual([json.loads(call.args[1])['type'] for call in publish.call_args_list], ['ADT'])
+        self.assertEqual([l['reason'] for l in dead_letters(self.redis, 'node-a')], ['expired'])
+        self.assertEqual(eviction_stats(self.redis)['buffered']['count'], 0)
+
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class OutboundBufferLaneTest(TestCase):
+    """Test the priority lanes of the outbound message buffer"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.buffer = RedisListBuffer(self.redis, 'node-a')
+
+    def test_classify(self):
+        """Test that messages are put in the lane of their protocol and type"""
+        self.assertEqual(classify('HL7', 'ALERT'), 'urgent')
+        self.assertEqual(classify('hl7', 'critical'), 'urgent')
+        self.assertEqual(classify('HL7', 'ADT'), 'normal')
+        self.assertEqual(classify('DICOM', 'CT'), 'bulk')
+        self.assertEqual(classify('FHIR', None), 'normal')
+        self.assertEqual(classify('DICOM', 'CT', priority='urgent'), 'urgent')
+        self.assertEqual(classify('HL7', 'alert', priority='bogus'), 'urgent')
+
+    def test_drain_sends_urgent_first_and_bulk_progresses(self):
+        """Test that urgent messages go first and bulk lanes are not starved by a normal backlog"""
+        for i in range(12):
+            self.buffer.push('agent-2', {'protocol': 'HL7', 'type': 'ADT', 'seq': i})
+        for i in range(3):
+            self.buffer.push('agent-3', {'protocol': 'DICOM', 'type': 'CT', 'seq': i})
+        self.buffer.push('agent-4', {'protocol': 'HL7', 'type': 'alert', 'seq': 0})
+
+        sent = []
+        self.assertEqual(self.buffer.drain(lambda destination, msg: sent.append((destination, json.loads(msg)['seq']))), 16)
+        self.assertEqual(sent[0], ('agent-4', 0))
+        self.assertLess(sent.index(('agent-3', 0)), 6)   # first weighted round
+        self.assertLess(sent.index(('agent-3', 1)), 11)  # second weighted round, normal backlog not done
+        self.assertEqual([seq for destination, seq in sent if destination == 'agent-2'], list(range(12)))
+        self.assertEqual([seq for destination, seq in sent if destination == 'agent-3'], list(range(3)))
+
+    def test_failed_publish_keeps_message_at_head(self):
+        """Test that draining stops at a failed publish and keeps the lane order"""
+        for i in range(3):
+            self.buffer.push('agent-2', {'protocol': 'HL7', 'type': 'ADT', 'seq': i})
+        publish = mock.Mock(side_effect=[None, ConnectionError('broker down')])
+        self.assertEqual(self.buffer.drain(publish), 1)
+
+        sent = []
+        self.assertEqual(self.buffer.drain(lambda destination, msg: sent.append(json.loads(msg)['seq'])), 2)
+        self.assertEqual(sent, [1, 2])
+        stats = self.buffer.lane_stats()['normal']
+        self.assertEqual((stats['enqueued'], stats['drained'], stats['failed'], stats['depth']), (3, 3, 1, 0))
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class OutboundStreamBufferTest(TestCase):
+    """Test the Redis streams backend of the outbound message buffer"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.buffer = RedisStreamBuffer(self.redis, 'node-a', consumer='c1')
+        for i in range(3):
+            self.buffer.push('agent-2', {'protocol': 'HL7', 'type': 'ADT', 'seq': i})
+        self.key = self.buffer.key('agent-2', 'normal')
+
+    def _collect(self, sent):
+        return lambda destination, msg: sent.append(json.loads(msg)['seq'])
+
+    def test_failed_publish_leaves_entries_pending_for_redelivery(self):
+        """Test that entries read before a failed publish are delivered again, in order"""
+        publish = mock.Mock(side_effect=[None, ConnectionError('broker down')])
+        self.assertEqual(self.buffer.drain(publish), 1)
+        self.assertEqual(self.redis.xlen(self.key), 2)
+        self.assertEqual(self.redis.xpending(self.key, 'drain')['pending'], 2)
+
+        sent = []
+        self.assertEqual(self.buffer.drain(self._collect(sent)), 2)
+        self.assertEqual(sent, [1, 2])
+        self.assertEqual(self.redis.xlen(self.key), 0)
+        self.assertEqual(self.redis.xpending(self.key, 'drain')['pending'], 0)
+        self.assertEqual(outbound_buffer.eviction_stats(self.redis)['buffered']['count'], 0)
+
+    def test_eviction_skips_entries_being_published(self):
+        """Test that the destination cap never evicts an entry a drainer has already read"""
+        self.buffer._ensure_group(self.key)
+        self.assertEqual(len(self.buffer._read_batch(self.key, 1)), 1)  # entry 0 is being published
+        self.assertEqual(self.buffer._oldest_time(self.key), json.loads(self.redis.xrange(self.key)[1][1][b'd'])['buffered_at'])
+        with mock.patch.object(outbound_buffer, 'MAX_MESSAGES_PER_DESTINATION', 3):
+            self.buffer.push('agent-2', {'protocol': 'HL7', 'type': 'ADT', 'seq': 3})
+
+        self.assertEqual([l['envelope']['seq'] for l in dead_letters(self.redis, 'node-a')], [1])
+        sent = []
+        self.assertEqual(self.buffer.drain(self._collect(sent)), 3)
+        self.assertEqual(sent, [0, 2, 3])
+        self.assertEqual(outbound_buffer.eviction_stats(self.redis)['buffered']['count'], 0)
+
+    def test_entry_removed_elsewhere_is_accounted_once(self):
+        """Test that only the consumer whose XDEL removed an entry updates the accounting"""
+        other = RedisStreamBuffer(self.redis, 'node-a', consumer='c2')
+
+        def publish(destination, msg):
+            # Another consumer reclaimed and delivered the same entry meanwhile
+            if json.loads(msg)['seq'] == 0:
+                entry_id = self.redis.xrange(self.key, count=1)[0][0]
+                self.assertTrue(other._remove(self.key, entry_id))
+                pipe = self.redis.pipeline()
+                other._account(pipe, destination, -1, -len(msg))
+                pipe.execute()
+
+        self.assertEqual(self.buffer.drain(publish), 3)
+        self.assertEqual(outbound_buffer.eviction_stats(self.redis)['buffered'], {'count': 0, 'bytes': 0})
+        self.assertEqual(self.buffer.lane_stats()['normal']['drained'], 2)
+
+    def test_entries_of_crashed_consumer_are_reclaimed(self):
+        """Test that another consumer claims entries a crashed consumer left pending"""
+        self.buffer._ensure_group(self.key)
+        self.assertEqual(len(self.buffer._read_batch(self.key, 10)), 3)  # read, then crash before publishing
+
+        other = RedisStreamBuffer(self.redis, 'node-a', consumer='c2')
+        sent = []
+        self.assertEqual(other.drain(self._collect(sent)), 0)  # not idle long enough yet
+        with mock.patch.object(outbound_buffer, 'STREAM_CLAIM_IDLE_MS', 0):
+            self.assertEqual(other.drain(self._collect(sent)), 3)
+        self.assertEqual(sent, [0, 1, 2])
+        self.assertEqual(self.redis.xpending(self.key, 'drain')['pending'], 0)
+
+
+class DispatcherTest(TestCase):
+    """Test the routing of inbound messages by the wildcard-subscription dispatcher"""
+
+    def setUp(self):
+        self.unroutable = mock.Mock()
+        self.dispatcher = Dispatcher('localhost', 1883, consumers=2, shared_group='omnisys', on_unroutable=self.unroutable)
+        self.nodes = {object_id: mock.Mock(object_id=object_id) for object_id in (1, 2, 3)}
+        for node in self.nodes.values():
+            self.dispatcher.register(node)
+
+    def test_requires_shared_group_for_several_consumers(self):
+        """Test that several consumers without a shared group are refused"""
+        with self.assertRaises(ValueError):
+            Dispatcher('localhost', 1883, consumers=2)
+        self.assertEqual(self.dispatcher.subscription, '$share/omnisys/comm/+')
+
+    def test_dispatch_by_topic_suffix(self):
+        """Test that a message goes to the node registered for its topic suffix only"""
+        client, msg = object(), SimpleNamespace(topic='comm/2', payload=b'{}')
+        self.dispatcher.dispatch(client, msg)
+        self.nodes[2].on_message.assert_called_once_with(client, self.nodes[2], msg)
+        self.nodes[1].on_message.assert_not_called()
+        self.unroutable.assert_not_called()
+
+    def test_unroutable_messages_are_forwarded(self):
+        """Test that messages for agents without a local node go to on_unroutable"""
+        msg = SimpleNamespace(topic='comm/42', payload=b'{}')
+        self.dispatcher.dispatch(object(), msg)
+        self.unroutable.assert_called_once_with('42', msg)
+
+        self.dispatcher.unregister(2)
+        self.dispatcher.dispatch(object(), SimpleNamespace(topic='comm/2', payload=b'{}'))
+        self.assertEqual(self.unroutable.call_args.args[0], '2')
+        self.nodes[2].on_message.assert_not_called()
+
+    def test_context_fan_out(self):
+        """Test that context multicasts reach the local members, subscribed by the first consumer only"""
+        self.dispatcher.join_context(7, self.nodes[1])
+        self.dispatcher.join_context(7, self.nodes[3])
+        msg = SimpleNamespace(topic='comm/context/7', payload=b'{}')
+        self.dispatcher.dispatch(object(), msg)
+        self.assertEqual(self.nodes[1].on_message.call_count, 1)
+        self.assertEqual(self.nodes[3].on_message.call_count, 1)
+        self.nodes[2].on_message.assert_not_called()
+        self.unroutable.assert_not_called()
+
+        self.dispatcher.leave_context(7, self.nodes[1])
+        self.dispatcher.leave_context(7, self.nodes[3])
+        self.assertEqual(self.dispatcher.context_members, {})
+
+        first, second = mock.Mock(), mock.Mock()
+        self.dispatcher.clients = [first, second]
+        for client in (first, second):
+            self.dispatcher._on_connect(client, None, {}, 0)
+        topics = lambda client: [c.args[0] for c in client.subscribe.call_args_list]
+        self.assertEqual(topics(first), ['$share/omnisys/comm/+', CONTEXT_TOPIC])
+        self.assertEqual(topics(second), ['$share/omnisys/comm/+'])
+
+
+class ApiClientTest(TestCase):
+    """Test the token handling and agent directory of the remote API client"""
+
+    def setUp(self):
+        self.client_sdk = ApiClient('http://backend/api/', 'doctor-1', 'secret')
+        self.client_sdk.session = mock.Mock()
+
+    def _token(self, name, expires_in):
+        claims = base64.urlsafe_b64encode(json.dumps({'exp': time.time() + expires_in}).encode()).decode().rstrip('=')
+        return f"header.{claims}.{name}"
+
+    def _response(self, status_code, data=None):
+        return mock.Mock(status_code=status_code, json=mock.Mock(return_value=data or {}), headers={}, text='')
+
+    def _auth_calls(self):
+        return [c.args[0].rsplit('/api/', 1)[1] for c in self.client_sdk.session.post.call_args_list]
+
+    def test_token_refreshed_before_expiry(self):
+        """Test that an access token about to expire is refreshed before the request"""
+        session = self.client_sdk.session
+        session.post.side_effect = [
+            self._response(200, {'access': self._token('a1', 30), 'refresh': 'r1'}),
+            self._response(200, {'access': self._token('a2', 3600)}),
+        ]
+        session.request.return_value = self._response(200, {'ok': True})
+        self.client_sdk.get('agents/')
+        self.client_sdk.get('agents/')
+        self.client_sdk.get('agents/')
+        self.assertEqual(self._auth_calls(), ['auth/user/token/', 'auth/user/token/refresh/'])
+        self.assertEqual(session.post.call_args.kwargs['json'], {'refresh': 'r1'})
+        tokens = [c.kwargs['headers']['Authorization'] for c in session.request.call_args_list]
+        self.assertEqual([t.rsplit('.', 1)[1] for t in tokens], ['a1', 'a2', 'a2'])
+
+    def test_unauthorized_request_is_retried_once_with_fresh_token(self):
+        """Test that a 401 refreshes the token (logging in again if needed) and retries once"""
+        session = self.client_sdk.session
+        session.post.side_effect = [
+            self._response(200, {'access': self._token('a1', 3600), 'refresh': 'r1'}),
+            self._response(401),  # refresh token expired too
+            self._response(200, {'access': self._token('a2', 3600), 'refresh': 'r2'}),
+        ]
+        session.request.side_effect = [self._response(401), self._response(200, {'agent_id': 5})]
+        self.assertEqual(self.client_sdk.get('agents/by-username/nurse/'), {'agent_id': 5})
+        self.assertEqual(self._auth_calls(), ['auth/user/token/', 'auth/user/token/refresh/', 'auth/user/token/'])
+        tokens = [c.kwargs['headers']['Authorization'].rsplit('.', 1)[1] for c in session.request.call_args_list]
+        self.assertEqual(tokens, ['a1', 'a2'])
+
+        session.request.side_effect = [self._response(401), self._response(401, {'error': 'denied'})]
+        session.post.side_effect = [self._response(200, {'access': self._token('a3', 3600)})]
+        with self.assertRaises(ApiError) as raised:
+            self.client_sdk.get('agents/')
+        self.assertEqual(raised.exception.status_code, 401)
+
+    def test_bulk_lookup_etags_are_capped(self):
+        """Test that the ETags of bulk lookups are kept for the most recently used username sets only"""
+        self.client_sdk._directory_etags_max = 2
+        session = self.client_sdk.session
+        session.post.return_value = self._response(200, {'access': self._token('a1', 3600), 'refresh': 'r1'})
+
+        def resolve(method, url, **kwargs):
+            usernames = kwargs['json']['usernames']
+            response = self._response(200, {'agents': {u: {'agent_id': len(u)} for u in usernames}})
+            response.headers = {'ETag': f'"{"-".join(usernames)}"'}
+            return response
+
+        session.request.side_effect = resolve
+        for usernames in (['a'], ['b'], ['a'], ['c']):
+            self.client_sdk.directory.invalidate()
+            self.client_sdk.resolve_many(usernames)
+        self.assertEqual(list(self.client_sdk._directory_etags), [('a',), ('c',)])
+        self.assertEqual(session.request.call_args_list[2].kwargs['headers']['If-None-Match'], '"a"')
+
+    def test_agent_directory_ttl(self):
+        """Test that resolved usernames are cached until their TTL runs out"""
+        directory = AgentDirectory(ttl=10)
+        with mock.patch('mqtt_backend.remote.api_client.time.monotonic', return_value=100.0):
+            directory.put('nurse', 7)
+            self.assertEqual(directory.get('nurse'), 7)
+        with mock.patch('mqtt_backend.remote.api_client.time.monotonic', return_value=111.0):
+            self.assertIsNone(directory.get('nurse'))
+
+        session = self.client_sdk.session
+        session.post.return_value = self._response(200, {'access': self._token('a1', 3600), 'refresh': 'r1'})
+        session.request.return_value = self._response(200, {'agent_id': 9})
+        self.assertEqual(self.client_sdk.resolve('nurse'), 9)
+        self.assertEqual(self.client_sdk.resolve('nurse'), 9)
+        self.assertEqual(session.request.call_count, 1)
+        self.client_sdk.directory.invalidate('nurse')
+        self.client_sdk.resolve('nurse')
+        self.assertEqual(session.request.call_count, 2)
+
+
+class HashRingTest(TestCase):
+    """Test the consistent hash ring mapping agents onto comm shards"""
+
+    def _owners(self, ring, keys):
+        return {key: ring.owner(key) for key in keys}
+
+    def test_distribution(self):
+        """Test that agents are spread over all shards"""
+        self.assertIsNone(HashRing().owner('1'))
+        ring = HashRing(['s1', 's2', 's3', 's4'])
+        self.assertEqual(ring.shards, ['s1', 's2', 's3', 's4'])
+        counts = {}
+        for owner in self._owners(ring, [str(i) for i in range(4000)]).values():
+            counts[owner] = counts.get(owner, 0) + 1
+        self.assertEqual(set(counts), {'s1', 's2', 's3', 's4'})
+        self.assertGreater(min(counts.values()), 600)  # 1000 each when perfectly even
+
+    def test_minimal_movement_on_add_and_remove(self):
+        """Test that only the agents of the changed shard move"""
+        keys = [str(i) for i in range(2000)]
+        ring = HashRing(['s1', 's2', 's3'])
+        before = self._owners(ring, keys)
+
+        ring.add('s4')
+        after = self._owners(ring, keys)
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == 's4' for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+        ring.remove('s4')
+        self.assertEqual(self._owners(ring, keys), before)
+        ring.remove('s2')
+        after = self._owners(ring, keys)
+        self.assertTrue(all(after[key] == before[key] for key in keys if before[key] != 's2'))
+        self.assertNotIn('s2', after.values())
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class CommShardTest(TestCase):
+    """Test the rebalancing and command handling of a comm shard (without its threads)"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.agents = list(range(1, 41))
+        self.manager = self._node_manager()
+        self.shard = CommShard(lambda: self.agents, self.manager, shard_id='s1', redis_client=self.redis)
+
+    def _node_manager(self):
+        manager = mock.Mock(live_nodes={})
+        manager.create_node.side_effect = lambda key: manager.live_nodes.setdefault(key, mock.Mock())
+        manager.shutdown_node.side_effect = lambda key: manager.live_nodes.pop(key, None)
+        manager.get_node.side_effect = lambda key: manager.live_nodes.get(key)
+        return manager
+
+    def _join(self, shard_id):
+        self.redis.zadd(sharding.SHARD_REGISTRY_KEY, {shard_id: time.time()})
+
+    def test_rebalance_follows_membership(self):
+        """Test that a shard starts the nodes it owns and hands over the ones that move away"""
+        self.shard._heartbeat()
+        self.shard.rebalance()
+        self.assertEqual(set(self.manager.live_nodes), set(self.agents))
+
+        self._join('s2')
+        self.shard.rebalance()
+        owned = {a for a in self.agents if HashRing(['s1', 's2']).owner(str(a)) == 's1'}
+        self.assertTrue(0 < len(owned) < len(self.agents))
+        self.assertEqual(set(self.manager.live_nodes), owned)
+        self.assertEqual(sharding.owner_of(self.agents[0], self.redis), HashRing(['s1', 's2']).owner('1'))
+
+        # s2 stops heartbeating and is dropped from the registry
+        self.redis.zadd(sharding.SHARD_REGISTRY_KEY, {'s2': time.time() - 2 * sharding.SHARD_TTL})
+        self.assertEqual(self.shard._heartbeat(), 1)
+        self.shard.rebalance()
+        self.assertEqual(set(self.manager.live_nodes), set(self.agents))
+
+    def test_handle_command_for_owned_agent(self):
+        """Test that commands for owned agents act on their local node"""
+        self.shard.rebalance()
+        self.shard.handle_command({'op': 'send', 'agent_id': '3', 'destination': '4',
+                                   'protocol': 'HL7', 'type': 'ADT', 'payload': {}})
+        self.manager.live_nodes[3].send_message.assert_called_once_with('4', 'HL7', 'ADT', {})
+        self.shard.handle_command({'op': 'join_context', 'agent_id': '3', 'context_id': '9'})
+        self.manager.live_nodes[3].join_context.assert_called_once_with('9')
+        self.shard.handle_command({'op': 'shutdown_node', 'agent_id': '3'})
+        self.assertNotIn(3, self.manager.live_nodes)
+        self.shard.handle_command({'op': 'deliver', 'agent_id': '3', 'message': {'id': 1}})
+        self.manager.live_nodes[3].handle_message.assert_called_once_with({'id': 1})
+
+    def test_commands_are_forwarded_to_new_owner_with_hop_limit(self):
+        """Test that commands for agents that moved are forwarded, at most MAX_COMMAND_HOPS times"""
+        self._join('s2')
+        self.shard.rebalance()
+        agent_id = next(str(a) for a in self.agents if not self.shard.owns(a))
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(sharding.SHARD_COMMAND_CHANNEL.format(shard_id='s2'))
+        pubsub.get_message(timeout=0.1)  # subscribe confirmation
+
+        self.shard.handle_command({'op': 'create_node', 'agent_id': agent_id})
+        message = pubsub.get_message(timeout=1.0)
+        self.assertEqual(json.loads(message['data']), {'op': 'create_node', 'agent_id': agent_id, 'hops': 1})
+        self.assertNotIn(int(agent_id), self.manager.live_nodes)
+
+        self.shard.handle_command({'op': 'create_node', 'agent_id': agent_id, 'hops': sharding.MAX_COMMAND_HOPS})
+        self.assertIsNone(pubsub.get_message(timeout=0.1))
+        pubsub.close()
+
+    @override_settings(COMM_SHARDING=True, COMM_SHARD_IN_WORKERS=False)
+    def test_start_worker_shard_respects_settings(self):
+        """Test that web workers join the ring only with COMM_SHARD_IN_WORKERS"""
+        from api.apps import active_agent_ids, start_worker_shard
+        with mock.patch('mqtt_backend.comm_node_manager.CommNodeManager.start_shard') as start_shard:
+            start_worker_shard()
+            start_shard.assert_not_called()
+            with override_settings(COMM_SHARD_IN_WORKERS=True):
+                start_worker_shard()
+            start_shard.assert_called_once_with(active_agent_ids)
+            with override_settings(COMM_SHARDING=False, COMM_SHARD_IN_WORKERS=True):
+                start_worker_shard()
+            self.assertEqual(start_shard.call_count, 1)
+
+
+class SpoolTest(TestCase):
+    """Test the durable on-disk spool of the remote nodes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def _spool(self, **kwargs):
+        spool = Spool(self.directory, **dict({'segment_size': 64, 'max_bytes': 1024}, **kwargs))
+        self.addCleanup(spool.close)
+        return spool
+
+    def _record(self, i):
+        return f"message-{i:011d}".encode()  # 20 bytes, two records per 64 byte segment
+
+    def _unsent(self, spool):
+        return [data for position, data in spool.peek(1000)]
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+
+    def test_append_peek_commit_in_order(self):
+        """Test that records are read back in order and committed records are not read again"""
+        spool = self._spool()
+        self.assertTrue(spool.is_empty())
+        for i in range(5):
+            spool.append(self._record(i))
+        records = spool.peek(3)
+        self.assertEqual([data for position, data in records], [self._record(i) for i in range(3)])
+        self.assertEqual(self._unsent(spool), [self._record(i) for i in range(5)])  # peek does not consume
+
+        spool.commit(records[1][0])
+        self.assertEqual(self._unsent(spool), [self._record(i) for i in range(2, 5)])
+        spool.commit(spool.peek(10)[-1][0])
+        self.assertTrue(spool.is_empty())
+        with self.assertRaises(ValueError):
+            spool.append(b'x' * 64)
+
+    def test_segments_roll_and_are_deleted_once_consumed(self):
+        """Test that full segments roll over and consumed ones are removed on commit"""
+        spool = self._spool()
+        for i in range(5):
+            spool.append(self._record(i))
+        self.assertEqual(len(self._segments()), 3)
+        self.assertEqual(spool.disk_usage(), 3 * 64)
+
+        spool.commit(spool.peek(4)[-1][0])
+        self.assertEqual(len(self._segments()), 2)  # the 4th record ends the second segment
+        self.assertEqual(self._unsent(spool), [self._record(4)])
+
+    def test_recovers_cursor_and_torn_tail_after_restart(self):
+        """Test that a restart resumes at the stored cursor and overwrites a torn last record"""
+        spool = self._spool()
+        for i in range(3):
+            spool.append(self._record(i))
+        spool.commit(spool.peek(1)[0][0])
+        spool.close()
+
+        # A power loss in the middle of a write leaves a record whose CRC does not match
+        last_segment = os.path.join(self.directory, self._segments()[-1])
+        with open(last_segment, 'r+b') as f:
+            f.seek(HEADER.size + len(self._record(2)))
+            f.write(HEADER.pack(20, 12345) + b'torn' * 5)
+
+        spool = self._spool()
+        self.assertEqual(self._unsent(spool), [self._record(1), self._record(2)])
+        spool.append(self._record(3))
+        self.assertEqual(self._unsent(spool), [self._record(i) for i in range(1, 4)])
+
+    def test_disk_budget_drops_oldest_unsent_records(self):
+        """Test that the oldest segments are dropped past the disk budget and the loss is counted"""
+        with self.assertRaises(ValueError):
+            Spool(self.directory, segment_size=64, max_bytes=32)
+        spool = self._spool(max_bytes=128)
+        spool.append(self._record(0))
+        spool.commit(spool.peek(1)[0][0])
+        for i in range(1, 6):
+            spool.append(self._record(i))
+        # Records 0 and 1 filled the first segment, 0 was delivered: only 1 was lost with it
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual(self._unsent(spool), [self._record(i) for i in range(2, 6)])
+        self.assertEqual(len(self._segments()), 2)
+
+        spool.append(self._record(6))
+        self.assertEqual(spool.dropped, 3)
+        self.assertEqual(self._unsent(spool), [self._record(i) for i in range(4, 7)])
+        spool.close()
+        self.assertEqual(self._unsent(self._spool(max_bytes=128)), [self._record(i) for i in range(4, 7)])
@@ -0,0 +1,226 @@
+"""
+This module provides a two-tier cache for hot lookups (agent name by ID, agent by username).
+
+Tier 1 is a size-bounded LRU dict inside each process, tier 2 the shared Redis cache. A lookup
+falls through local -> Redis -> loader (database) and fills the tiers on the way back.
+Invalidations delete the Redis entry and are broadcast over Redis pub/sub, so that every
+gunicorn worker drops its local copy within milliseconds. Local entries also expire after
+LOCAL_CACHE_TTL seconds in case a broadcast is missed.
+
+The same channel carries other per-process state changes (see register_broadcast_handler), e.g.
+the edge updates of the relationship graph index.
+
+Without a django-redis cache (e.g. in tests) invalidations only apply to the current process.
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock, Thread
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('omnisyslogger')
+
+INVALIDATION_CHANNEL = "tieredcache:invalidate"
+PROCESS_ID = uuid.uuid4().hex  # lets a listener skip the broadcasts it sent itself
+
+
+class LRUCache:
+    """Thread-safe LRU mapping with a maximum size and per-entry TTL."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    """A named two-tier cache. Values must be JSON/pickle friendly and not None."""
+    registry = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.local = LRUCache(getattr(settings, 'LOCAL_CACHE_MAX_ENTRIES', 1024),
+                              getattr(settings, 'LOCAL_CACHE_TTL', 60))
+        self.counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+        TieredCache.registry[name] = self
+
+    def _redis_key(self, key):
+        return f"tiered:{self.name}:{key}"
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss. None results are not cached."""
+        key = str(key)
+        value = self.local.get(key)
+        if value is not None:
+            self.counters['local_hits'] += 1
+            return value
+
+        ensure_listener()
+        try:
+            value = cache.get(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Redis tier of {self.name} cache unavailable: {str(e)}")
+            value = None
+        if value is not None:
+            self.counters['redis_hits'] += 1
+            self.local.set(key, value)
+            return value
+
+        self.counters['misses'] += 1
+        value = loader()
+        if value is not None:
+            self.local.set(key, value)
+            try:
+                cache.set(self._redis_key(key), value, timeout=getattr(settings, 'API_CACHE_TTL', 300))
+            except Exception as e:
+                logger.warning(f"Failed to fill Redis tier of {self.name} cache: {str(e)}")
+        return value
+
+    def invalidate(self, key):
+        """Drop key from both tiers here and broadcast the invalidation to other processes."""
+        key = str(key)
+        self.local.delete(key)
+        try:
+            cache.delete(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Failed to invalidate Redis tier of {self.name} cache: {str(e)}")
+        _publish({'origin': PROCESS_ID, 'cache': self.name, 'key': key})
+
+    def stats(self):
+        lookups = sum(self.counters.values())
+        return {
+            **self.counters,
+            'local_entries': len(self.local),
+            'local_hit_ratio': round(self.counters['local_hits'] / lookups, 4) if lookups else None,
+        }
+
+
+def tiered_cache_stats():
+    """Return the per-tier counters of this process' tiered caches."""
+    return {name: tiered.stats() for name, tiered in TieredCache.registry.items()}
+
+
+# -- pub/sub invalidation ------------------------------------------------------
+
+_listener_lock = Lock()
+_listener_pid = None
+_handlers = {}  # message kind -> handler, see register_broadcast_handler
+
+
+def _redis_connection():
+    """Return the raw Redis client behind the default cache, or None if it is not django-redis."""
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection("default")
+    except Exception:
+        return None
+
+
+def _publish(message):
+    redis_client = _redis_connection()
+    if redis_client is None:
+        return
+    try:
+        redis_client.publish(INVALIDATION_CHANNEL, json.dumps(message))
+    except Exception as e:
+        logger.warning(f"Failed to broadcast cache invalidation: {str(e)}")
+
+
+def register_broadcast_handler(kind, handler):
+    """
+    Call handler(message) for the broadcasts of this kind sent by other processes, and
+    handler(None) after the listener reconnected, since broadcasts may have been missed.
+    """
+    _handlers[kind] = handler
+
+
+def broadcast(kind, message):
+    """Send a message to the handlers of this kind in the other processes."""
+    _publish({'origin': PROCESS_ID, 'kind': kind, **message})
+
+
+def _apply(message):
+    if message.get('origin') == PROCESS_ID:
+        return
+    if 'kind' in message:
+        handler = _handlers.get(message['kind'])
+        if handler is not None:
+            handler(message)
+        return
+    tiered = TieredCache.registry.get(message.get('cache'))
+    if tiered is not None:
+        tiered.local.delete(message.get('key'))
+
+
+def _listen(redis_client):
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Invalidations may have been missed while disconnected
+            for tiered in TieredCache.registry.values():
+                tiered.local.clear()
+            for handler in _handlers.values():
+                handler(None)
+            for item in pubsub.listen():
+                try:
+                    _apply(json.loads(item['data']))
+                except (ValueError, TypeError):
+                    logger.warning(f"Ignoring malformed cache invalidation: {item['data']}")
+        except Exception as e:
+            logger.warning(f"Cache invalidation listener lost Redis connection: {str(e)}")
+            time.sleep(1)
+
+
+def ensure_listener():
+    """Start the invalidation listener thread of this process (once per pid, so forks get their own)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        redis_client = _redis_connection()
+        if redis_client is None:
+            return
+        Thread(target=_listen, args=(redis_client,), daemon=True, name="tiered-cache-listener").start()
+
+
+agent_names = TieredCache('agent_name')              # agent ID -> agent name
+agents_by_username = TieredCache('agent_by_username')  # username -> {"agent_id", "agent_name"}
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AgentViewSet, SpaceViewSet, ContextViewSet, RelationshipViewSet, get_agent_id_by_username
+from .views import AgentViewSet, SpaceViewSet, ContextViewSet, RelationshipViewSet, get_agent_id_by_username, resolve_agent_ids, get_cache_stats
 
 
 router = DefaultRouter()
@@ -10,6 +10,8 @@ router.register(r'contexts', ContextViewSet)
 router.register(r'relationships', RelationshipViewSet)
 
 urlpatterns = [
+    path("agents/resolve/", resolve_agent_ids),  # before the router, which would treat "resolve" as a pk
     path('', include(router.urls)),
     path("agents/by-username/<str:username>/", get_agent_id_by_username),
+    path("cache/stats/", get_cache_stats),
 ]
@@ -11,22 +11,53 @@ from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
+from rest_framework.parsers import MultiPartParser
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import BooleanField
 from .models import Agent, Space, Context, Relationship
-from .serializers import AgentSerializer, SpaceSerializer, ContextSerializer, RelationshipSerializer
+from .serializers import (
+    AgentSerializer, SpaceSerializer, ContextSerializer, ContextBatchItemSerializer, RelationshipSerializer,
+    over_capacity_message
+)
 from django_filters.rest_framework import DjangoFilterBackend
+from django.conf import settings
 from django.core.cache import cache
+import io
 import json
+import time
 from .filters import AgentFilter, SpaceFilter, ContextFilter
-from .pagination import StandardResultsSetPagination
-from django.db import IntegrityError
+from .scheduling import find_free_slots, find_batch_conflicts, series_q, expand_contexts
+from .recurrence import parse_rule
+from .signals import contexts_bulk_created
+from .space_solver import assign_spaces
+from .relationship_import import detect_format, import_relationships
+from .graph_index import DIRECTIONS, GraphIndexTooLarge, graph_snapshot
+from .pagination import StandardResultsSetPagination, ApproximateCountPagination
+from .caching import CachedResponseMixin, cache_stats, etag_matches, versions_etag
+from .errors import handle_api_error
+from .bulk import BulkMixin, duplicate_name_errors
+from .export import ExportMixin
+from .tiered_cache import agents_by_username, tiered_cache_stats
+from django.db import transaction
+from django.db.models import Count, Prefetch, Q
 import logging
 from mqtt_backend.comm_node_manager import CommNodeManager
-from users.models import CustomUser, AgentProfile
-from django.shortcuts import get_object_or_404
+from users.models import AgentProfile
+from django.http import Http404
 import redis
+from datetime import timedelta
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 logger = logging.getLogger('omnisyslogger')
 
+FREE_SLOTS_MAX_LIMIT = 100
+FREE_SLOTS_MAX_WINDOW = timedelta(days=92)
+BATCH_MAX_CONTEXTS = 1000
+GRAPH_MAX_HOPS = 6
+GRAPH_DEFAULT_LIMIT = 1000
+GRAPH_MAX_LIMIT = 10000
+
 """ ArchiveMixin provides reusable archive/unarchive actions for models
     with a BooleanField named 'is_archived'. Used in ModelViewSets. """
 class ArchiveMixin:
@@ -50,29 +81,36 @@ class ArchiveMixin:
         logger.info(f"User {request.user.username} unarchived {obj.__class__.__name__} ID: {obj.id}")
         return Response({'status': f'{obj.__class__.__name__.lower()} unarchived'})
 
-def handle_api_error(exception, default_message="An error occurred"):
-    """Simple helper to format error responses"""
-    error_message = str(exception) if str(exception) else default_message
-
-    # Customize based on exception type if needed
-    if isinstance(exception, IntegrityError):
-        error_message = "This operation conflicts with existing data"
-    elif isinstance(exception, ValueError):
-        error_message = f"Invalid value: {str(exception)}"
-    elif hasattr(exception, 'detail'):
-        # DRF validation errors
-        error_message = str(exception.detail)
-
-    return Response({
-        'error': error_message
-    }, status=status.HTTP_400_BAD_REQUEST)
-
-
-class AgentViewSet(ArchiveMixin, viewsets.ModelViewSet):
+def with_context_relations(queryset):
+    """
+    Load what ContextSerializer nests (space_detail, agents/agents_detail) in two extra queries
+    per page instead of two per context.
+    """
+    return queryset.select_related('space').prefetch_related(
+        Prefetch('agents', queryset=Agent.objects.only('id', 'name', 'created_at', 'is_archived'))
+    )
+
+def parse_aware_datetime(value):
+    """Parse an ISO datetime from request data, assuming the current time zone if it has none."""
+    parsed = parse_datetime(str(value)) if value else None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def parse_bool(data, name, default=False):
+    """Read a boolean from request data strictly, so that form values like "false" are False."""
+    try:
+        return BooleanField().to_internal_value(data.get(name, default))
+    except ValidationError:
+        raise ValueError(f"{name} must be true or false")
+
+
+class AgentViewSet(BulkMixin, ExportMixin, CachedResponseMixin, ArchiveMixin, viewsets.ModelViewSet):
     """
     ViewSet for Agent CRUD operations
     """
     queryset = Agent.objects.all().order_by('-created_at')
+    cache_models = (Agent,)  # models the cached responses are built from
     serializer_class = AgentSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, OrderingFilter, SearchFilter]
@@ -81,6 +119,8 @@ class AgentViewSet(ArchiveMixin, viewsets.ModelViewSet):
     ordering = ['-created_at']  # Default ordering
     search_fields = ['name']  # Fields for ?search= parameter
     pagination_class = StandardResultsSetPagination
+    bulk_update_fields = ('name', 'is_archived')
+    export_fields = ('id', 'name', 'created_at', 'is_archived')
 
     def _filter_queryset(self, queryset):
         """Apply common filtering for Agent queryset."""
@@ -146,8 +186,7 @@ class AgentViewSet(ArchiveMixin, viewsets.ModelViewSet):
 
     def retrieve(self, request, *args, **kwargs):
         try:
-            instance = self.get_object()
-            logger.debug(f"User {request.user.username} retrieving agent ID: {instance.id}")
+            logger.debug(f"User {request.user.username} retrieving agent ID: {kwargs.get('pk')}")
             return super().retrieve(request, *args, **kwargs)
         except Exception as e:
             logger.error(f"Error retrieving agent: {str(e)}")
@@ -171,11 +210,22 @@ class AgentViewSet(ArchiveMixin, viewsets.ModelViewSet):
             logger.error(f"Error deleting agent: {str(e)}")
             return handle_api_error(e, "Failed to delete agent")
 
-class SpaceViewSet(ArchiveMixin, viewsets.ModelViewSet):
+    def bulk_check(self, objects, instances):
+        return duplicate_name_errors(Agent, objects, "An agent with the name '{}' already exists")
+
+    def bulk_deleted(self, objects):
+        for obj in objects:
+            try:
+                CommNodeManager.shutdown_node(obj.id)
+            except Exception as comm_error:
+                logger.error(f"Failed to shutdown comm node of agent ID {obj.id}: {str(comm_error)}")
+
+class SpaceViewSet(BulkMixin, ExportMixin, CachedResponseMixin, ArchiveMixin, viewsets.ModelViewSet):
     """
     ViewSet for Space CRUD operations
     """
     queryset = Space.objects.all().order_by('-created_at')
+    cache_models = (Space,)
     serializer_class = SpaceSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, OrderingFilter]
@@ -183,6 +233,8 @@ class SpaceViewSet(ArchiveMixin, viewsets.ModelViewSet):
     ordering_fields = ['name', 'capacity', 'created_at']
     ordering = ['-created_at']
     pagination_class = StandardResultsSetPagination
+    bulk_update_fields = ('name', 'capacity', 'is_archived')
+    export_fields = ('id', 'name', 'capacity', 'created_at', 'is_archived')
 
     def _filter_queryset(self, queryset):
         """Apply common filtering for Space queryset."""
@@ -266,12 +318,30 @@ class SpaceViewSet(ArchiveMixin, viewsets.ModelViewSet):
             logger.error(f"Error deleting space: {str(e)}")
             return handle_api_error(e, "Failed to delete space")
 
+    def bulk_check(self, objects, instances):
+        errors = duplicate_name_errors(Space, objects, "A space with the name '{}' already exists")
+        # Capacity reductions: the agent counts of the affected spaces' contexts in one query
+        reduced = {obj.pk: index for index, obj in objects.items()
+                   if obj.pk is not None and obj.capacity < instances[obj.pk].capacity}
+        if reduced:
+            too_large = {}
+            rows = Context.objects.filter(space_id__in=list(reduced)).annotate(
+                agent_count=Count('agents')
+            ).filter(agent_count__gt=min(objects[index].capacity for index in reduced.values()))
+            for space_id, name, agent_count in rows.values_list('space_id', 'name', 'agent_count'):
+                if agent_count > objects[reduced[space_id]].capacity:
+                    too_large.setdefault(space_id, []).append(name)
+            for space_id, names in too_large.items():
+                index = reduced[space_id]
+                errors.setdefault(index, {})['capacity'] = [over_capacity_message(objects[index].capacity, names)]
+        return errors
+
     @action(detail=True, methods=['get'])
     def contexts(self, request, pk=None):
         """Get all contexts for a specific space"""
         try:
             space = self.get_object()
-            contexts = Context.objects.filter(space=space)
+            contexts = with_context_relations(Context.objects.filter(space=space))
             serializer = ContextSerializer(contexts, many=True)
             return Response(serializer.data)
         except Exception as e:
@@ -279,11 +349,12 @@ class SpaceViewSet(ArchiveMixin, viewsets.ModelViewSet):
             return handle_api_error(e, "Failed to retrieve contexts for space")
 
 
-class ContextViewSet(ArchiveMixin, viewsets.ModelViewSet):
+class ContextViewSet(BulkMixin, ExportMixin, CachedResponseMixin, ArchiveMixin, viewsets.ModelViewSet):
     """
     ViewSet for Context CRUD operations
     """
     queryset = Context.objects.all()
+    cache_models = (Context, Space, Agent)
     serializer_class = ContextSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, OrderingFilter]
@@ -291,6 +362,11 @@ class ContextViewSet(ArchiveMixin, viewsets.ModelViewSet):
     ordering_fields = ['scheduled', 'created_at']
     ordering = ['scheduled']  # Upcoming first
     pagination_class = StandardResultsSetPagination
+    keyset_ordering = ('scheduled', 'id')  # used with ?cursor=, the other viewsets page by (-created_at, -id)
+    bulk_update_fields = ('name', 'scheduled', 'ends_at', 'space_id', 'is_archived')
+    export_fields = ('id', 'name', 'scheduled', 'ends_at', 'space_id', 'created_at', 'is_archived',
+                     'recurrence_rule', 'recurrence_parent_id', 'original_start')
+    export_related_fields = ('agent_ids',)
 
     def _filter_queryset(self, queryset):
         """Apply common filtering for Context queryset."""
@@ -307,16 +383,44 @@ class ContextViewSet(ArchiveMixin, viewsets.ModelViewSet):
         # Filter by date range
         from_date = self.request.query_params.get('from_date', None)
         to_date = self.request.query_params.get('to_date', None)
-        if from_date:
-            queryset = queryset.filter(scheduled__gte=from_date)
-        if to_date:
-            queryset = queryset.filter(scheduled__lte=to_date)
+        window = self._expand_window()
+        if window:
+            # Single contexts overlapping the window and series that may recur into it
+            start, end = window
+            queryset = queryset.filter(Q(recurrence_rule='', scheduled__lt=end, ends_at__gt=start) | series_q('', start, end))
+        else:
+            if from_date:
+                queryset = queryset.filter(scheduled__gte=from_date)
+            if to_date:
+                queryset = queryset.filter(scheduled__lte=to_date)
 
         return queryset.order_by('scheduled')
 
+    def _expand_window(self):
+        """
+        Return (from_date, to_date) if a list request asks for recurring contexts to be expanded
+        into their occurrences (?expand=true), else None.
+        """
+        if self.action != 'list' or self.request.query_params.get('expand', 'false').lower() != 'true':
+            return None
+        start = parse_aware_datetime(self.request.query_params.get('from_date'))
+        end = parse_aware_datetime(self.request.query_params.get('to_date'))
+        if not start or not end or end <= start:
+            raise ValidationError("expand=true requires a from_date before the to_date")
+        if 'cursor' in self.request.query_params:
+            raise ValidationError("expand=true cannot be combined with cursor pagination")
+        return start, end
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        window = self._expand_window()
+        if window:
+            return expand_contexts(list(queryset), *window)
+        return queryset
+
     def get_queryset(self):
         """Return non-archived contexts by default, optionally include archived ones."""
-        queryset = Context.objects.all()
+        queryset = with_context_relations(Context.objects.all())
 
         archived = self.request.query_params.get("archived", "true").lower()
         if archived != "true":
@@ -470,16 +574,364 @@ class ContextViewSet(ArchiveMixin, viewsets.ModelViewSet):
             return handle_api_error(e, "Failed to remove agent from context")
 
 
-class RelationshipViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['post'])
+    def notify(self, request, pk=None):
+        """Multicast a message from an agent to all agents of a context with a single publish"""
+        try:
+            context = self.get_object()
+            agent_id = request.data.get('agent_id')
+            protocol = request.data.get('protocol')
+            msg_type = request.data.get('type')
+            payload = request.data.get('payload')
+
+            if not agent_id or not protocol or payload is None:
+                return Response({
+                    'error': 'agent_id, protocol and payload are required'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            if not Agent.objects.filter(pk=agent_id).exists():
+                return Response({
+                    'error': f'Agent with ID {agent_id} not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            CommNodeManager.send_context_message(int(agent_id), context.id, protocol, msg_type, payload)
+            recipients = context.agents.count()
+            logger.info(
+                f"User {request.user.username} sent {protocol} message from agent ID: {agent_id} "
+                f"to context ID: {context.id} ({recipients} agents)")
+            return Response({'status': 'message sent', 'recipients': recipients})
+
+        except Exception as e:
+            logger.error(f"Error sending message to context: {str(e)}")
+            return handle_api_error(e, "Failed to send message to context")
+
+    @action(detail=False, methods=['post'])
+    def free_slots(self, request):
+        """
+        Find the earliest slots in which all given agents (and optionally a space) are free.
+        Body: agent_ids, duration_minutes, window_start, window_end, optional space_id or
+        min_capacity, and limit (default 5).
+        """
+        try:
+            agent_ids = request.data.get('agent_ids') or []
+            window_start = parse_aware_datetime(request.data.get('window_start'))
+            window_end = parse_aware_datetime(request.data.get('window_end'))
+            duration = timedelta(minutes=int(request.data.get('duration_minutes', 0)))
+            limit = min(int(request.data.get('limit', 5)), FREE_SLOTS_MAX_LIMIT)
+            space_id = request.data.get('space_id')
+            min_capacity = request.data.get('min_capacity')
+
+            if not agent_ids or not window_start or not window_end:
+                return Response({
+                    'error': 'agent_ids, window_start and window_end are required'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if duration <= timedelta(0) or window_end - window_start < duration:
+                return Response({
+                    'error': 'duration_minutes must be positive and fit into the search window'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if window_end - window_start > FREE_SLOTS_MAX_WINDOW:
+                return Response({
+                    'error': f'The search window cannot exceed {FREE_SLOTS_MAX_WINDOW.days} days'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            slots = find_free_slots(
+                [int(a) for a in agent_ids], duration, window_start, window_end,
+                space_id=int(space_id) if space_id else None,
+                min_capacity=int(min_capacity) if min_capacity else None,
+                limit=max(limit, 1)
+            )
+            logger.debug(f"User {request.user.username} found {len(slots)} free slots for agents {agent_ids}")
+            return Response({'slots': slots})
+
+        except Exception as e:
+            logger.error(f"Error finding free slots: {str(e)}")
+            return handle_api_error(e, "Failed to find free slots")
+
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Validate a batch of proposed contexts against each other and against existing contexts,
+        reporting every error and conflict, and unless dry_run is set insert the accepted ones
+        (or, with all_or_nothing, only a fully valid batch) in one transaction.
+        Body: contexts (list of name, scheduled, optional ends_at and space_id, agent_ids),
+        dry_run (default false), all_or_nothing (default false).
+        """
+        try:
+            proposed = request.data.get('contexts')
+            dry_run = parse_bool(request.data, 'dry_run')
+            all_or_nothing = parse_bool(request.data, 'all_or_nothing')
+
+            if not isinstance(proposed, list) or not proposed:
+                return Response({
+                    'error': 'contexts must be a non-empty list'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            return self._schedule_batch(request, proposed, dry_run, all_or_nothing)
+
+        except Exception as e:
+            logger.error(f"Error scheduling context batch: {str(e)}")
+            return handle_api_error(e, "Failed to schedule context batch")
+
+    @action(detail=False, methods=['post'])
+    def bulk_create(self, request):
+        """
+        Bulk creation of contexts is a batch (see batch) without dry run, taking a list body
+        and ?all_or_nothing=true like the other bulk endpoints.
+        """
+        try:
+            if not isinstance(request.data, list) or not request.data:
+                return Response({'error': 'Request body must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+            return self._schedule_batch(request, request.data, False, self._all_or_nothing(request))
+
+        except Exception as e:
+            logger.error(f"Error bulk creating contexts: {str(e)}")
+            return handle_api_error(e, "Failed to bulk create contexts")
+
+    def _schedule_batch(self, request, proposed, dry_run, all_or_nothing):
+        """Validate and (unless dry_run) insert proposed contexts; the body of batch and bulk_create."""
+        if len(proposed) > BATCH_MAX_CONTEXTS:
+            return Response({
+                'error': f'A batch cannot contain more than {BATCH_MAX_CONTEXTS} contexts'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        logger.info(f"User {request.user.username} validating batch of {len(proposed)} contexts (dry_run={dry_run})")
+
+        errors = {}
+        items = {}
+        for index, data in enumerate(proposed):
+            serializer = ContextBatchItemSerializer(data=data)
+            if serializer.is_valid():
+                items[index] = serializer.validated_data
+            else:
+                errors[index] = serializer.errors
+
+        # Referenced spaces and agents are loaded once for the whole batch
+        capacities = dict(Space.objects.filter(
+            pk__in={item['space_id'] for item in items.values() if item.get('space_id') is not None}
+        ).values_list('id', 'capacity'))
+        known_agents = set(Agent.objects.filter(
+            pk__in={agent_id for item in items.values() for agent_id in item['agent_ids']}
+        ).values_list('id', flat=True))
+        for index, item in list(items.items()):
+            missing = [agent_id for agent_id in item['agent_ids'] if agent_id not in known_agents]
+            space_id = item.get('space_id')
+            if missing:
+                errors[index] = {'agent_ids': [f"Agents not found: {missing}"]}
+            elif space_id is not None and space_id not in capacities:
+                errors[index] = {'space_id': [f"Space with ID {space_id} not found"]}
+            elif space_id is not None and len(item['agent_ids']) > capacities[space_id]:
+                errors[index] = {'agent_ids': [
+                    f"Number of agents ({len(item['agent_ids'])}) exceeds space capacity ({capacities[space_id]})"]}
+            else:
+                continue
+            del items[index]
+
+        indexes = sorted(items)
+        conflicts = find_batch_conflicts([items[index] for index in indexes])
+        for conflict in conflicts:
+            conflict['index'] = indexes[conflict['index']]
+            if 'other_index' in conflict:
+                conflict['other_index'] = indexes[conflict['other_index']]
+        rejected = set(errors)
+        for conflict in conflicts:
+            rejected.add(conflict['index'])
+            rejected.add(conflict.get('other_index', conflict['index']))
+        accepted = [index for index in indexes if index not in rejected]
+
+        created = []
+        if not dry_run and accepted and not (all_or_nothing and rejected):
+            with transaction.atomic():
+                contexts = Context.objects.bulk_create([
+                    Context(name=items[index]['name'], scheduled=items[index]['scheduled'],
+                            ends_at=items[index]['ends_at'], space_id=items[index].get('space_id'))
+                    for index in accepted
+                ])
+                memberships = [
+                    (agent_id, context.pk)
+                    for index, context in zip(accepted, contexts) for agent_id in items[index]['agent_ids']
+                ]
+                Context.agents.through.objects.bulk_create(
+                    Context.agents.through(agent_id=agent_id, context_id=context_id)
+                    for agent_id, context_id in memberships
+                )
+                contexts_bulk_created(memberships)
+            created = [context.pk for context in contexts]
+            logger.info(f"User {request.user.username} created {len(created)} contexts from a batch: {created}")
+        if rejected:
+            logger.warning(f"Batch of {len(proposed)} contexts had {len(rejected)} rejected items: {sorted(rejected)}")
+
+        response_status = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        if not dry_run and not created:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'dry_run': dry_run,
+            'accepted': accepted,
+            'rejected': sorted(rejected),
+            'errors': [{'index': index, 'errors': errors[index]} for index in sorted(errors)],
+            'conflicts': conflicts,
+            'created': created,
+        }, status=response_status)
+
+    def get_bulk_queryset(self):
+        return with_context_relations(Context.objects.all())
+
+    def export_related(self, rows):
+        """The agent IDs of a chunk of exported contexts, in one query."""
+        agent_ids = {row['id']: [] for row in rows}
+        memberships = Context.agents.through.objects.filter(context_id__in=list(agent_ids)).order_by('agent_id')
+        for context_id, agent_id in memberships.values_list('context_id', 'agent_id'):
+            agent_ids[context_id].append(agent_id)
+        for row in rows:
+            row['agent_ids'] = agent_ids[row['id']]
+
+    def bulk_check(self, objects, instances):
+        """Check the updated contexts against each other and the rest of the schedule in one sweep."""
+        errors = {}
+        for index, obj in objects.items():
+            if obj.recurrence_rule:
+                errors[index] = {'id': ["Recurring contexts cannot be updated in bulk"]}
+        indexes = sorted(index for index, obj in objects.items() if not obj.is_archived and index not in errors)
+        items = [
+            {'scheduled': objects[index].scheduled, 'ends_at': objects[index].ends_at,
+             'space_id': objects[index].space_id,
+             'agent_ids': [agent.pk for agent in instances[objects[index].pk].agents.all()]}
+            for index in indexes
+        ]
+        moved = [obj.pk for obj in objects.values()]
+        for conflict in find_batch_conflicts(items, exclude_context_ids=moved):
+            index = indexes[conflict['index']]
+            field = 'scheduled' if conflict['resource'] == 'space' else 'agent_ids'
+            resource = f"{conflict['resource']} {conflict['resource_id']}"
+            if 'other_index' in conflict:
+                # Like batch, both items of a clash within the batch are rejected
+                other = indexes[conflict['other_index']]
+                errors.setdefault(index, {}).setdefault(field, []).append(f"Overlaps item {other} of this batch ({resource})")
+                errors.setdefault(other, {}).setdefault(field, []).append(f"Overlaps item {index} of this batch ({resource})")
+            else:
+                errors.setdefault(index, {}).setdefault(field, []).append(
+                    f"Scheduling conflict with: {conflict['context_name']} at {conflict['scheduled']} ({resource})")
+        return errors
+
+    @action(detail=False, methods=['post'])
+    def assign_spaces(self, request):
+        """
+        Assign spaces to the contexts of a window that have none (plus the flexible context_ids),
+        respecting capacity, existing bookings and agent conflicts.
+        Body: window_start, window_end, optional context_ids, space_ids, time_budget (seconds)
+        and commit (default false, only proposes the assignment).
+        """
+        try:
+            window_start = parse_aware_datetime(request.data.get('window_start'))
+            window_end = parse_aware_datetime(request.data.get('window_end'))
+            context_ids = [int(pk) for pk in request.data.get('context_ids') or []]
+            space_ids = request.data.get('space_ids')
+            commit = parse_bool(request.data, 'commit')
+            time_budget = min(float(request.data.get('time_budget', settings.SPACE_SOLVER_TIME_BUDGET)),
+                              settings.SPACE_SOLVER_MAX_TIME_BUDGET)
+
+            if not window_start or not window_end or window_end <= window_start:
+                return Response({
+                    'error': 'window_start and window_end are required and must form a valid window'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            logger.info(
+                f"User {request.user.username} assigning spaces from {window_start} to {window_end} "
+                f"(flexible: {context_ids}, commit={commit})")
+            result = assign_spaces(
+                window_start, window_end, context_ids=context_ids,
+                space_ids=[int(pk) for pk in space_ids] if space_ids is not None else None,
+                time_budget=max(time_budget, 0), commit=commit
+            )
+            stats = result['stats']
+            if commit:
+                logger.warning(
+                    f"User {request.user.username} assigned spaces to {len(result['assignments'])} contexts, "
+                    f"{len(result['unassigned'])} left without a space")
+            logger.info(f"Space solver stats: {stats}")
+            return Response({
+                'assignments': [
+                    {'context_id': context_id, 'space_id': space_id}
+                    for context_id, space_id in sorted(result['assignments'].items())
+                ],
+                'unassigned': result['unassigned'],
+                'agent_conflicts': result['agent_conflicts'],
+                'stats': stats,
+                'committed': commit,
+            })
+
+        except Exception as e:
+            logger.error(f"Error assigning spaces: {str(e)}")
+            return handle_api_error(e, "Failed to assign spaces")
+
+
+    @action(detail=True, methods=['post'])
+    def edit_occurrence(self, request, pk=None):
+        """
+        Edit or cancel one occurrence of a recurring context, materializing it as an exception row.
+        Body: original_start, and either cancel: true or any of name, scheduled, ends_at, space_id
+        and agent_ids.
+        """
+        try:
+            series = self.get_object()
+            original_start = parse_aware_datetime(request.data.get('original_start'))
+            cancel = parse_bool(request.data, 'cancel')
+
+            rule = parse_rule(series.recurrence_rule)
+            if rule is None:
+                return Response({
+                    'error': 'Context is not recurring'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            duration = series.ends_at - series.scheduled
+            if not original_start or original_start not in rule.occurrences(
+                    series.scheduled, duration, original_start, original_start + timedelta(microseconds=1)):
+                return Response({
+                    'error': f'Context {series.id} has no occurrence starting at {request.data.get("original_start")}'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            with transaction.atomic():
+                # Start as a cancelled occurrence, so that it replaces the occurrence but does not
+                # conflict with itself while the changes are validated
+                exception, created = Context.objects.get_or_create(
+                    recurrence_parent=series, original_start=original_start,
+                    defaults={'name': series.name, 'scheduled': original_start, 'ends_at': original_start + duration,
+                              'space': series.space, 'is_archived': True}
+                )
+                if created:
+                    exception.agents.set(series.agents.all())
+                if cancel:
+                    exception.is_archived = True
+                    exception.save()
+                else:
+                    fields = ('name', 'scheduled', 'ends_at', 'space_id', 'agent_ids')
+                    serializer = self.get_serializer(
+                        exception, data={k: v for k, v in request.data.items() if k in fields}, partial=True)
+                    serializer.is_valid(raise_exception=True)
+                    serializer.save(is_archived=False)
+
+            logger.info(
+                f"User {request.user.username} {'cancelled' if cancel else 'edited'} occurrence {original_start} "
+                f"of context ID: {series.id} as context ID: {exception.id}")
+            return Response(self.get_serializer(exception).data,
+                            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+        except Exception as e:
+            logger.error(f"Error editing context occurrence: {str(e)}")
+            return handle_api_error(e, "Failed to edit context occurrence")
+
+
+class RelationshipViewSet(BulkMixin, ExportMixin, CachedResponseMixin, viewsets.ModelViewSet):
     """
     ViewSet for Relationship CRUD operations
     """
     queryset = Relationship.objects.all()
+    cache_models = (Relationship,)
     serializer_class = RelationshipSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = StandardResultsSetPagination
+    pagination_class = ApproximateCountPagination  # relationships can grow to 100M+ rows
     ordering_fields = ['created_at', 'agent_from', 'agent_to']
     ordering = ['-created_at'] 
+    bulk_update_fields = ('agent_from', 'agent_to', 'description')
+    export_fields = ('id', 'agent_from_id', 'agent_to_id', 'description', 'created_at')
 
     def get_queryset(self):
         """Filter relationships by agent_from or agent_to"""
@@ -585,8 +1037,7 @@ class RelationshipViewSet(viewsets.ModelViewSet):
 
     def retrieve(self, request, *args, **kwargs):
         try:
-            instance = self.get_object()
-            logger.debug(f"User {request.user.username} retrieving relationship ID: {instance.id}")
+            logger.debug(f"User {request.user.username} retrieving relationship ID: {kwargs.get('pk')}")
             return super().retrieve(request, *args, **kwargs)
         except Exception as e:
             logger.error(f"Error retrieving relationship: {str(e)}")
@@ -612,16 +1063,258 @@ class RelationshipViewSet(viewsets.ModelViewSet):
             logger.error(f"Error deleting relationship: {str(e)}")
             return handle_api_error(e, "Failed to delete relationship")
 
+    def bulk_check(self, objects, instances):
+        """The self-reference and duplicate checks of create, with one query for the whole batch."""
+        errors = {}
+        pairs = {}
+        for index, obj in objects.items():
+            if obj.agent_from_id == obj.agent_to_id:
+                errors[index] = {'non_field_errors': ['An agent cannot have a relationship with itself']}
+            else:
+                pairs[index] = (obj.agent_from_id, obj.agent_to_id)
+        existing = set(Relationship.objects.filter(
+            agent_from_id__in={pair[0] for pair in pairs.values()},
+            agent_to_id__in={pair[1] for pair in pairs.values()},
+        ).exclude(pk__in=[obj.pk for obj in objects.values() if obj.pk is not None]).values_list(
+            'agent_from_id', 'agent_to_id'))
+        seen = set()
+        for index in sorted(pairs):
+            agent_from_id, agent_to_id = pairs[index]
+            if pairs[index] in existing:
+                errors[index] = {'non_field_errors': [
+                    f'Relationship already exists from agent {agent_from_id} to agent {agent_to_id}']}
+            elif pairs[index] in seen:
+                errors[index] = {'non_field_errors': ['Relationship is listed twice in this batch']}
+            seen.add(pairs[index])
+        return errors
+
+    @action(detail=False, methods=['post'], parser_classes=[MultiPartParser])
+    def upload(self, request):
+        """
+        Import relationships from an uploaded CSV or NDJSON file (multipart field `file`, optional
+        `format`) in batches; see api.relationship_import. Admins only. For very large files
+        use the import_relationships management command instead.
+        """
+        if getattr(request.user, 'role', None) != 'admin':
+            return Response({"error": "Admin access required"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+            fmt = request.data.get('format') or detect_format(upload.name)
+            if fmt is None:
+                return Response({'error': 'Cannot tell the format from the file name, pass format'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            logger.info(f"User {request.user.username} importing relationships from {upload.name} ({upload.size} bytes)")
+
+            def progress(stats):
+                logger.info(f"Relationship import from {upload.name}: {stats}")
+
+            # Large uploads are spooled to a temporary file by Django, and the import reads it in batches
+            stream = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+            stats, errors = import_relationships(stream, fmt, progress=progress)
+            logger.info(f"Imported {stats['inserted']} relationships from {upload.name}")
+            return Response({'stats': stats, 'errors': errors})
+
+        except Exception as e:
+            logger.error(f"Error importing relationships: {str(e)}")
+            return handle_api_error(e, "Failed to import relationships")
+
+    # -- relationship graph (see api.graph_index) --------------------------------
+
+    @staticmethod
+    def _graph_node(request, index, name):
+        """Return the node of the agent ID in query parameter name; agents without edges are isolated nodes."""
+        value = request.query_params.get(name)
+        if value is None:
+            raise ValueError(f"{name} is required")
+        agent_id = int(value)
+        node = index.node(agent_id)
+        if node is None:
+            if not Agent.objects.filter(pk=agent_id).exists():
+                raise Http404(f"Agent with ID {agent_id} not found")
+            node = index.node(agent_id, create=True)  # created after the index was built
+        return node
+
+    def _graph_response(self, request, query, run):
+        """Run run(index, direction) against the graph index; query names it in logs and errors."""
+        started = time.perf_counter()
+        try:
+            direction = request.query_params.get('direction', 'out')
+            if direction not in DIRECTIONS:
+                return Response({
+                    'error': f"direction must be one of {', '.join(DIRECTIONS)}"
+                }, status=status.HTTP_400_BAD_REQUEST)
+            data = run(graph_snapshot(), direction)
+            data['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            logger.debug(
+                f"User {request.user.username} queried relationship graph {query} "
+                f"with params: {request.query_params} in {data['elapsed_ms']} ms")
+            return Response(data)
+
+        except Http404 as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except GraphIndexTooLarge as e:
+            logger.error(f"Relationship graph index unavailable: {str(e)}")
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            logger.error(f"Error querying relationship graph {query}: {str(e)}")
+            return handle_api_error(e, f"Failed to query relationship graph {query}")
+
+    @action(detail=False, methods=['get'])
+    def graph_neighbourhood(self, request):
+        """
+        Agents within `hops` (1-6, default 1) relationships of `agent`, nearest first.
+        Query params: agent, hops, direction (out, in or both; default out), limit.
+        """
+        def run(index, direction):
+            hops = int(request.query_params.get('hops', 1))
+            limit = int(request.query_params.get('limit', GRAPH_DEFAULT_LIMIT))
+            if not 1 <= hops <= GRAPH_MAX_HOPS:
+                raise ValueError(f"hops must be between 1 and {GRAPH_MAX_HOPS}")
+            if not 1 <= limit <= GRAPH_MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {GRAPH_MAX_LIMIT}")
+            node = self._graph_node(request, index, 'agent')
+            reached, distances = index.neighbourhood(node, hops, direction)
+            neighbours = sorted(zip(distances.tolist(), index.agent_ids(reached)))
+            return {
+                'agent': int(request.query_params['agent']),
+                'direction': direction,
+                'hops': hops,
+                'count': len(neighbours),
+                'truncated': len(neighbours) > limit,
+                'agents': [{'agent_id': agent_id, 'distance': distance} for distance, agent_id in neighbours[:limit]],
+            }
+        return self._graph_response(request, 'neighbourhood', run)
+
+    @action(detail=False, methods=['get'])
+    def graph_path(self, request):
+        """Shortest relationship path between two agents. Query params: from, to, direction."""
+        def run(index, direction):
+            source = self._graph_node(request, index, 'from')
+            target = self._graph_node(request, index, 'to')
+            path = index.shortest_path(source, target, direction)
+            return {
+                'from': int(request.query_params['from']),
+                'to': int(request.query_params['to']),
+                'direction': direction,
+                'reachable': path is not None,
+                'distance': len(path) - 1 if path is not None else None,
+                'path': index.agent_ids(path) if path is not None else [],
+            }
+        return self._graph_response(request, 'path', run)
+
+    @action(detail=False, methods=['get'])
+    def graph_reachability(self, request):
+        """
+        Number of agents reachable from `agent` at any depth, or with `to` whether that agent is
+        reachable. Query params: agent, direction, optional to.
+        """
+        def run(index, direction):
+            source = self._graph_node(request, index, 'agent')
+            data = {'agent': int(request.query_params['agent']), 'direction': direction}
+            if request.query_params.get('to') is not None:
+                target = self._graph_node(request, index, 'to')
+                distance = index.bfs(source, direction, target=target).depth(target)
+                data.update(to=int(request.query_params['to']), reachable=distance is not None, distance=distance)
+            else:
+                data['count'] = index.bfs(source, direction).count()
+            return data
+        return self._graph_response(request, 'reachability', run)
+
+    @action(detail=False, methods=['get'])
+    def graph_cycles(self, request):
+        """
+        Cycle detection: with `agent` a shortest cycle through that agent, otherwise whether the
+        whole graph has a cycle, one example and how many agents lie on or after a cycle.
+        """
+        def run(index, direction):
+            if request.query_params.get('agent') is not None:
+                cycle = index.shortest_cycle(self._graph_node(request, index, 'agent'))
+                return {
+                    'agent': int(request.query_params['agent']),
+                    'has_cycle': cycle is not None,
+                    'cycle': index.agent_ids(cycle) if cycle is not None else [],
+                }
+            remaining = index.cyclic_nodes()
+            has_cycle = bool(remaining.any())
+            return {
+                'has_cycle': has_cycle,
+                'cycle': index.agent_ids(index.find_cycle(remaining)) if has_cycle else [],
+                'cyclic_agents': int(remaining.sum()),
+            }
+        return self._graph_response(request, 'cycles', run)
+
+    @action(detail=False, methods=['get'])
+    def graph_stats(self, request):
+        """Size, memory use and age of this process' graph index. Admins only."""
+        if getattr(request.user, 'role', None) != 'admin':
+            return Response({"error": "Admin access required"}, status=status.HTTP_403_FORBIDDEN)
+        return self._graph_response(request, 'stats', lambda index, direction: index.stats())
+
 @api_view(['GET'])
 def get_agent_id_by_username(request, username):
     """Return the agent_id from an agent username based on CustomUser table"""
-    user = get_object_or_404(CustomUser, username=username)
-    agent_profile = get_object_or_404(AgentProfile, user=user)
-    agent = get_object_or_404(Agent, id=agent_profile.agent_object.id, is_archived=False)
-    if agent.is_archived:
-        return Response({"error": "Agent is archived"}, status=404)
+    def load():
+        return AgentProfile.objects.filter(
+            user__username=username, agent_object__is_archived=False
+        ).values('agent_object_id', 'agent_object__name').first()
+
+    # Served from the per-process / Redis lookup cache, invalidated by api.signals
+    agent = agents_by_username.get(username, load)
+    if agent is None:
+        raise Http404("Agent not found")
 
     return Response({
-        "agent_id": agent.id,
-        "agent_name": agent.name
-    })
\ No newline at end of file
+        "agent_id": agent['agent_object_id'],
+        "agent_name": agent['agent_object__name']
+    })
+
+@api_view(['GET'])
+def get_cache_stats(request):
+    """Return response cache hit ratios per resource and this process' lookup cache tiers (admins only)"""
+    if getattr(request.user, 'role', None) != 'admin':
+        return Response({"error": "Admin access required"}, status=status.HTTP_403_FORBIDDEN)
+    return Response({'responses': cache_stats(), 'lookups': tiered_cache_stats()})
+
+AGENT_RESOLVE_MAX_USERNAMES = 1000
+
+@api_view(['GET', 'POST'])
+def resolve_agent_ids(request):
+    """
+    Return the agent_id of many agent usernames in one joined query.
+    GET ?usernames=a,b,c or POST {"usernames": [...]}. The response carries an ETag derived from
+    the cache versions of agents and agent profiles, so clients can revalidate a cached directory
+    with If-None-Match and get a 304 back without the query running.
+    """
+    if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({"error": "Expected a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+        usernames = request.data.get('usernames') or []
+    else:
+        usernames = [u for u in request.query_params.get('usernames', '').split(',') if u]
+    if not isinstance(usernames, list) or not usernames:
+        return Response({"error": "usernames is required"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(usernames) > AGENT_RESOLVE_MAX_USERNAMES:
+        return Response({"error": f"At most {AGENT_RESOLVE_MAX_USERNAMES} usernames per request"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    usernames = sorted(set(map(str, usernames)))
+    try:
+        etag = versions_etag((Agent, AgentProfile), usernames)
+    except Exception as e:
+        logger.warning(f"Response cache unavailable, serving agent directory without ETag: {str(e)}")
+        etag = None
+    if etag and etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    rows = AgentProfile.objects.filter(
+        user__username__in=usernames, agent_object__is_archived=False
+    ).values_list('user__username', 'agent_object_id', 'agent_object__name')
+    agents = {username: {"agent_id": agent_id, "agent_name": name} for username, agent_id, name in rows}
+    data = {
+        "agents": agents,
+        "missing": [username for username in usernames if username not in agents],
+    }
+    return Response(data, headers={'ETag': etag} if etag else {})
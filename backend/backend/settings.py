@@ -168,4 +168,58 @@ CACHES = {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
     }
-}
\ No newline at end of file
+}
+# Communication node sharding: with COMM_SHARDING enabled, agents' MQTT nodes are distributed
+# over comm shards with consistent hashing instead of being started in every process.
+# Shards are either the web workers themselves (COMM_SHARD_IN_WORKERS) or dedicated
+# `python manage.py run_comm_shard` processes.
+COMM_SHARDING = os.getenv('COMM_SHARDING', 'False') == 'True'
+COMM_SHARD_IN_WORKERS = os.getenv('COMM_SHARD_IN_WORKERS', 'False') == 'True'
+
+# Dispatcher mode: instead of one MQTT session per agent, a few consumer clients subscribe to
+# comm/+ and dispatch to the agents' nodes. Set COMM_DISPATCHER_SHARED_GROUP to use an EMQX
+# shared subscription ($share/<group>/comm/+) so several consumers/shards split inbound load.
+COMM_DISPATCHER_MODE = os.getenv('COMM_DISPATCHER_MODE', 'False') == 'True'
+COMM_DISPATCHER_CONSUMERS = int(os.getenv('COMM_DISPATCHER_CONSUMERS', '1'))
+COMM_DISPATCHER_SHARED_GROUP = os.getenv('COMM_DISPATCHER_SHARED_GROUP', '')
+
+# Outbound comm buffer limits (Redis is shared with the cache). Messages beyond the caps, or
+# older than their TTL, are moved to a dead-letter list; see `manage.py replay_dead_letters`.
+COMM_BUFFER_MAX_MESSAGES_PER_DESTINATION = int(os.getenv('COMM_BUFFER_MAX_MESSAGES_PER_DESTINATION', '10000'))
+COMM_BUFFER_MAX_BYTES_PER_DESTINATION = int(os.getenv('COMM_BUFFER_MAX_BYTES_PER_DESTINATION', str(256 * 1024 * 1024)))
+COMM_BUFFER_MAX_MESSAGES = int(os.getenv('COMM_BUFFER_MAX_MESSAGES', '500000'))
+COMM_BUFFER_MAX_BYTES = int(os.getenv('COMM_BUFFER_MAX_BYTES', str(1024 * 1024 * 1024)))
+COMM_BUFFER_DEFAULT_TTL = int(os.getenv('COMM_BUFFER_DEFAULT_TTL', str(24 * 60 * 60)))
+COMM_DEAD_LETTER_MAX = int(os.getenv('COMM_DEAD_LETTER_MAX', '100000'))
+# Storage of the outbound comm buffer: 'list' (Redis lists) or 'streams' (Redis Streams with a
+# consumer group: batched reads, acknowledgement after publish, recovery of pending entries).
+COMM_BUFFER_BACKEND = os.getenv('COMM_BUFFER_BACKEND', 'list')
+
+# Response caching of the api viewsets' list/retrieve (see api/caching.py). Entries are invalidated
+# through version counters bumped by model signals; the TTL only bounds how long stale entries linger.
+API_CACHE_ENABLED = os.getenv('API_CACHE_ENABLED', 'True') == 'True'
+API_CACHE_TTL = int(os.getenv('API_CACHE_TTL', 300))
+
+# Per-process LRU tier in front of Redis for hot lookups (see api/tiered_cache.py). Invalidations
+# are broadcast over Redis pub/sub; the local TTL bounds staleness if a broadcast is missed.
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 1024))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', 60))
+
+# Paginated lists using ApproximateCountPagination report the Postgres planner's row estimate
+# instead of an exact COUNT(*) once the estimate reaches this many rows.
+API_APPROXIMATE_COUNT_THRESHOLD = int(os.getenv('API_APPROXIMATE_COUNT_THRESHOLD', 100000))
+
+# Time budget (seconds) of the space assignment solver (see api/space_solver.py); requests may ask
+# for less but never more than SPACE_SOLVER_MAX_TIME_BUDGET.
+SPACE_SOLVER_TIME_BUDGET = float(os.getenv('SPACE_SOLVER_TIME_BUDGET', 2))
+SPACE_SOLVER_MAX_TIME_BUDGET = float(os.getenv('SPACE_SOLVER_MAX_TIME_BUDGET', 30))
+
+# Rows per batch of the relationship import (see api/relationship_import.py); memory use of an
+# import is bounded by the batch size, not the file size.
+RELATIONSHIP_IMPORT_BATCH_SIZE = int(os.getenv('RELATIONSHIP_IMPORT_BATCH_SIZE', 10000))
+
+# In-memory relationship graph index (see api/graph_index.py): about 8 bytes per relationship and
+# process. It is not built above GRAPH_INDEX_MAX_EDGES relationships, and is rebuilt once more than
+# GRAPH_INDEX_MAX_DELTA changes have piled up since the last build.
+GRAPH_INDEX_MAX_EDGES = int(os.getenv('GRAPH_INDEX_MAX_EDGES', 200_000_000))
+GRAPH_INDEX_MAX_DELTA = int(os.getenv('GRAPH_INDEX_MAX_DELTA', 100000))
@@ -0,0 +1,12 @@
+"""
+Gunicorn settings for the backend (gunicorn -c gunicorn.conf.py backend.wsgi).
+
+Startup work that must only happen in serving processes, not in every process that loads
+Django (migrate, test, run_comm_shard), is started from the worker hooks below.
+"""
+
+
+def post_worker_init(worker):
+    """Called in each worker once the Django application is loaded."""
+    from api.apps import start_worker_shard
+    start_worker_shard()
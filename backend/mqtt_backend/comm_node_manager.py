@@ -1,4 +1,9 @@
-from mqtt_backend.core.base_node import BaseNode
+from mqtt_backend.core.base_node import BaseNode, BROKER, PORT, build_envelope, context_destination
+from mqtt_backend.core.config import get_bool_setting, get_int_setting, get_setting
+from mqtt_backend.core.dispatcher import Dispatcher
+from mqtt_backend.core.buffer import get_buffer
+from mqtt_backend import sharding
+import json
 import logging
 
 logger = logging.getLogger('omnisyslogger')
@@ -12,14 +17,90 @@ class CommNodeManager:
     The nodes are created with only the agent_id, as the broker and port are predefined.
     The class uses a class-level dictionary to keep track of live nodes, ensuring that only one
     instance of BaseNode exists for each agent_id.
+
+    With COMM_SHARDING enabled, live_nodes only holds the nodes owned by this process' shard
+    (see mqtt_backend.sharding). Requests for agents owned by another shard are forwarded to
+    that shard over Redis instead of opening a second MQTT client with the same client ID.
+
+    With COMM_DISPATCHER_MODE enabled, nodes share the clients of a single Dispatcher that
+    subscribes to `comm/+` (or `$share/<COMM_DISPATCHER_SHARED_GROUP>/comm/+`) instead of
+    opening one MQTT session per agent.
+
+    Nodes listen to the multicast topics of the contexts their agent belongs to. The backend keeps
+    these memberships in sync through join_context/leave_context and sets membership_provider
+    so that newly created nodes join their existing contexts.
     """
     live_nodes = {}
+    shard = None  # CommShard of this process, if it takes part in sharding
+    dispatcher = None  # shared Dispatcher, if dispatcher mode is enabled
+    membership_provider = None  # callable(agent_id) -> context IDs the agent is a member of
+
+    @classmethod
+    def get_dispatcher(cls):
+        """Return the process-wide dispatcher, or None if nodes use their own MQTT sessions."""
+        if not get_bool_setting("COMM_DISPATCHER_MODE", False):
+            return None
+        if cls.dispatcher is None:
+            shared_group = get_setting("COMM_DISPATCHER_SHARED_GROUP", "") or None
+            cls.dispatcher = Dispatcher(
+                BROKER, PORT,
+                consumers=get_int_setting("COMM_DISPATCHER_CONSUMERS", 1),
+                shared_group=shared_group,
+                # With a shared subscription the broker may hand us messages for agents owned
+                # by another shard; without one every shard sees every message anyway.
+                on_unroutable=cls._forward_unroutable if shared_group else None,
+            )
+        return cls.dispatcher
+
+    @classmethod
+    def _forward_unroutable(cls, agent_id, msg):
+        """Forward an inbound message for a non-local agent to its owning shard."""
+        if not cls.sharding_enabled():
+            logger.debug(f"Dispatcher received message for agent {agent_id} without a local node")
+            return
+        try:
+            message = json.loads(msg.payload.decode())
+        except Exception as e:
+            logger.error(f"Error decoding message for agent {agent_id}: {e}")
+            return
+        sharding.send_command(agent_id, {"op": "deliver", "message": message})
+
+    @classmethod
+    def sharding_enabled(cls):
+        return get_bool_setting("COMM_SHARDING", False)
+
+    @classmethod
+    def is_local(cls, agent_id):
+        """Return True if nodes for this agent are owned by the current process."""
+        if not cls.sharding_enabled():
+            return True
+        return cls.shard is not None and cls.shard.owns(agent_id)
+
+    @classmethod
+    def start_shard(cls, agent_provider, shard_id=None):
+        """Join the shard ring and take over the nodes of the agents this process owns."""
+        if cls.shard is None:
+            cls.shard = sharding.CommShard(agent_provider, cls, shard_id=shard_id)
+            cls.shard.start()
+        return cls.shard
+
+    @classmethod
+    def stop_shard(cls):
+        """Leave the shard ring and shut down all local nodes."""
+        if cls.shard is not None:
+            cls.shard.stop()
+            cls.shard = None
 
     @classmethod
     def create_node(cls, agent_id):
         """Create a new communication node for the specified agent ID or reuse an existing one."""
+        if not cls.is_local(agent_id):
+            sharding.send_command(agent_id, {"op": "create_node"})
+            logger.info(f"Requested node creation for agent {agent_id} from its owning shard")
+            return None
+
         if agent_id not in cls.live_nodes:
-            node = BaseNode(str(agent_id))  # Only agent_id needed
+            node = BaseNode(str(agent_id), dispatcher=cls.get_dispatcher())
             try:
                 node.start()
                 logger.info(f"Started BaseNode thread for {agent_id}")
@@ -27,6 +108,9 @@ class CommNodeManager:
             except Exception as e:
                 logger.error(f"Failed to start BaseNode for {agent_id}: {str(e)}")
             cls.live_nodes[agent_id] = node
+            if cls.membership_provider:
+                for context_id in cls.membership_provider(agent_id):
+                    node.join_context(context_id)
             logger.info(f"Created new node for agent {agent_id}")
             logger.debug(f"Live nodes after creation: {cls.live_nodes.keys()}")
             return node
@@ -41,12 +125,64 @@ class CommNodeManager:
         if node:
             node.shutdown()
             logger.info(f"Node for agent {agent_id} shut down successfully")
+        elif not cls.is_local(agent_id):
+            sharding.send_command(agent_id, {"op": "shutdown_node"})
 
     @classmethod
     def get_node(cls, agent_id):
         """Retrieve the communication node for the specified agent ID."""
         return cls.live_nodes.get(agent_id)
 
+    @classmethod
+    def send_message(cls, agent_id, destination, protocol, msg_type, payload):
+        """
+        Send a message on behalf of an agent, wherever its node lives.
+        If the owning shard is not reachable the message is written to the agent's Redis buffer,
+        which the owning node drains once it is (re)started.
+        """
+        node = cls.get_node(agent_id)
+        if node:
+            node.send_message(destination, protocol, msg_type, payload)
+            return
+        if cls.is_local(agent_id):
+            cls.create_node(agent_id).send_message(destination, protocol, msg_type, payload)
+            return
+
+        received = sharding.send_command(agent_id, {
+            "op": "send",
+            "destination": str(destination),
+            "protocol": protocol,
+            "type": msg_type,
+            "payload": payload,
+        })
+        if not received:
+            envelope = build_envelope(str(agent_id), str(destination), protocol, msg_type, payload)
+            get_buffer(sharding.get_redis(), agent_id).push(str(destination), envelope)
+            logger.warning(f"Owning shard for agent {agent_id} unreachable, buffered message to {destination}")
+
+    @classmethod
+    def send_context_message(cls, agent_id, context_id, protocol, msg_type, payload):
+        """Multicast a message from an agent to all members of a context with one publish."""
+        cls.send_message(agent_id, context_destination(context_id), protocol, msg_type, payload)
+
+    @classmethod
+    def join_context(cls, agent_id, context_id):
+        """Subscribe the agent's node to a context's multicast topic."""
+        node = cls.get_node(agent_id)
+        if node:
+            node.join_context(context_id)
+        elif not cls.is_local(agent_id):
+            sharding.send_command(agent_id, {"op": "join_context", "context_id": str(context_id)})
+
+    @classmethod
+    def leave_context(cls, agent_id, context_id):
+        """Unsubscribe the agent's node from a context's multicast topic."""
+        node = cls.get_node(agent_id)
+        if node:
+            node.leave_context(context_id)
+        elif not cls.is_local(agent_id):
+            sharding.send_command(agent_id, {"op": "leave_context", "context_id": str(context_id)})
+
     @classmethod
     def rebuild_all(cls, agent_ids):
         """Rebuild all nodes for the specified list of agent IDs."""
@@ -60,4 +196,7 @@ class CommNodeManager:
         for node in list(cls.live_nodes.values()):
             node.shutdown()
         cls.live_nodes.clear()
+        if cls.dispatcher is not None:
+            cls.dispatcher.stop()
+            cls.dispatcher = None
         logger.info("All nodes shut down successfully")
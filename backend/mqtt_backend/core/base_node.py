@@ -5,6 +5,8 @@ import redis
 from threading import Thread, Event
 from paho.mqtt.client import Client
 from .protocol_router import ProtocolRouter
+from .config import REDIS_HOST, REDIS_PORT, REDIS_DB
+from .buffer import get_buffer
 
 BROKER = "localhost"
 PORT = 1883
@@ -12,23 +14,48 @@ RETRY_INTERVAL = 10  # seconds
 
 logger = logging.getLogger('omnisyslogger')
 
+
+def context_destination(context_id):
+    """Destination of a context multicast; published to 'comm/context/<context_id>'."""
+    return f"context/{context_id}"
+
+
+def build_envelope(source, destination, protocol, msg_type, payload):
+    """Build the JSON envelope that wraps every message sent between nodes."""
+    return {
+        "protocol": protocol,
+        "type": msg_type,
+        "source": source,
+        "destination": destination,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "payload": payload,
+    }
+
+
 class BaseNode:
     """
     Base class for all communication nodes
     This class handles MQTT connection, message sending, receiving, and retrying buffered messages.
-    It uses Redis for buffering messages when the broker is down.
+    It uses Redis for buffering messages when the broker is down, in priority lanes (see buffer.py).
     """
-    def __init__(self, object_id, broker=BROKER, port=PORT):
-        """Initialize the BaseNode with an object ID, broker address, and port."""
+    def __init__(self, object_id, broker=BROKER, port=PORT, dispatcher=None):
+        """
+        Initialize the BaseNode with an object ID, broker address, and port.
+        If a Dispatcher is given, the node does not open its own MQTT session: it is registered
+        with the dispatcher for inbound messages and publishes through the dispatcher's clients.
+        """
         self.object_id = object_id
         self.broker = broker
         self.port = port
+        self.dispatcher = dispatcher
 
         self.client = None
         self._thread = None
+        self.contexts = set()  # IDs of the contexts whose multicast topic this node listens to
 
         # Redis client
-        self.redis = redis.Redis(host="localhost", port=6379, db=1)
+        self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self.buffer = get_buffer(self.redis, self.object_id)
         self._retry_stop_event = Event()
         self._retry_thread = Thread(target=self._periodic_retry_loop, daemon=True)
 
@@ -36,7 +63,9 @@ class BaseNode:
 
     def start(self):
         """Start the MQTT client loop and retry thread."""
-        if not self._thread:
+        if self.dispatcher:
+            self.dispatcher.start()
+        elif not self._thread:
             self._thread = Thread(target=self.client.loop_start, daemon=True)
             self._thread.start()
         if not self._retry_thread.is_alive():
@@ -45,21 +74,18 @@ class BaseNode:
     def stop(self):
         """Stop the MQTT client loop and retry thread."""
         self._retry_stop_event.set()
-        if self.client:
+        if self.dispatcher:
+            for context_id in list(self.contexts):
+                self.dispatcher.leave_context(context_id, self)
+            self.dispatcher.unregister(self.object_id)
+        elif self.client:
             self.client.disconnect()
             self.client.loop_stop()
         logger.info(f"[Object: {self.object_id}] MQTT client disconnected and loop stopped.")
 
     def send_message(self, destination, protocol, msg_type, payload):
         """Send a message to a destination using MQTT."""
-        envelope = {
-            "protocol": protocol,
-            "type": msg_type,
-            "source": self.object_id,
-            "destination": destination,
-            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-            "payload": payload,
-        }
+        envelope = build_envelope(self.object_id, destination, protocol, msg_type, payload)
         topic = f"comm/{destination}"
         try:
             result = self.client.publish(topic, json.dumps(envelope))
@@ -67,8 +93,32 @@ class BaseNode:
             if result.rc != 0:
                 raise Exception(f"MQTT publish failed, rc={result.rc}")
         except Exception as e:
-            logger.warning(f"MQTT send failed, buffering message: {e}")
-            self.redis.lpush(f"buffer:{self.object_id}:{destination}", json.dumps(envelope))
+            lane = self.buffer.push(destination, envelope)
+            logger.warning(f"MQTT send failed, buffering message in {lane} lane: {e}")
+
+    def send_context_message(self, context_id, protocol, msg_type, payload):
+        """Multicast a message to all members of a context with a single publish."""
+        self.send_message(context_destination(context_id), protocol, msg_type, payload)
+
+    def join_context(self, context_id):
+        """Start listening to the multicast topic of a context."""
+        context_id = str(context_id)
+        self.contexts.add(context_id)
+        if self.dispatcher:
+            self.dispatcher.join_context(context_id, self)
+        else:
+            self.client.subscribe(f"comm/{context_destination(context_id)}", qos=1)
+        logger.info(f"[Object: {self.object_id}] Joined context {context_id}")
+
+    def leave_context(self, context_id):
+        """Stop listening to the multicast topic of a context."""
+        context_id = str(context_id)
+        self.contexts.discard(context_id)
+        if self.dispatcher:
+            self.dispatcher.leave_context(context_id, self)
+        else:
+            self.client.unsubscribe(f"comm/{context_destination(context_id)}")
+        logger.info(f"[Object: {self.object_id}] Left context {context_id}")
 
     def on_message(self, client, userdata, msg):
         """
@@ -80,6 +130,8 @@ class BaseNode:
         print(f"📦 Payload (raw): {payload_raw}")
         try:
             message = json.loads(payload_raw)
+            if message.get('source') == self.object_id and msg.topic.startswith("comm/context/"):
+                return  # own multicast echoed back by the broker
             print(f"📦 Payload (parsed):\n{json.dumps(message, indent=2)}")
             self.handle_message(message)
         except Exception as e:
@@ -107,6 +159,10 @@ class BaseNode:
 
     def connect(self):
         """Connect to EMQX broker with no authentication."""
+        if self.dispatcher:
+            self.client = self.dispatcher.publisher()
+            self.dispatcher.register(self)
+            return
         self.client = Client(client_id=self.object_id)
         self.client.user_data_set(self)
         self.client.on_connect = self._on_connect
@@ -125,33 +181,23 @@ class BaseNode:
             topic = f"comm/{self.object_id}"
             client.subscribe(topic, qos=1)
             logger.info(f"[Object: {self.object_id}] Subscribed to {topic}")
+            for context_id in self.contexts:
+                client.subscribe(f"comm/{context_destination(context_id)}", qos=1)
         else:
             logger.warning(f"[Object: {self.object_id}] Failed to connect with code {rc}")
 
     def retry_buffered_messages_all(self):
-        """Retry all buffered messages for this node, for all destinations."""
-        pattern = f"buffer:{self.object_id}:*"
-        for key in self.redis.scan_iter(pattern):
-            parts = key.decode().split(":")
-            if len(parts) == 3:
-                destination = parts[2]
-                self._retry_single_destination(destination)
+        """Retry all buffered messages for this node, for all destinations, urgent lanes first."""
+        self.buffer.drain(self._publish_buffered)
 
     def _retry_single_destination(self, destination):
         """Retry buffered messages for a specific destination."""
-        key = f"buffer:{self.object_id}:{destination}"
-        while True:
-            msg_json = self.redis.rpop(key)
-            if not msg_json:
-                break
-            try:
-                result = self.client.publish(f"comm/{destination}", msg_json)
-                if result.rc != 0:
-                    raise Exception("MQTT publish failed during retry")
-            except Exception as e:
-                logger.warning(f"Retry failed for {destination}, re-buffering message: {e}")
-                self.redis.lpush(key, msg_json)
-                break  # Stop if broker is down
+        self.buffer.drain(self._publish_buffered, destination)
+
+    def _publish_buffered(self, destination, msg_json):
+        result = self.client.publish(f"comm/{destination}", msg_json)
+        if result.rc != 0:
+            raise Exception("MQTT publish failed during retry")
 
     def _periodic_retry_loop(self):
         while not self._retry_stop_event.is_set():
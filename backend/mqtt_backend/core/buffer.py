@@ -0,0 +1,544 @@
+import json
+import logging
+import os
+import socket
+import time
+from .config import get_int_setting, get_setting
+
+"""
+Outbound message buffer of the server nodes.
+
+Messages that cannot be published are buffered in Redis per source, destination and priority
+lane (`buffer:<source>:<destination>:<lane>`). Lanes are derived from the protocol and message
+type, so a critical HL7 alert never waits behind a backlog of DICOM transfers:
+
+    urgent  -> always drained first, across all destinations
+    normal  -> drained with weight LANE_WEIGHTS['normal'] per round
+    bulk    -> drained with weight LANE_WEIGHTS['bulk'] per round (slower, but never starved)
+
+Per-lane counters are kept in `bufstats:<lane>` for monitoring.
+
+The buffer is bounded because its Redis is shared with the Django cache: every message carries a
+TTL derived from its protocol and type, and there are count and byte caps per destination and
+globally. A destination over its cap loses its oldest messages, lowest lane first. Over the global
+cap the oldest bulk messages of all sources go first, then the oldest normal ones; urgent messages
+are never evicted for the global cap (they are bounded by the destination caps and their short
+TTL). To find the oldest messages without scanning the keyspace, the bulk and normal keys are kept
+in a sorted set per backend and lane (`bufindex:<prefix>:<lane>`) scored by a lower bound of the
+buffered_at of their oldest message, corrected lazily when eviction looks at a key. Expired messages (found while draining) and evicted ones are moved to a capped dead-letter
+list `deadletter:<source>` of their source, with eviction counters in `bufstats:evictions`. Dead letters can be re-injected with the
+`replay_dead_letters` management command.
+
+Two storage backends are available, selected with the COMM_BUFFER_BACKEND setting:
+
+    list     (default) one Redis list per key, LPUSH/RPOP
+    streams  one Redis stream per key (`bufstream:<source>:<destination>:<lane>`) read through a
+             consumer group: entries are read in batches with XREADGROUP, acknowledged and deleted
+             only after a successful publish, and entries left pending by a crashed consumer are
+             reclaimed with XAUTOCLAIM, so a crash between read and publish loses nothing.
+             Evictions read their victim through the same group (as consumer `evictor`), so an
+             entry is either published or dead-lettered, never both; entries already read by a
+             drainer are not evicted. Only the process whose XDEL removed an entry accounts for it.
+"""
+
+logger = logging.getLogger('omnisyslogger')
+
+URGENT = "urgent"
+NORMAL = "normal"
+BULK = "bulk"
+LANES = (URGENT, NORMAL, BULK)
+
+# Messages drained per lane in each weighted round (urgent is always drained completely first)
+LANE_WEIGHTS = {NORMAL: 4, BULK: 1}
+URGENT_RESCAN_ROUNDS = 20  # look for newly buffered urgent destinations every N weighted rounds
+
+# (protocol, message type) -> lane; a type of None matches all types of the protocol
+PRIORITY_RULES = {
+    ("HL7", "alert"): URGENT,
+    ("HL7", "alarm"): URGENT,
+    ("HL7", "critical"): URGENT,
+    ("HL7", None): NORMAL,
+    ("DICOM", None): BULK,
+}
+
+# (protocol, message type) -> seconds a buffered message stays deliverable
+TTL_RULES = {
+    ("HL7", "alert"): 60 * 60,
+    ("HL7", "alarm"): 60 * 60,
+    ("HL7", "critical"): 60 * 60,
+    ("HL7", None): 24 * 60 * 60,
+    ("DICOM", None): 6 * 60 * 60,
+}
+DEFAULT_TTL = get_int_setting("COMM_BUFFER_DEFAULT_TTL", 24 * 60 * 60)
+
+MAX_MESSAGES_PER_DESTINATION = get_int_setting("COMM_BUFFER_MAX_MESSAGES_PER_DESTINATION", 10000)
+MAX_BYTES_PER_DESTINATION = get_int_setting("COMM_BUFFER_MAX_BYTES_PER_DESTINATION", 256 * 1024 * 1024)
+MAX_MESSAGES = get_int_setting("COMM_BUFFER_MAX_MESSAGES", 500000)
+MAX_BYTES = get_int_setting("COMM_BUFFER_MAX_BYTES", 1024 * 1024 * 1024)
+DEAD_LETTER_MAX = get_int_setting("COMM_DEAD_LETTER_MAX", 100000)  # per source
+
+STREAM_GROUP = "drain"
+STREAM_EVICTOR = "evictor"  # consumer name under which evictions claim their victims
+STREAM_BATCH = get_int_setting("COMM_BUFFER_STREAM_BATCH", 100)        # entries per XREADGROUP
+STREAM_CLAIM_IDLE_MS = get_int_setting("COMM_BUFFER_STREAM_CLAIM_IDLE_MS", 60000)  # reclaim pending entries idle this long
+
+STATS_KEY = "bufstats:{lane}"
+EVICTIONS_KEY = "bufstats:evictions"
+DESTINATION_META_KEY = "bufmeta:{source}:{destination}"  # count/bytes buffered per destination
+GLOBAL_META_KEY = "bufmeta:global"                       # count/bytes buffered overall
+DEAD_LETTER_KEY = "deadletter:{source}"
+INDEX_KEY = "bufindex:{prefix}:{lane}"  # sorted set: bulk/normal buffer key -> oldest buffered_at (lower bound)
+INDEX_SEEDED_KEY = "bufindex:{prefix}:seeded"  # set once keys buffered before the index existed are indexed
+
+EXPIRED = "expired"
+OVERFLOW_DESTINATION = "overflow_destination"
+OVERFLOW_GLOBAL = "overflow_global"
+
+
+def classify(protocol, msg_type, priority=None):
+    """Return the buffer lane for a message, honouring an explicit priority if valid."""
+    if priority in LANES:
+        return priority
+    protocol = (protocol or "").upper()
+    msg_type = (msg_type or "").lower()
+    return PRIORITY_RULES.get((protocol, msg_type)) or PRIORITY_RULES.get((protocol, None)) or NORMAL
+
+
+def ttl_for(protocol, msg_type):
+    """Return how many seconds a buffered message of this protocol and type stays deliverable."""
+    protocol = (protocol or "").upper()
+    msg_type = (msg_type or "").lower()
+    ttl = TTL_RULES.get((protocol, msg_type)) or TTL_RULES.get((protocol, None))
+    return ttl or DEFAULT_TTL
+
+
+def is_expired(envelope, now=None):
+    """Messages buffered before TTLs existed carry no expiry and never expire."""
+    expires_at = envelope.get("expires_at")
+    return expires_at is not None and expires_at < (now or time.time())
+
+
+def parse_buffer_source(key):
+    """Return the source (node) of a buffer key."""
+    return key.split(":")[1]
+
+
+def parse_buffer_key(key):
+    """
+    Split a buffer key into (destination, lane).
+    Keys without a lane (written before lanes existed) belong to the normal lane.
+    """
+    parts = key.split(":")
+    if len(parts) == 4 and parts[3] in LANES:
+        return parts[2], parts[3]
+    if len(parts) == 3:
+        return parts[2], NORMAL
+    return None, None
+
+
+class RedisListBuffer:
+    """
+    Buffer backed by one Redis list per (source, destination, lane).
+    Messages are LPUSHed and RPOPed, so each lane is FIFO.
+    """
+    KEY_PREFIX = "buffer"
+
+    def __init__(self, redis_client, object_id):
+        self.redis = redis_client
+        self.object_id = str(object_id)
+
+    def key(self, destination, lane):
+        return f"{self.KEY_PREFIX}:{self.object_id}:{destination}:{lane}"
+
+    def _store(self, pipe, key, data):
+        pipe.lpush(key, data)
+
+    def push(self, destination, envelope):
+        """Buffer an envelope in the lane of its protocol and type, then enforce the caps."""
+        lane = classify(envelope.get("protocol"), envelope.get("type"), envelope.get("priority"))
+        now = time.time()
+        envelope = dict(envelope, buffered_at=now,
+                        expires_at=now + ttl_for(envelope.get("protocol"), envelope.get("type")))
+        data = json.dumps(envelope)
+
+        pipe = self.redis.pipeline()
+        self._store(pipe, self.key(destination, lane), data)
+        self._account(pipe, destination, 1, len(data))
+        pipe.hincrby(STATS_KEY.format(lane=lane), "enqueued", 1)
+        if lane != URGENT:
+            # Only a key's first message sets its score, later ones are newer than its head
+            pipe.zadd(self._index_key(lane), {self.key(destination, lane): now}, nx=True)
+        results = pipe.execute()
+        destination_count, destination_bytes, total_count, total_bytes = results[1:5]
+        self._enforce_caps(destination, destination_count, destination_bytes, total_count, total_bytes)
+        return lane
+
+    def _account(self, pipe, destination, count, size, source=None):
+        """Queue updates of the per-destination and global count/byte accounting."""
+        meta = DESTINATION_META_KEY.format(source=source or self.object_id, destination=destination)
+        pipe.hincrby(meta, "count", count)
+        pipe.hincrby(meta, "bytes", size)
+        pipe.hincrby(GLOBAL_META_KEY, "count", count)
+        pipe.hincrby(GLOBAL_META_KEY, "bytes", size)
+
+    def _enforce_caps(self, destination, destination_count, destination_bytes, total_count, total_bytes):
+        """Evict the oldest, lowest-priority messages until the buffer is within its caps."""
+        while destination_count > MAX_MESSAGES_PER_DESTINATION or destination_bytes > MAX_BYTES_PER_DESTINATION:
+            keys = [self.key(destination, lane) for lane in reversed(LANES)]
+            size = self._evict_oldest(keys, OVERFLOW_DESTINATION)
+            if size is None:
+                break
+            destination_count -= 1
+            destination_bytes -= size
+            total_count -= 1
+            total_bytes -= size
+
+        if total_count > MAX_MESSAGES or total_bytes > MAX_BYTES:
+            self._evict_global(total_count, total_bytes)
+
+    def _index_key(self, lane):
+        return INDEX_KEY.format(prefix=self.KEY_PREFIX, lane=lane)
+
+    def _seed_index(self):
+        """Index the keys buffered before the index existed (once, with a SCAN)."""
+        seeded = INDEX_SEEDED_KEY.format(prefix=self.KEY_PREFIX)
+        if self.redis.exists(seeded):
+            return
+        by_lane = keys_by_lane(self.redis, [f"{self.KEY_PREFIX}:*"])
+        pipe = self.redis.pipeline()
+        for lane in (BULK, NORMAL):
+            if by_lane[lane]:
+                pipe.zadd(self._index_key(lane), {key: 0 for key in by_lane[lane]}, nx=True)
+        pipe.set(seeded, 1)
+        pipe.execute()
+
+    def _unindex(self, lane, key):
+        """Drop an empty key from the index; a message pushed meanwhile puts it back."""
+        index = self._index_key(lane)
+        self.redis.zrem(index, key)
+        oldest = self._oldest_time(key)
+        if oldest is not None:
+            self.redis.zadd(index, {key: oldest}, nx=True)
+
+    def _evict_global(self, total_count, total_bytes):
+        """Evict the oldest bulk, then normal messages of all sources until within the global caps."""
+        self._seed_index()
+        for lane in (BULK, NORMAL):
+            index = self._index_key(lane)
+            while total_count > MAX_MESSAGES or total_bytes > MAX_BYTES:
+                head = self.redis.zrange(index, 0, 0, withscores=True)
+                if not head:
+                    break
+                key, score = head[0]
+                key = key.decode() if isinstance(key, bytes) else key
+                oldest = self._oldest_time(key)
+                if oldest is None:
+                    self._unindex(lane, key)
+                    continue
+                if oldest > score:
+                    # Scores only lag behind (heads get newer), so the true minimum has an exact score
+                    self.redis.zadd(index, {key: oldest}, xx=True)
+                    continue
+                size = self._evict_oldest([key], OVERFLOW_GLOBAL)
+                if size is None:
+                    self.redis.zrem(index, key)  # emptied meanwhile; its next push indexes it again
+                    continue
+                total_count -= 1
+                total_bytes -= size
+            if total_count <= MAX_MESSAGES and total_bytes <= MAX_BYTES:
+                return
+
+    def _oldest_time(self, key):
+        """buffered_at of the oldest message of a key (0 for messages without one), None if empty."""
+        data = self.redis.lindex(key, -1)
+        return json.loads(data).get("buffered_at", 0) if data else None
+
+    def _evict_oldest(self, keys, reason):
+        """Move the oldest message of the first non-empty key to the dead-letter list. Returns its size."""
+        for key in keys:
+            data = self.redis.rpop(key)
+            if data:
+                self._dead_letter(key, data, reason)
+                return len(data)
+        return None
+
+    def _dead_letter(self, key, data, reason):
+        """Record a message that left the buffer without being delivered."""
+        destination, lane = parse_buffer_key(key)
+        source = parse_buffer_source(key)  # global evictions reach other sources' buffers
+        record = json.dumps({
+            "reason": reason,
+            "destination": destination,
+            "lane": lane,
+            "dead_at": time.time(),
+            "envelope": json.loads(data),
+        })
+        dead_letter_key = DEAD_LETTER_KEY.format(source=source)
+        pipe = self.redis.pipeline()
+        self._account(pipe, destination, -1, -len(data), source)
+        pipe.lpush(dead_letter_key, record)
+        pipe.ltrim(dead_letter_key, 0, DEAD_LETTER_MAX - 1)
+        pipe.hincrby(EVICTIONS_KEY, reason, 1)
+        pipe.hincrby(STATS_KEY.format(lane=lane), reason, 1)
+        pipe.execute()
+        logger.warning(f"Buffered message from {source} to {destination} ({lane}) dead-lettered: {reason}")
+
+    def _keys_by_lane(self, destination="*"):
+        prefix = f"{self.KEY_PREFIX}:{self.object_id}"
+        if destination == "*":
+            patterns = [f"{prefix}:*"]
+        else:
+            patterns = [f"{prefix}:{destination}", f"{prefix}:{destination}:*"]
+        return keys_by_lane(self.redis, patterns)
+
+    def _drain_key(self, key, lane, publish, limit=None):
+        """
+        Publish up to limit messages from one list. Returns (sent, ok); ok is False if publishing
+        failed, in which case the message is put back at the head of the lane.
+        """
+        sent = 0
+        destination, _ = parse_buffer_key(key)
+        while limit is None or sent < limit:
+            msg_json = self.redis.rpop(key)
+            if not msg_json:
+                break
+            if is_expired(json.loads(msg_json)):
+                self._dead_letter(key, msg_json, EXPIRED)
+                continue
+            try:
+                publish(destination, msg_json)
+            except Exception as e:
+                logger.warning(f"Retry failed for {destination} ({lane}), re-buffering message: {e}")
+                self.redis.rpush(key, msg_json)  # back to the head of the FIFO, keeps order
+                self.redis.hincrby(STATS_KEY.format(lane=lane), "failed", 1)
+                return sent, False
+            sent += 1
+            pipe = self.redis.pipeline()
+            self._account(pipe, destination, -1, -len(msg_json))
+            pipe.hincrby(STATS_KEY.format(lane=lane), "drained", 1)
+            pipe.execute()
+        return sent, True
+
+    def drain(self, publish, destination="*"):
+        """
+        Drain buffered messages with publish(destination, msg_json), which raises on failure.
+        Urgent lanes are emptied first; normal and bulk lanes are then drained in weighted rounds.
+        Stops at the first failure (broker down). Returns the number of messages sent.
+        """
+        keys = self._keys_by_lane(destination)
+        urgent_keys = keys[URGENT]
+        total = 0
+        active = {lane: list(keys[lane]) for lane in LANE_WEIGHTS}
+        rounds = 0
+        while True:
+            # Urgent messages buffered while a long backlog drains still go first
+            if rounds and rounds % URGENT_RESCAN_ROUNDS == 0:
+                urgent_keys = self._keys_by_lane(destination)[URGENT]
+            for key in urgent_keys:
+                sent, ok = self._drain_key(key, URGENT, publish)
+                total += sent
+                if not ok:
+                    return total
+            if not any(active.values()):
+                return total
+            rounds += 1
+            for lane, weight in LANE_WEIGHTS.items():
+                for key in list(active[lane]):
+                    sent, ok = self._drain_key(key, lane, publish, limit=weight)
+                    total += sent
+                    if not ok:
+                        return total
+                    if sent < weight:
+                        active[lane].remove(key)  # lane empty for this destination
+                        self._unindex(lane, key)
+
+    def lane_stats(self):
+        """Return per-lane depth of this node's buffers and the global lane counters."""
+        return lane_stats(self.redis, self._keys_by_lane())
+
+
+class RedisStreamBuffer(RedisListBuffer):
+    """
+    Buffer backed by one Redis stream per (source, destination, lane), drained through a consumer
+    group. Several consumers may drain the same streams; each entry is delivered to one of them.
+    """
+    KEY_PREFIX = "bufstream"
+
+    def __init__(self, redis_client, object_id, consumer=None):
+        super().__init__(redis_client, object_id)
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self._groups = set()
+
+    def _store(self, pipe, key, data):
+        pipe.xadd(key, {"d": data})
+
+    def _ensure_group(self, key):
+        if key in self._groups:
+            return
+        try:
+            self.redis.xgroup_create(key, STREAM_GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._groups.add(key)
+
+    def _remove(self, key, entry_id):
+        """Acknowledge and delete an entry. Returns False if another process deleted it first."""
+        pipe = self.redis.pipeline()
+        pipe.xack(key, STREAM_GROUP, entry_id)
+        pipe.xdel(key, entry_id)
+        return bool(pipe.execute()[1])
+
+    def _evict_oldest(self, keys, reason):
+        """
+        Evict the oldest entry no drainer has read yet. The victim is read through the consumer
+        group, which hands each entry to one consumer only, so it cannot be published as well.
+        """
+        for key in keys:
+            if not self.redis.xlen(key):
+                continue  # without creating the stream through its group
+            self._ensure_group(key)
+            while True:
+                response = self.redis.xreadgroup(STREAM_GROUP, STREAM_EVICTOR, {key: ">"}, count=1)
+                entries = response[0][1] if response else []
+                if not entries:
+                    break
+                entry_id, fields = entries[0]
+                if self._remove(key, entry_id):
+                    data = fields[b"d"]
+                    self._dead_letter(key, data, reason)
+                    return len(data)
+        return None
+
+    def _oldest_time(self, key):
+        """buffered_at of the oldest entry no drainer has read yet (the next eviction victim)."""
+        try:
+            groups = self.redis.xinfo_groups(key)
+        except Exception:
+            return None  # no such stream
+        last_id = next((g["last-delivered-id"] for g in groups if g["name"] in (STREAM_GROUP, STREAM_GROUP.encode())), None)
+        if last_id is None:
+            entries = self.redis.xrange(key, count=1)
+        else:
+            last_id = last_id.decode() if isinstance(last_id, bytes) else last_id
+            entries = self.redis.xrange(key, min=f"({last_id}", count=1)
+        return json.loads(entries[0][1][b"d"]).get("buffered_at", 0) if entries else None
+
+    def _read_batch(self, key, count):
+        """
+        Return the next batch of entries for this consumer: first its own pending entries (read
+        before a failed publish or a crash), then entries other consumers left pending for too
+        long, then new entries.
+        """
+        response = self.redis.xreadgroup(STREAM_GROUP, self.consumer, {key: "0"}, count=count)
+        entries = [e for e in (response[0][1] if response else []) if e[1]]
+        if entries:
+            return entries
+        claimed = self.redis.xautoclaim(key, STREAM_GROUP, self.consumer, STREAM_CLAIM_IDLE_MS, count=count)
+        entries = [e for e in (claimed[1] if claimed else []) if e and e[1]]
+        if entries:
+            return entries
+        response = self.redis.xreadgroup(STREAM_GROUP, self.consumer, {key: ">"}, count=count)
+        return response[0][1] if response else []
+
+    def _drain_key(self, key, lane, publish, limit=None):
+        self._ensure_group(key)
+        destination, _ = parse_buffer_key(key)
+        sent = 0
+        while limit is None or sent < limit:
+            count = STREAM_BATCH if limit is None else min(STREAM_BATCH, limit - sent)
+            entries = self._read_batch(key, count)
+            if not entries:
+                break
+            for entry_id, fields in entries:
+                data = fields[b"d"]
+                if is_expired(json.loads(data)):
+                    if self._remove(key, entry_id):
+                        self._dead_letter(key, data, EXPIRED)
+                    continue
+                try:
+                    publish(destination, data)
+                except Exception as e:
+                    # Unacknowledged entries stay pending and are read again first next time
+                    logger.warning(f"Retry failed for {destination} ({lane}), keeping message pending: {e}")
+                    self.redis.hincrby(STATS_KEY.format(lane=lane), "failed", 1)
+                    return sent, False
+                sent += 1
+                if not self._remove(key, entry_id):
+                    continue  # reclaimed and delivered by another consumer as well, which accounted for it
+                pipe = self.redis.pipeline()
+                self._account(pipe, destination, -1, -len(data))
+                pipe.hincrby(STATS_KEY.format(lane=lane), "drained", 1)
+                pipe.execute()
+        return sent, True
+
+    def drain(self, publish, destination="*"):
+        # Messages buffered in lists before switching to streams are delivered first
+        sent = RedisListBuffer(self.redis, self.object_id).drain(publish, destination)
+        return sent + super().drain(publish, destination)
+
+
+BUFFER_BACKENDS = {
+    "list": RedisListBuffer,
+    "streams": RedisStreamBuffer,
+}
+
+
+def get_buffer(redis_client, object_id):
+    """Return the outbound buffer of a node, using the backend chosen by COMM_BUFFER_BACKEND."""
+    backend = get_setting("COMM_BUFFER_BACKEND", "list")
+    return BUFFER_BACKENDS[backend](redis_client, object_id)
+
+
+def keys_by_lane(redis_client, patterns):
+    """Group the buffer keys matching the given patterns by lane."""
+    keys = {lane: [] for lane in LANES}
+    for pattern in patterns:
+        for key in redis_client.scan_iter(pattern):
+            key = key.decode() if isinstance(key, bytes) else key
+            _, lane = parse_buffer_key(key)
+            if lane and key not in keys[lane]:
+                keys[lane].append(key)
+    return keys
+
+
+def dead_letters(redis_client, source, count=100):
+    """Return up to count dead letters of a source, oldest first."""
+    key = DEAD_LETTER_KEY.format(source=source)
+    return [json.loads(r) for r in redis_client.lrange(key, -count, -1)][::-1]
+
+
+def pop_dead_letter(redis_client, source):
+    """Remove and return the oldest dead letter of a source, or None."""
+    record = redis_client.rpop(DEAD_LETTER_KEY.format(source=source))
+    return json.loads(record) if record else None
+
+
+def requeue_dead_letter(redis_client, source, letter):
+    """Put a popped dead letter back (as the newest entry)."""
+    redis_client.lpush(DEAD_LETTER_KEY.format(source=source), json.dumps(letter))
+
+
+def eviction_stats(redis_client):
+    """Return the dead-letter counters per reason and the buffered totals."""
+    decode = lambda v: v.decode() if isinstance(v, bytes) else v
+    return {
+        "evictions": {decode(k): int(v) for k, v in redis_client.hgetall(EVICTIONS_KEY).items()},
+        "buffered": {decode(k): int(v) for k, v in redis_client.hgetall(GLOBAL_META_KEY).items()},
+    }
+
+
+def lane_stats(redis_client, keys=None):
+    """
+    Return {lane: {'depth': ..., 'enqueued': ..., 'drained': ..., 'failed': ...}}.
+    Depth covers the given keys (default: the buffers of all nodes).
+    """
+    if keys is None:
+        keys = keys_by_lane(redis_client, [f"{backend.KEY_PREFIX}:*" for backend in BUFFER_BACKENDS.values()])
+    depth = lambda key: redis_client.xlen(key) if key.startswith(RedisStreamBuffer.KEY_PREFIX + ":") else redis_client.llen(key)
+    stats = {}
+    for lane in LANES:
+        counters = redis_client.hgetall(STATS_KEY.format(lane=lane))
+        stats[lane] = {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in counters.items()}
+        stats[lane]["depth"] = sum(depth(key) for key in keys[lane])
+    return stats
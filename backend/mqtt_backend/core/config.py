@@ -0,0 +1,35 @@
+import os
+
+"""
+Shared configuration lookup for the communication layer.
+Values are read from Django settings when the nodes run inside the backend,
+and from environment variables when the scripts run standalone.
+"""
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "1"))
+
+
+def get_setting(name, default=None):
+    """Return a setting from Django settings if available, otherwise from the environment."""
+    try:
+        from django.conf import settings
+        if settings.configured and hasattr(settings, name):
+            return getattr(settings, name)
+    except ImportError:
+        pass
+    return os.getenv(name, default)
+
+
+def get_bool_setting(name, default=False):
+    """Return a boolean setting, accepting 'True'/'true'/'1' for string values."""
+    value = get_setting(name, default)
+    if isinstance(value, str):
+        return value.lower() in ("true", "1", "yes")
+    return bool(value)
+
+
+def get_int_setting(name, default):
+    """Return an integer setting."""
+    return int(get_setting(name, default))
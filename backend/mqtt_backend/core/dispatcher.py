@@ -0,0 +1,134 @@
+import itertools
+import logging
+import os
+import socket
+from threading import Lock
+from paho.mqtt.client import Client
+
+"""
+Wildcard-subscription dispatcher for communication nodes.
+
+Instead of one MQTT session and subscription per agent, a small pool of consumer clients
+subscribes to `comm/+` (or the EMQX shared subscription `$share/<group>/comm/+`, which makes
+the broker spread inbound messages across all consumers in the group) and hands every message
+to the in-process node registered for the topic suffix. Nodes publish through the same clients.
+
+Context multicasts (`comm/context/<context_id>`) are received once per process by the first
+consumer, never through the shared group, and fanned out to all local member nodes.
+"""
+
+logger = logging.getLogger('omnisyslogger')
+
+INBOX_TOPIC = "comm/+"
+CONTEXT_TOPIC = "comm/context/+"
+
+
+class Dispatcher:
+    """
+    Routes inbound messages to registered nodes with a dict lookup on the topic suffix.
+
+    consumers: number of MQTT clients to open. More than one requires a shared group,
+               otherwise every consumer would receive (and dispatch) each message.
+    shared_group: EMQX shared subscription group, e.g. 'omnisys' -> '$share/omnisys/comm/+'.
+    on_unroutable: optional callback(agent_id, message) for messages whose agent is not
+                   registered in this process (e.g. owned by another comm shard).
+    """
+    def __init__(self, broker, port, consumers=1, shared_group=None, on_unroutable=None, client_prefix=None):
+        if consumers > 1 and not shared_group:
+            raise ValueError("Multiple dispatcher consumers require a shared subscription group")
+        self.broker = broker
+        self.port = port
+        self.shared_group = shared_group
+        self.on_unroutable = on_unroutable
+        self.client_prefix = client_prefix or f"dispatcher-{socket.gethostname()}-{os.getpid()}"
+        self.handlers = {}
+        self.context_members = {}  # context_id -> set of local member object IDs
+        self.clients = [self._make_client(i) for i in range(consumers)]
+        self._publishers = itertools.cycle(self.clients)
+        self._lock = Lock()
+        self._started = False
+
+    @property
+    def subscription(self):
+        if self.shared_group:
+            return f"$share/{self.shared_group}/{INBOX_TOPIC}"
+        return INBOX_TOPIC
+
+    def _make_client(self, index):
+        client = Client(client_id=f"{self.client_prefix}-{index}")
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        return client
+
+    def register(self, node):
+        """Register a node as the handler for messages addressed to its object ID."""
+        self.handlers[str(node.object_id)] = node
+        logger.debug(f"Dispatcher registered node {node.object_id}")
+
+    def unregister(self, object_id):
+        self.handlers.pop(str(object_id), None)
+        logger.debug(f"Dispatcher unregistered node {object_id}")
+
+    def join_context(self, context_id, node):
+        self.context_members.setdefault(str(context_id), set()).add(str(node.object_id))
+
+    def leave_context(self, context_id, node):
+        members = self.context_members.get(str(context_id))
+        if members is not None:
+            members.discard(str(node.object_id))
+            if not members:
+                del self.context_members[str(context_id)]
+
+    def publisher(self):
+        """Return a connected client for publishing (round-robin over the consumers)."""
+        with self._lock:
+            return next(self._publishers)
+
+    def start(self):
+        """Connect all consumer clients and start their network loops."""
+        if self._started:
+            return
+        for client in self.clients:
+            result = client.connect(self.broker, self.port, 60)
+            if result != 0:
+                raise Exception("MQTT connection failed")
+            client.loop_start()
+        self._started = True
+        logger.info(f"Dispatcher started with {len(self.clients)} consumer(s) on {self.subscription}")
+
+    def stop(self):
+        for client in self.clients:
+            client.disconnect()
+            client.loop_stop()
+        self._started = False
+        logger.info("Dispatcher stopped")
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(self.subscription, qos=1)
+            logger.info(f"Dispatcher consumer subscribed to {self.subscription}")
+            if client is self.clients[0]:
+                client.subscribe(CONTEXT_TOPIC, qos=1)
+        else:
+            logger.warning(f"Dispatcher consumer failed to connect with code {rc}")
+
+    def _on_message(self, client, userdata, msg):
+        self.dispatch(client, msg)
+
+    def dispatch(self, client, msg):
+        """Hand a message to the node registered for the topic suffix."""
+        if msg.topic.startswith("comm/context/"):
+            context_id = msg.topic.rsplit("/", 1)[-1]
+            for object_id in list(self.context_members.get(context_id, ())):
+                node = self.handlers.get(object_id)
+                if node:
+                    node.on_message(client, node, msg)
+            return
+        agent_id = msg.topic.rsplit("/", 1)[-1]
+        node = self.handlers.get(agent_id)
+        if node:
+            node.on_message(client, node, msg)
+        elif self.on_unroutable:
+            self.on_unroutable(agent_id, msg)
+        else:
+            logger.debug(f"Dispatcher dropped message for unknown agent {agent_id}")
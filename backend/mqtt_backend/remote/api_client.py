@@ -0,0 +1,227 @@
+import base64
+import json
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+Small client SDK for the OmniSys backend API, used by the send scripts and remote devices.
+
+One ApiClient keeps a pooled requests.Session (keep-alive connections are reused between calls),
+logs in once and refreshes the JWT access token through `auth/user/token/refresh/` shortly
+before it expires (or after a 401). Usernames are resolved to agent IDs through a TTL cache, so
+repeated sends to the same agents cost no HTTP round trips at all. Many usernames are resolved
+with a single call to `agents/resolve/`, revalidated with If-None-Match:
+
+    client = ApiClient("http://backend:8000/api", "doctor-1", "123456")
+    node = client.node(BaseNode, broker="localhost", port=1883)
+    client.send_to_username(node, "medical-device-1", "hl7", "report", {...})
+"""
+
+logger = logging.getLogger("remotenode")
+
+REQUEST_TIMEOUT = 10
+TOKEN_REFRESH_MARGIN = 60   # seconds before expiry at which the access token is refreshed
+DIRECTORY_TTL = 300         # seconds a username -> agent_id entry is kept
+DIRECTORY_ETAGS_MAX = 256   # bulk lookups whose ETag is kept for revalidation (least recently used dropped)
+
+
+class ApiError(Exception):
+    """Raised when the backend answers with an error status."""
+    def __init__(self, status_code, message):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+
+
+def _token_expiry(token):
+    """Read the `exp` claim of a JWT without verifying it (the server does that)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return 0.0
+
+
+class AgentDirectory:
+    """TTL cache of username -> agent_id."""
+    def __init__(self, ttl=DIRECTORY_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            agent_id, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[username]
+                return None
+            return agent_id
+
+    def put(self, username, agent_id):
+        with self._lock:
+            self._entries[username] = (agent_id, time.monotonic() + self.ttl)
+
+    def invalidate(self, username=None):
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+
+class ApiClient:
+    def __init__(self, api_root, username, password, directory_ttl=DIRECTORY_TTL,
+                 timeout=REQUEST_TIMEOUT, pool_size=10, directory_etags_max=DIRECTORY_ETAGS_MAX):
+        self.api_root = api_root.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.directory = AgentDirectory(directory_ttl)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._directory_etags = OrderedDict()  # sorted usernames -> (ETag, agents) of the last bulk lookup, LRU
+        self._directory_etags_max = directory_etags_max
+        self._etags_lock = Lock()
+        self._access = None
+        self._refresh = None
+        self._access_expires = 0.0
+        self._auth_lock = Lock()
+
+    # -- authentication ------------------------------------------------------
+
+    def _url(self, path):
+        return f"{self.api_root}/{path.lstrip('/')}"
+
+    def _set_tokens(self, data):
+        self._access = data["access"]
+        self._refresh = data.get("refresh", self._refresh)
+        self._access_expires = _token_expiry(self._access)
+
+    def login(self):
+        """Obtain a fresh access/refresh token pair."""
+        r = self.session.post(self._url("auth/user/token/"),
+                              json={"username": self.username, "password": self.password},
+                              timeout=self.timeout)
+        if r.status_code != 200:
+            raise ApiError(r.status_code, "login failed")
+        self._set_tokens(r.json())
+        logger.debug(f"Logged in to {self.api_root} as {self.username}")
+
+    def refresh(self):
+        """Refresh the access token, falling back to a full login if the refresh token expired."""
+        if self._refresh:
+            r = self.session.post(self._url("auth/user/token/refresh/"),
+                                  json={"refresh": self._refresh}, timeout=self.timeout)
+            if r.status_code == 200:
+                self._set_tokens(r.json())
+                logger.debug("Refreshed access token")
+                return
+        self.login()
+
+    def _ensure_token(self):
+        with self._auth_lock:
+            if self._access is None:
+                self.login()
+            elif self._access_expires - TOKEN_REFRESH_MARGIN < time.time():
+                self.refresh()
+            return self._access
+
+    def request(self, method, path, **kwargs):
+        """Send an authenticated request; retries once with a refreshed token on 401."""
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(2):
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers["Authorization"] = f"Bearer {self._ensure_token()}"
+            r = self.session.request(method, self._url(path), headers=headers, **kwargs)
+            if r.status_code == 401 and attempt == 0:
+                with self._auth_lock:
+                    self.refresh()
+                kwargs["headers"] = headers
+                continue
+            if r.status_code >= 400:
+                try:
+                    message = r.json().get("error") or r.text
+                except ValueError:
+                    message = r.text
+                raise ApiError(r.status_code, message)
+            return r
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs).json()
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs).json()
+
+    # -- agent directory -----------------------------------------------------
+
+    def resolve(self, username):
+        """Return the agent ID of a username, using the cached directory when possible."""
+        agent_id = self.directory.get(username)
+        if agent_id is None:
+            agent_id = self.get(f"agents/by-username/{username}/")["agent_id"]
+            self.directory.put(username, agent_id)
+        return agent_id
+
+    def resolve_many(self, usernames):
+        """
+        Return a dict of username -> agent ID for all known usernames.
+        Uncached usernames are resolved with one call to the bulk endpoint, revalidated with the
+        ETag of the previous answer for the same set of usernames.
+        """
+        usernames = sorted(set(usernames))
+        result = {}
+        pending = []
+        for username in usernames:
+            agent_id = self.directory.get(username)
+            if agent_id is None:
+                pending.append(username)
+            else:
+                result[username] = agent_id
+        if not pending:
+            return result
+
+        key = tuple(pending)
+        with self._etags_lock:
+            etag, agents = self._directory_etags.get(key, (None, None))
+            if etag:
+                self._directory_etags.move_to_end(key)
+        headers = {"If-None-Match": etag} if etag else {}
+        r = self.request("POST", "agents/resolve/", json={"usernames": pending}, headers=headers)
+        if r.status_code != 304:
+            agents = {username: entry["agent_id"] for username, entry in r.json()["agents"].items()}
+            with self._etags_lock:
+                self._directory_etags[key] = (r.headers.get("ETag"), agents)
+                self._directory_etags.move_to_end(key)
+                while len(self._directory_etags) > self._directory_etags_max:
+                    self._directory_etags.popitem(last=False)
+        for username, agent_id in agents.items():
+            self.directory.put(username, agent_id)
+            result[username] = agent_id
+        return result
+
+    # -- messaging -----------------------------------------------------------
+
+    def node(self, node_class, **kwargs):
+        """Create and start a node for the logged-in agent."""
+        node = node_class(str(self.resolve(self.username)), **kwargs)
+        node.start()
+        return node
+
+    def send_to_username(self, node, username, protocol, msg_type, payload):
+        """Publish a message from node to the agent behind username."""
+        node.send_message(destination=str(self.resolve(username)),
+                          protocol=protocol, msg_type=msg_type, payload=payload)
+
+    def close(self):
+        self.session.close()
@@ -1,27 +1,47 @@
+import os
 import time
 import json
 import logging
-from threading import Thread
+from threading import Thread, Event, Lock
 from paho.mqtt.client import Client
+from spool import Spool
 
 BROKER_HOST = "192.168.0.2"
 BROKER_PORT = 21883
 LOGLEVEL = logging.INFO
 
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")                                       # one subdirectory per node
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))       # disk budget per node
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+SPOOL_FSYNC_BATCH = int(os.getenv("SPOOL_FSYNC_BATCH", "64"))                     # records per msync
+REPLAY_BATCH = 100
+PUBLISH_TIMEOUT = 10  # seconds to wait for the broker's PUBACK during replay
+
 logging.basicConfig(level=LOGLEVEL)
 logger = logging.getLogger("remotenode")
 
 class BaseNode:
     """
-    Remote Base Node for handling MQTT communication (same as /core/base_node.py but without Redis buffering)
+    Remote Base Node for handling MQTT communication (same as /core/base_node.py but without Redis buffering).
+    Outbound messages that cannot be published are kept in a local durable spool (see spool.py)
+    and replayed in order once the broker link is back.
     """
-    def __init__(self, object_id, broker=BROKER_HOST, port=BROKER_PORT):
+    def __init__(self, object_id, broker=BROKER_HOST, port=BROKER_PORT, spool_dir=None):
         self.object_id = object_id
         self.broker = broker
         self.port = port
 
         self.client = None
         self._thread = None
+        self.connected = Event()
+
+        self.spool = Spool(
+            spool_dir or os.path.join(SPOOL_DIR, str(object_id)),
+            segment_size=SPOOL_SEGMENT_BYTES,
+            max_bytes=SPOOL_MAX_BYTES,
+            fsync_batch=SPOOL_FSYNC_BATCH,
+        )
+        self._replay_lock = Lock()
 
         self.connect()
 
@@ -35,6 +55,7 @@ class BaseNode:
         if self.client:
             self.client.disconnect()
             self.client.loop_stop()
+        self.spool.close()
         logger.info(f"BaseNode {self.object_id} stopped.")
 
     def send_message(self, destination, protocol, msg_type, payload):
@@ -47,13 +68,73 @@ class BaseNode:
             "payload": payload,
         }
         topic = f"comm/{destination}"
+        # Keep order: while older messages are spooled, new ones queue up behind them
+        if not self.connected.is_set() or not self.spool.is_empty():
+            self._spool(envelope)
+            return
         try:
             result = self.client.publish(topic, json.dumps(envelope), qos=1)
             logger.info(f"[{self.object_id}] Published to {topic}")
             if result.rc != 0:
                 raise Exception(f"MQTT publish failed, rc={result.rc}")
         except Exception as e:
-            logger.warning(f"MQTT send failed: {e}")
+            logger.warning(f"MQTT send failed, spooling message: {e}")
+            self._spool(envelope)
+
+    def _spool(self, envelope):
+        self.spool.append(json.dumps(envelope).encode())
+        logger.info(f"[{self.object_id}] Spooled message to {envelope['destination']}")
+        if self.connected.is_set() and not self._replay_lock.locked():
+            Thread(target=self.replay_spool, daemon=True).start()
+
+    def replay_spool(self):
+        """Publish spooled messages in order, advancing the cursor only after the broker acknowledged them."""
+        sent = 0
+        while self._replay_lock.acquire(blocking=False):
+            try:
+                replayed, completed = self._replay_batches()
+                sent += replayed
+            finally:
+                self._replay_lock.release()
+            # A message spooled between the last peek and the release saw the lock held and started
+            # no replay of its own, so look again once the lock is free
+            if not completed or not self.connected.is_set() or self.spool.is_empty():
+                break
+        if sent:
+            logger.info(f"[{self.object_id}] Replayed {sent} spooled messages")
+        return sent
+
+    def _replay_batches(self):
+        """
+        Replay the spool batch by batch: publish a whole batch, wait for its acknowledgements, then
+        commit once. Returns (sent, completed); completed is False if the replay was interrupted.
+        """
+        sent = 0
+        while self.connected.is_set():
+            records = self.spool.peek(REPLAY_BATCH)
+            if not records:
+                return sent, True
+            published = []
+            for position, data in records:
+                envelope = json.loads(data)
+                info = self.client.publish(f"comm/{envelope['destination']}", data, qos=1)
+                if info.rc != 0:
+                    logger.warning(f"[{self.object_id}] Replay interrupted, rc={info.rc}")
+                    break
+                published.append((position, info))
+            acknowledged = None
+            for position, info in published:
+                info.wait_for_publish(timeout=PUBLISH_TIMEOUT)
+                if not info.is_published():
+                    logger.warning(f"[{self.object_id}] Replay interrupted, no acknowledgement from broker")
+                    break
+                acknowledged = position
+                sent += 1
+            if acknowledged is not None:
+                self.spool.commit(acknowledged)
+            if acknowledged != records[-1][0]:
+                return sent, False
+        return sent, False
 
     def on_message(self, client, userdata, msg):
         try:
@@ -67,6 +148,7 @@ class BaseNode:
         self.client = Client(client_id=self.object_id)
         self.client.user_data_set(self)
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self.on_message
         result = self.client.connect(self.broker, self.port, 60)
         if result != 0:
@@ -77,9 +159,16 @@ class BaseNode:
             topic = f"comm/{self.object_id}"
             client.subscribe(topic, qos=1)
             logger.info(f"[Object: {self.object_id}] Subscribed to {topic}")
+            self.connected.set()
+            # Replay from a separate thread: waiting for PUBACKs inside the network loop would block it
+            Thread(target=self.replay_spool, daemon=True).start()
         else:
             logger.warning(f"[Object: {self.object_id}] Failed to connect with code {rc}")
 
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        logger.warning(f"[Object: {self.object_id}] Disconnected from broker (rc={rc}), spooling outbound messages")
+
 
 if __name__ == "__main__":
     node = BaseNode(object_id="my-remote-agent")
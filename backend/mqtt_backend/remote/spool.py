@@ -0,0 +1,242 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+import logging
+from threading import Lock
+
+"""
+Durable on-disk spool for remote nodes (which cannot run Redis).
+
+Outbound envelopes are appended to fixed-size, memory-mapped segment files:
+
+    <spool_dir>/segment-000000000001.log   [len:u32][crc32:u32][data] [len][crc][data] ... 0000
+
+A zero length marks the end of the written part of a segment; a record with a bad CRC (torn write
+after a power loss) is treated the same way. Writes are msync'ed in batches (every `fsync_batch`
+records or `fsync_interval` seconds). The read position is kept in a small cursor file that is
+replaced atomically after records have been delivered, so messages are replayed in order and at
+least once after a crash. Fully consumed segments are deleted, and the oldest segments are
+dropped when the spool would exceed its disk budget.
+"""
+
+logger = logging.getLogger("remotenode")
+
+HEADER = struct.Struct("<II")  # record length, crc32
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+
+
+class Spool:
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_bytes=512 * 1024 * 1024,
+                 fsync_batch=64, fsync_interval=1.0):
+        if max_bytes < segment_size:
+            raise ValueError("Spool disk budget must hold at least one segment")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.dropped = 0  # records lost to the disk budget since start
+
+        self._lock = Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._maps = {}  # segment seq -> (file, mmap)
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._list_segments()
+        self._read_seq, self._read_offset = self._load_cursor()
+        if not self._segments:
+            self._segments = [self._read_seq]
+            self._map(self._read_seq)
+        self._write_seq = self._segments[-1]
+        self._write_offset = self._scan_end(self._write_seq)
+        if self._read_seq < self._segments[0]:
+            self._read_seq, self._read_offset = self._segments[0], 0
+
+    # -- segment files -------------------------------------------------------
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                seqs.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(seqs)
+
+    def _map(self, seq):
+        if seq not in self._maps:
+            path = self._path(seq)
+            f = open(path, "a+b")
+            if os.path.getsize(path) < self.segment_size:
+                f.truncate(self.segment_size)
+                self._fsync_dir()
+            self._maps[seq] = (f, mmap.mmap(f.fileno(), self.segment_size))
+        return self._maps[seq][1]
+
+    def _unmap(self, seq):
+        f, mm = self._maps.pop(seq, (None, None))
+        if mm is not None:
+            mm.close()
+            f.close()
+
+    def _fsync_dir(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _read_record(self, mm, offset):
+        """Return (data, next_offset) for the record at offset, or (None, offset) at the end."""
+        if offset + HEADER.size > self.segment_size:
+            return None, offset
+        length, crc = HEADER.unpack_from(mm, offset)
+        end = offset + HEADER.size + length
+        if length == 0 or end > self.segment_size:
+            return None, offset
+        data = bytes(mm[offset + HEADER.size:end])
+        if zlib.crc32(data) != crc:
+            return None, offset
+        return data, end
+
+    def _scan_end(self, seq):
+        """Find the write offset of a segment by walking its valid records."""
+        mm = self._map(seq)
+        offset = 0
+        while True:
+            data, next_offset = self._read_record(mm, offset)
+            if data is None:
+                return offset
+            offset = next_offset
+
+    # -- cursor --------------------------------------------------------------
+
+    def _load_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        try:
+            with open(path) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (FileNotFoundError, ValueError):
+            return (self._segments[0] if self._segments else 1), 0
+
+    def _store_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{self._read_seq} {self._read_offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    # -- public API ----------------------------------------------------------
+
+    def append(self, data):
+        """Append one record (bytes) to the spool."""
+        record_size = HEADER.size + len(data)
+        if record_size > self.segment_size:
+            raise ValueError(f"Record of {len(data)} bytes does not fit in a spool segment")
+        with self._lock:
+            if self._write_offset + record_size > self.segment_size:
+                self._roll()
+            mm = self._map(self._write_seq)
+            mm[self._write_offset + HEADER.size:self._write_offset + record_size] = data
+            HEADER.pack_into(mm, self._write_offset, len(data), zlib.crc32(data))
+            self._write_offset += record_size
+            self._unsynced += 1
+            if (self._unsynced >= self.fsync_batch
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def _roll(self):
+        """Start a new segment, dropping the oldest ones if the disk budget is exceeded."""
+        self._sync()
+        self._write_seq += 1
+        self._segments.append(self._write_seq)
+        self._write_offset = 0
+        while len(self._segments) * self.segment_size > self.max_bytes:
+            self._drop_oldest()
+        self._map(self._write_seq)
+
+    def _drop_oldest(self):
+        seq = self._segments.pop(0)
+        if seq >= self._read_seq:
+            mm = self._map(seq)
+            offset = self._read_offset if seq == self._read_seq else 0
+            lost = 0
+            data, offset = self._read_record(mm, offset)
+            while data is not None:
+                lost += 1
+                data, offset = self._read_record(mm, offset)
+            self.dropped += lost
+            logger.warning(f"Spool disk budget exceeded, dropped {lost} unsent messages")
+        self._unmap(seq)
+        os.remove(self._path(seq))
+        if self._read_seq <= seq:
+            self._read_seq, self._read_offset = self._segments[0], 0
+            self._store_cursor()
+
+    def _sync(self):
+        if self._write_seq in self._maps:
+            self._maps[self._write_seq][1].flush()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        """Force pending appends to disk."""
+        with self._lock:
+            self._sync()
+
+    def peek(self, max_records=100):
+        """
+        Return up to max_records unsent records in order as a list of (position, data).
+        Pass the position of the last delivered record to commit().
+        """
+        records = []
+        with self._lock:
+            seq, offset = self._read_seq, self._read_offset
+            while len(records) < max_records and seq <= self._write_seq:
+                if seq not in self._segments:
+                    seq, offset = seq + 1, 0
+                    continue
+                data, next_offset = self._read_record(self._map(seq), offset)
+                if data is None or (seq == self._write_seq and next_offset > self._write_offset):
+                    if seq == self._write_seq:
+                        break
+                    seq, offset = seq + 1, 0
+                    continue
+                records.append(((seq, next_offset), data))
+                offset = next_offset
+        return records
+
+    def commit(self, position):
+        """Advance the read cursor past a delivered record and delete consumed segments."""
+        with self._lock:
+            seq, offset = position
+            if not self._segments or seq < self._segments[0]:
+                return  # segment was dropped to stay within the disk budget meanwhile
+            self._read_seq, self._read_offset = seq, offset
+            while self._segments and self._segments[0] < seq:
+                old = self._segments.pop(0)
+                self._unmap(old)
+                os.remove(self._path(old))
+            self._store_cursor()
+
+    def is_empty(self):
+        return not self.peek(1)
+
+    def disk_usage(self):
+        return len(self._segments) * self.segment_size
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            for seq in list(self._maps):
+                self._unmap(seq)
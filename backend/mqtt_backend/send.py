@@ -1,7 +1,7 @@
-import requests
 import json
 import time
-from core.base_node import BaseNode 
+from core.base_node import BaseNode
+from remote.api_client import ApiClient
 
 BROKER_HOST = "localhost"     
 BROKER_PORT = 1883
@@ -15,30 +15,12 @@ PROTOCOL = "hl7"                             # Change to desired protocol
 
 API_ROOT = f"http://{BACKEND_HOST}:{BACKEND_PORT}/api"
 
-def get_access_token(username, password):
-    url = f"{API_ROOT}/auth/user/token/"
-    r = requests.post(url, json={"username": username, "password": password}, timeout=10)
-    r.raise_for_status()
-    return r.json()["access"]
-
-def get_agent_id(username, token):
-    url = f"{API_ROOT}/agents/by-username/{username}/"
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=10)
-    r.raise_for_status()
-    return r.json()["agent_id"]
-
 def main():
-    token = get_access_token(LOGIN_USERNAME, LOGIN_PASSWORD)
-    print("✓ got access token")
-
-    # Resolve IDs
-    sender_id = get_agent_id(LOGIN_USERNAME, token)
-    receiver_id = get_agent_id(TARGET_USERNAME, token)
-    print(f"✓ sender_id={sender_id}, receiver_id={receiver_id}")
+    client = ApiClient(API_ROOT, LOGIN_USERNAME, LOGIN_PASSWORD)
 
-    # Spin up BaseNode and send message
-    node = BaseNode(str(sender_id), broker=BROKER_HOST, port=BROKER_PORT)
-    node.start()
+    # Spin up BaseNode for the logged-in agent (login and ID lookup happen once, then are cached)
+    node = client.node(BaseNode, broker=BROKER_HOST, port=BROKER_PORT)
+    print(f"✓ sender_id={node.object_id}")
 
     payload = {
         "patient_id": "P67890",
@@ -46,10 +28,7 @@ def main():
         "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
     }
 
-    node.send_message(destination=str(receiver_id),
-                      protocol=PROTOCOL,
-                      msg_type="report",
-                      payload=payload)
+    client.send_to_username(node, TARGET_USERNAME, PROTOCOL, "report", payload)
     print("✓ message published via MQTT")
 
     # Keep running to allow MQTT to flush or receive
@@ -0,0 +1,254 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from threading import Thread, Event, Lock
+
+import redis
+
+from mqtt_backend.core.config import REDIS_HOST, REDIS_PORT, REDIS_DB, get_int_setting
+
+"""
+Sharding of communication nodes across processes.
+
+Every comm shard (a gunicorn worker or a dedicated `run_comm_shard` process) registers itself
+in Redis with a heartbeat. Agents are mapped onto the live shards with a consistent hash ring,
+so each agent's MQTT client is owned by exactly one process and no two workers fight over the
+same client ID. Any process can ask the owning shard to act for an agent by publishing a
+command on the shard's Redis channel.
+"""
+
+logger = logging.getLogger('omnisyslogger')
+
+SHARD_REGISTRY_KEY = "comm:shards"            # sorted set: shard_id -> last heartbeat (unix time)
+SHARD_CHANGES_CHANNEL = "comm:shards:changed"  # membership change notifications
+SHARD_COMMAND_CHANNEL = "comm:shard:{shard_id}"
+
+HEARTBEAT_INTERVAL = get_int_setting("COMM_SHARD_HEARTBEAT_INTERVAL", 5)  # seconds
+SHARD_TTL = get_int_setting("COMM_SHARD_TTL", 15)  # seconds without heartbeat before a shard is considered gone
+RING_REPLICAS = get_int_setting("COMM_SHARD_RING_REPLICAS", 64)  # virtual nodes per shard
+MAX_COMMAND_HOPS = 2  # forwards allowed while shards disagree about ownership during a rebalance
+
+
+def default_shard_id():
+    """Shard ID for the current process, unique per host and pid."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def get_redis():
+    return redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+    Adding or removing a shard only moves the agents that hash next to that shard's points.
+    """
+    def __init__(self, shards=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for shard in shards:
+            self.add(shard)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    def add(self, shard):
+        for i in range(self.replicas):
+            point = self._hash(f"{shard}#{i}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = shard
+
+    def remove(self, shard):
+        for i in range(self.replicas):
+            point = self._hash(f"{shard}#{i}")
+            if self._owners.get(point) == shard:
+                del self._owners[point]
+                index = bisect.bisect_left(self._points, point)
+                del self._points[index]
+
+    def owner(self, key):
+        """Return the shard owning the given key, or None if the ring is empty."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+    @property
+    def shards(self):
+        return sorted(set(self._owners.values()))
+
+
+def live_shards(redis_client):
+    """Return the IDs of all shards with a recent heartbeat."""
+    cutoff = time.time() - SHARD_TTL
+    return sorted(s.decode() for s in redis_client.zrangebyscore(SHARD_REGISTRY_KEY, cutoff, "+inf"))
+
+
+def owner_of(agent_id, redis_client):
+    """Return the shard currently owning the given agent."""
+    return HashRing(live_shards(redis_client)).owner(str(agent_id))
+
+
+def send_command(agent_id, command, redis_client=None):
+    """
+    Publish a command to the shard that owns the agent.
+    Returns the number of shards that received it (0 if the owner is not listening).
+    """
+    redis_client = redis_client or get_redis()
+    shard_id = owner_of(agent_id, redis_client)
+    if shard_id is None:
+        logger.warning(f"No live comm shard to handle {command.get('op')} for agent {agent_id}")
+        return 0
+    command = dict(command, agent_id=str(agent_id))
+    received = redis_client.publish(SHARD_COMMAND_CHANNEL.format(shard_id=shard_id), json.dumps(command))
+    logger.debug(f"Sent {command['op']} for agent {agent_id} to shard {shard_id} (received={received})")
+    return received
+
+
+class CommShard:
+    """
+    A process-local shard of communication nodes.
+    It keeps a heartbeat in Redis, listens for commands on its own channel and rebalances
+    (starts newly owned nodes, shuts down nodes that moved away) whenever membership changes.
+
+    agent_provider: callable returning the IDs of all agents that should have a node.
+    node_manager: object exposing create_node/shutdown_node/get_node/live_nodes (CommNodeManager).
+    """
+    def __init__(self, agent_provider, node_manager, shard_id=None, redis_client=None):
+        self.shard_id = shard_id or default_shard_id()
+        self.agent_provider = agent_provider
+        self.node_manager = node_manager
+        self.redis = redis_client or get_redis()
+        self.ring = HashRing()
+        self._members = []
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._pubsub = None
+        self._listener_thread = None
+        self._heartbeat_thread = None
+
+    def owns(self, agent_id):
+        return self.ring.owner(str(agent_id)) == self.shard_id
+
+    def start(self):
+        """Join the ring, take ownership of this shard's agents and start listening for commands."""
+        self._heartbeat()
+        self.redis.publish(SHARD_CHANGES_CHANNEL, json.dumps({"joined": self.shard_id}))
+
+        self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(SHARD_COMMAND_CHANNEL.format(shard_id=self.shard_id), SHARD_CHANGES_CHANNEL)
+        self._listener_thread = Thread(target=self._listen_loop, daemon=True)
+        self._listener_thread.start()
+        self._heartbeat_thread = Thread(target=self._heartbeat_loop, daemon=True)
+        self._heartbeat_thread.start()
+
+        self.rebalance()
+        logger.info(f"Comm shard {self.shard_id} started")
+
+    def stop(self):
+        """Leave the ring gracefully so the remaining shards take over immediately."""
+        self._stop_event.set()
+        self.redis.zrem(SHARD_REGISTRY_KEY, self.shard_id)
+        self.redis.publish(SHARD_CHANGES_CHANNEL, json.dumps({"left": self.shard_id}))
+        if self._pubsub:
+            self._pubsub.close()
+        self.node_manager.shutdown_all()
+        logger.info(f"Comm shard {self.shard_id} stopped")
+
+    def rebalance(self):
+        """Recompute the ring from live shards and adjust the locally owned nodes."""
+        with self._lock:
+            members = live_shards(self.redis)
+            if self.shard_id not in members:
+                members = sorted(members + [self.shard_id])
+            self._members = members
+            self.ring = HashRing(members)
+
+            owned = {str(a) for a in self.agent_provider() if self.owns(a)}
+            running = {str(a) for a in list(self.node_manager.live_nodes.keys())}
+
+            for agent_id in running - owned:
+                self.node_manager.shutdown_node(self._key(agent_id))
+            for agent_id in owned - running:
+                self.node_manager.create_node(self._key(agent_id))
+            logger.info(
+                f"Shard {self.shard_id} rebalanced over {len(members)} shards: owns {len(owned)} agents "
+                f"(+{len(owned - running)}, -{len(running - owned)})")
+
+    @staticmethod
+    def _key(agent_id):
+        """Live nodes are keyed by int agent ID in the backend."""
+        return int(agent_id) if str(agent_id).isdigit() else agent_id
+
+    def handle_command(self, command):
+        """Execute a command addressed to an agent owned by this shard."""
+        op = command.get("op")
+        agent_id = command.get("agent_id")
+        if not self.owns(agent_id):
+            # Membership changed while the command was in flight, forward it to the new owner
+            hops = command.get("hops", 0)
+            if hops >= MAX_COMMAND_HOPS:
+                logger.warning(f"Dropping {op} for agent {agent_id} after {hops} forwards")
+                return
+            logger.info(f"Shard {self.shard_id} no longer owns agent {agent_id}, forwarding {op}")
+            send_command(agent_id, dict(command, hops=hops + 1), self.redis)
+            return
+
+        key = self._key(agent_id)
+        if op == "send":
+            node = self.node_manager.get_node(key) or self.node_manager.create_node(key)
+            node.send_message(command["destination"], command["protocol"], command["type"], command["payload"])
+        elif op == "deliver":
+            node = self.node_manager.get_node(key) or self.node_manager.create_node(key)
+            node.handle_message(command["message"])
+        elif op in ("join_context", "leave_context"):
+            node = self.node_manager.get_node(key)
+            if node:
+                getattr(node, op)(command["context_id"])
+        elif op == "create_node":
+            self.node_manager.create_node(key)
+        elif op == "shutdown_node":
+            self.node_manager.shutdown_node(key)
+        else:
+            logger.warning(f"Shard {self.shard_id} received unknown command: {op}")
+
+    def _listen_loop(self):
+        command_channel = SHARD_COMMAND_CHANNEL.format(shard_id=self.shard_id)
+        while not self._stop_event.is_set():
+            try:
+                message = self._pubsub.get_message(timeout=1.0)
+                if not message:
+                    continue
+                channel = message["channel"].decode()
+                data = json.loads(message["data"])
+                if channel == SHARD_CHANGES_CHANNEL:
+                    self.rebalance()
+                elif channel == command_channel:
+                    self.handle_command(data)
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                logger.error(f"Shard {self.shard_id} failed to process message: {e}")
+                time.sleep(1)
+
+    def _heartbeat(self):
+        now = time.time()
+        self.redis.zadd(SHARD_REGISTRY_KEY, {self.shard_id: now})
+        # Drop shards that stopped heartbeating (crashed processes)
+        return self.redis.zremrangebyscore(SHARD_REGISTRY_KEY, "-inf", now - SHARD_TTL)
+
+    def _heartbeat_loop(self):
+        while not self._stop_event.wait(HEARTBEAT_INTERVAL):
+            try:
+                removed = self._heartbeat()
+                if removed or live_shards(self.redis) != self._members:
+                    self.rebalance()
+            except Exception as e:
+                logger.error(f"Shard {self.shard_id} heartbeat failed: {e}")